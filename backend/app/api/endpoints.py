@@ -1,35 +1,42 @@
-from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks,Request
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+import asyncio
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from datetime import datetime
+from typing import Dict, Any, Optional
 import uuid
 
-from app.models.schema import QueryRequest, QueryResponse, SessionResponse, SessionHistoryResponse, SessionInit
-from app.services.conversation_service import ConversationManager, get_conversation_manager, conversation_store
-from app.services.ai_service import classify_query_type, handle_general_conversation
-from app.services.data_service import process_dataframe_query, get_dataframe
-from app.config import CONVERSATION_TIMEOUT_HOURS
+from app.models.schema import (
+    QueryRequest, QueryResponse, SessionResponse, SessionHistoryResponse, SessionInit, SessionSearchResponse,
+    ResultPage
+)
+from app.services.conversation_service import (
+    ConversationManager, get_conversation_manager, conversation_store, session_registry, delete_conversation
+)
+from app.services.ai_service import (
+    AiModelService, classify_query_type, classify_flights, handle_general_conversation, local_classifier,
+    prepare_general_conversation, stream_conversation_response
+)
+from app.services import data_service
+from app.services.data_service import (
+    process_dataframe_query, compute_dataframe_result, build_explanation_prompt, dataset_registry
+)
+from app.api.responses import FastJSONResponse, dumps_json
+from app.services.result_encoding import (
+    negotiate_encoding, arrow_available, frame_columns, frame_arrow_stream,
+    ENCODING_ARROW, ENCODING_COLUMNAR, COLUMNAR_MEDIA_TYPE, ARROW_STREAM_MEDIA_TYPE
+)
+from app.services.result_store import ResultNotFoundError, frame_records
+from app.services.session_catalog import InvalidCursorError
+from app.services.sql_engine import ENGINE_SQL
+from app.services.llm_provider import get_llm_provider, STAGE_CONVERSATION, STAGE_EXPLANATION
 
 logger = logging.getLogger(__name__)
 
 # Create router
 router = APIRouter()
 
-# Background task to clean up old conversations
-async def cleanup_old_conversations():
-    """Remove conversations that haven't been accessed for more than CONVERSATION_TIMEOUT_HOURS"""
-    cutoff_time = datetime.now() - timedelta(hours=CONVERSATION_TIMEOUT_HOURS)
-    removed = 0
-    
-    for session_id in list(conversation_store.keys()):
-        if conversation_store[session_id]["last_access"] < cutoff_time:
-            conversation_store.pop(session_id)
-            removed += 1
-    
-    logger.info(f"Cleaned up {removed} old conversations")
-
 # Root route (for health check)
 @router.get("/")
 async def root():
@@ -50,7 +57,7 @@ async def init_session():
     session_id = str(uuid.uuid4())
     
     # Create new conversation manager for this session
-    conversation_manager = ConversationManager(session_id)
+    conversation_manager = get_conversation_manager(session_id)
     
     return SessionInit(
         sessionId=session_id
@@ -63,7 +70,7 @@ async def create_session():
     session_id = str(uuid.uuid4())
     
     # Create new conversation manager for this session
-    conversation_manager = ConversationManager(session_id)
+    conversation_manager = get_conversation_manager(session_id)
     
     return SessionInit(
         sessionId=session_id
@@ -71,13 +78,17 @@ async def create_session():
 
 # Get chat history
 @router.get("/sessions/history", response_model=SessionHistoryResponse)
-async def get_session_history():
-    """Get list of recent chat sessions"""
-    # Use the list_conversations function from conversation_service
-    from app.services.conversation_service import list_conversations
+async def get_session_history(limit: int = 20, cursor: Optional[str] = None, tag: Optional[str] = None):
+    """Get list of recent chat sessions, newest first; pass nextCursor back as `cursor` for the next page"""
+    # Served from the session catalog, so the cost depends on the page size only
+    from app.services.conversation_service import list_conversation_page, session_catalog
     
-    # Get paginated conversations (default 20)
-    conversations, total_count = list_conversations(limit=20, offset=0)
+    if limit < 1 or limit > 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    try:
+        conversations, next_cursor = list_conversation_page(limit=limit, cursor=cursor, filter_tag=tag)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Format for response
     history = []
@@ -87,45 +98,77 @@ async def get_session_history():
             "createdAt": conv.get("created_at", datetime.now().isoformat()),
             "updatedAt": conv.get("last_access", conv.get("created_at", datetime.now().isoformat())),
             "title": conv.get("title", f"Conversation {conv['session_id'][:8]}"),
-            "messageCount": conv.get("message_count", 0)
+            "messageCount": conv.get("message_count", 0),
+            "tags": conv.get("tags", [])
         })
     
     return SessionHistoryResponse(
-        history=history
+        history=history,
+        nextCursor=next_cursor,
+        total=session_catalog.count(tag)
     )
 
+# Search chat history
+@router.get("/sessions/search", response_model=SessionSearchResponse)
+async def search_sessions(q: str, limit: int = 20, offset: int = 0):
+    """Full-text search over session titles and messages; the last word also matches as a prefix"""
+    from app.services.conversation_service import search_conversations
+    
+    if limit < 1 or limit > 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    
+    matches, total_count = search_conversations(q, limit=limit, offset=offset)
+    results = []
+    for match in matches:
+        results.append({
+            "sessionId": match["session_id"],
+            "title": match.get("title", f"Conversation {match['session_id'][:8]}"),
+            "score": match["score"],
+            "titleMatch": match["title_match"],
+            "messageIndexes": match["message_indexes"],
+            "updatedAt": match.get("last_access"),
+            "messageCount": match.get("message_count", 0)
+        })
+    
+    return SessionSearchResponse(
+        results=results,
+        total=total_count
+    )
+
+def _session_payload(session_id: str, conversation_manager: ConversationManager,
+                     updated_at: Optional[str] = None) -> Dict[str, Any]:
+    """SessionResponse body built straight from the stored messages
+    
+    Returned as a FastJSONResponse, which skips validating and re-encoding every message through
+    the response model.
+    """
+    metadata = conversation_manager.get_metadata()
+    messages = [
+        {
+            "text": msg.text,
+            "sender": msg.sender,
+            "timestamp": msg.timestamp,
+            "source": getattr(msg, "source", "conversation"),
+            "isError": getattr(msg, "isError", False)
+        }
+        for msg in conversation_manager.get_messages()
+    ]
+    return {
+        "id": session_id,
+        "messages": messages,
+        "createdAt": metadata.get("created_at", datetime.now().isoformat()),
+        "updatedAt": updated_at or metadata.get("last_access", datetime.now().isoformat())
+    }
+
 # Get a specific session
 @router.get("/sessions/{session_id}", response_model=SessionResponse)
 async def get_session(session_id: str):
     """Get details for a specific chat session"""
     try:
-        # Load the conversation using ConversationManager
-        conversation_manager = ConversationManager(session_id)
-        
-        # Get all messages
-        messages_obj = conversation_manager.get_messages()
-        
-        # Get metadata
-        metadata = conversation_manager.get_metadata()
-        
-        # Format messages for frontend
-        messages = []
-        for msg in messages_obj:
-            messages.append({
-                "text": msg.text,
-                "sender": msg.sender,
-                "timestamp": msg.timestamp,
-                "source": getattr(msg, "source", "conversation"),
-                "isError": getattr(msg, "isError", False)
-            })
+        # Load the conversation (served from memory if the session is live)
+        conversation_manager = get_conversation_manager(session_id)
         
-        return SessionResponse(
-            id=session_id,
-            messages=messages,
-            createdAt=metadata.get("created_at", datetime.now().isoformat()),
-            updatedAt=metadata.get("last_access", datetime.now().isoformat()),
-            title=metadata.get("title", f"Conversation {session_id[:8]}")
-        )
+        return FastJSONResponse(_session_payload(session_id, conversation_manager))
     
     except Exception as e:
         logger.error(f"Error retrieving session {session_id}: {str(e)}")
@@ -136,37 +179,10 @@ async def get_session(session_id: str):
 async def load_session(session_id: str):
     """Load a specific chat session with all its messages"""
     try:
-        # Load the conversation using ConversationManager
-        conversation_manager = ConversationManager(session_id)
-        
-        # Get all messages
-        messages_obj = conversation_manager.get_messages()
-        
-        # Get metadata
-        metadata = conversation_manager.get_metadata()
-        
-        # Format messages for frontend
-        messages = []
-        for msg in messages_obj:
-            messages.append({
-                "text": msg.text,
-                "sender": msg.sender,
-                "timestamp": msg.timestamp,
-                "source": getattr(msg, "source", "conversation"),
-                "isError": getattr(msg, "isError", False)
-            })
-        
-        # Update the last access time
-        conversation_manager.conversation_data["last_access"] = datetime.now().isoformat()
-        conversation_manager._save_conversation()
+        # Load the conversation (served from memory if the session is live)
+        conversation_manager = get_conversation_manager(session_id)
         
-        return SessionResponse(
-            id=session_id,
-            messages=messages,
-            createdAt=metadata.get("created_at", datetime.now().isoformat()),
-            updatedAt=datetime.now().isoformat(),
-            title=metadata.get("title", f"Conversation {session_id[:8]}")
-        )
+        return FastJSONResponse(_session_payload(session_id, conversation_manager, updated_at=datetime.now().isoformat()))
     
     except Exception as e:
         logger.error(f"Error loading session {session_id}: {str(e)}")
@@ -175,25 +191,23 @@ async def load_session(session_id: str):
 @router.post("/query", response_model=QueryResponse)
 async def query(
     request: QueryRequest, 
-    background_tasks: BackgroundTasks,
-    conversation_manager: ConversationManager = Depends(get_conversation_manager)
+    background_tasks: BackgroundTasks
 ):
     """Process a natural language query against the employee data"""
     question = request.query
     session_id = request.session_id or str(uuid.uuid4())
     
-    # Schedule cleanup in background
-    background_tasks.add_task(cleanup_old_conversations)
-    
     if not question or question.strip() == "":
         raise HTTPException(status_code=400, detail="Query cannot be empty")
+    _check_dataset(request.dataset)
     
-    # Initialize conversation manager with provided session ID
-    conversation_manager = ConversationManager(session_id)
+    # Get the conversation manager for the provided session ID
+    conversation_manager = get_conversation_manager(session_id)
     
     try:
         # First determine if this is a data analysis question or general conversation
-        query_type = await classify_query_type(question, conversation_manager)
+        debug_info = {}
+        query_type = await classify_query_type(question, conversation_manager, debug_info, request.dataset)
         logger.info(f"Query type for '{question[:50]}...': {query_type}")
         
         if query_type == "GENERAL_CONVERSATION":
@@ -208,7 +222,9 @@ async def query(
             )
         else:
             # Process as a data analysis query
-            result_data, answer, code = await process_dataframe_query(question, conversation_manager)
+            result_data, answer, code = await process_dataframe_query(
+                question, conversation_manager, debug_info, request.dataset
+            )
             
             # Store the interaction in conversation history
             conversation_manager.add_message(question, answer, result_data)
@@ -216,14 +232,18 @@ async def query(
             response = QueryResponse(
                 answer=answer, 
                 source="dataframe",
-                session_id=session_id
+                session_id=session_id,
+                data_version=debug_info.get("data_version"),
+                result_id=debug_info.get("result_id"),
+                result_rows=debug_info.get("result_rows")
             )
             
             # Include debug info if in development
             if os.getenv("ENV") == "development":
                 response.debug = {
                     "code": code,
-                    "raw_result": result_data
+                    "raw_result": result_data,
+                    **debug_info
                 }
                 
             return response
@@ -236,13 +256,162 @@ async def query(
             session_id=session_id
         )
 
+def _check_dataset(name: Optional[str]) -> None:
+    """Reject a request naming a dataset that isn't registered"""
+    if name is not None and name not in dataset_registry:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset: {name}")
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {dumps_json(data).decode('utf-8')}\n\n"
+
+# Streaming pipelines that outlive their client; kept referenced until they finish
+_stream_tasks = set()
+
+@router.post("/query/stream")
+async def query_stream(request: QueryRequest):
+    """Process a query like /query, streaming pipeline stages and answer tokens as Server-Sent Events
+    
+    Events: classified, code_generated, result_computed, token (repeated), then done (the final
+    QueryResponse) or error. The pipeline runs as its own task, so the exchange is still completed
+    and saved to the conversation when the client disconnects early.
+    """
+    question = request.query
+    session_id = request.session_id or str(uuid.uuid4())
+    
+    if not question or question.strip() == "":
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+    _check_dataset(request.dataset)
+    
+    conversation_manager = get_conversation_manager(session_id)
+    is_development = os.getenv("ENV") == "development"
+    # Formatted events, then None once the pipeline has finished
+    events: asyncio.Queue = asyncio.Queue()
+    
+    async def run_pipeline():
+        try:
+            ai_service = AiModelService()
+            debug_info = {}
+            query_type = await classify_query_type(question, conversation_manager, debug_info, request.dataset)
+            events.put_nowait(_sse_event("classified", {"query_type": query_type}))
+            
+            result_data = None
+            code = None
+            chunks = []
+            
+            if query_type == "GENERAL_CONVERSATION":
+                source = "conversation"
+                prompt, response_length, generation_config = await prepare_general_conversation(
+                    ai_service, question, conversation_manager
+                )
+                # Tokens are cleaned as they stream, so the client sees exactly the stored answer
+                async for chunk in stream_conversation_response(ai_service.stream_content(
+                    prompt, stage=STAGE_CONVERSATION, generation_config=generation_config
+                )):
+                    chunks.append(chunk)
+                    events.put_nowait(_sse_event("token", {"text": chunk}))
+                answer = "".join(chunks).strip()
+            else:
+                source = "dataframe"
+                result_data, code, response_length, error_answer = await compute_dataframe_result(
+                    question, conversation_manager, debug_info, request.dataset
+                )
+                events.put_nowait(_sse_event("code_generated", {"code": code} if is_development else {}))
+                
+                if error_answer is not None:
+                    answer = error_answer
+                else:
+                    events.put_nowait(_sse_event("result_computed", {"result": result_data} if is_development else {}))
+                    explanation_prompt = build_explanation_prompt(
+                        question, result_data, response_length, debug_info.get("result_rows")
+                    )
+                    async for chunk in ai_service.stream_content(explanation_prompt, stage=STAGE_EXPLANATION):
+                        chunks.append(chunk)
+                        events.put_nowait(_sse_event("token", {"text": chunk}))
+                    answer = "".join(chunks).strip()
+            
+            # Store the interaction in conversation history
+            conversation_manager.add_message(question, answer, result_data)
+            
+            response = QueryResponse(
+                answer=answer, source=source, session_id=session_id, data_version=debug_info.get("data_version"),
+                result_id=debug_info.get("result_id"), result_rows=debug_info.get("result_rows")
+            )
+            if is_development and source == "dataframe":
+                response.debug = {
+                    "code": code,
+                    "raw_result": result_data,
+                    **debug_info
+                }
+            events.put_nowait(_sse_event("done", response.model_dump()))
+        
+        except Exception as e:
+            logger.error(f"Error streaming query: {str(e)}", exc_info=True)
+            response = QueryResponse(
+                answer="I'm sorry, but I encountered an error while processing your question. Please try rephrasing or ask something else.",
+                source="error",
+                session_id=session_id
+            )
+            events.put_nowait(_sse_event("error", response.model_dump()))
+        finally:
+            events.put_nowait(None)
+    
+    async def event_stream():
+        # A disconnect closes this generator but not the pipeline task
+        task = asyncio.ensure_future(run_pipeline())
+        _stream_tasks.add(task)
+        task.add_done_callback(_stream_tasks.discard)
+        while True:
+            event = await events.get()
+            if event is None:
+                return
+            yield event
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/results/{result_id}", response_model=ResultPage)
+async def get_result_page(result_id: str, request: Request, offset: int = 0, limit: int = 50):
+    """Page through a stored table result returned as result_id by /query
+    
+    Rows are records by default. Send `Accept: application/vnd.columnar+json` for column names
+    once plus one value array per column, or `Accept: application/vnd.apache.arrow.stream` for an
+    Arrow IPC stream of the page (when pyarrow is installed).
+    """
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="offset must not be negative")
+    if limit < 1 or limit > 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    encoding = negotiate_encoding(request.headers.get("accept"))
+    if encoding == ENCODING_ARROW and not arrow_available():
+        raise HTTPException(status_code=406, detail="Arrow encoding is not available on this server")
+    try:
+        rows, total = data_service.result_store.slice(result_id, offset, limit)
+    except ResultNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Result {result_id} not found or expired")
+    
+    next_offset = offset + limit if offset + limit < total else None
+    if encoding == ENCODING_ARROW:
+        headers = {"X-Total-Count": str(total)}
+        if next_offset is not None:
+            headers["X-Next-Offset"] = str(next_offset)
+        return Response(content=frame_arrow_stream(rows), media_type=ARROW_STREAM_MEDIA_TYPE, headers=headers)
+    
+    # Built directly instead of through ResultPage, so the rows aren't validated and copied again
+    page = {"resultId": result_id, "offset": offset, "limit": limit, "total": total, "nextOffset": next_offset}
+    if encoding == ENCODING_COLUMNAR:
+        return FastJSONResponse({**page, **frame_columns(rows)}, media_type=COLUMNAR_MEDIA_TYPE)
+    return FastJSONResponse({**page, "rows": frame_records(rows)})
+
 # Delete a specific session
 @router.delete("/sessions/{session_id}")
 async def delete_session(session_id: str):
     """Delete a specific chat session"""
     try:
-        conversation_manager = ConversationManager(session_id)
-        success = conversation_manager.delete_conversation()
+        success = delete_conversation(session_id)
         
         if success:
             return {"status": "success", "message": f"Session {session_id} deleted successfully"}
@@ -258,7 +427,7 @@ async def delete_session(session_id: str):
 async def clear_session_history(session_id: str):
     """Clear all messages in a specific chat session but keep the session"""
     try:
-        conversation_manager = ConversationManager(session_id)
+        conversation_manager = get_conversation_manager(session_id)
         conversation_manager.clear_history()
         
         return {"status": "success", "message": f"Conversation history for session {session_id} cleared"}
@@ -267,30 +436,71 @@ async def clear_session_history(session_id: str):
         logger.error(f"Error clearing history for session {session_id}: {str(e)}")
         raise HTTPException(status_code=404, detail=f"Session not found or error occurred: {str(e)}")
 
+@router.get("/datasets")
+async def list_datasets():
+    """List the registered datasets and whether each is currently loaded"""
+    stats = dataset_registry.get_stats()
+    return {
+        "default": stats["default"],
+        "datasets": [
+            {"name": name, "engine": data_service.dataset_engine(name), "loaded": details["loaded"],
+             "version": details.get("version"),
+             "shape": details.get("shape"), "memoryBytes": details["memory_bytes"]}
+            for name, details in stats["datasets"].items()
+        ],
+        "memoryBudgetBytes": stats["memory_budget_bytes"],
+        "memoryUsedBytes": stats["memory_used_bytes"]
+    }
+
+@router.get("/datasets/{name}/memory")
+def get_dataset_memory(name: str):
+    """Per-column dtypes and memory of a dataset before and after dtype compaction (loads it if needed)"""
+    _check_dataset(name)
+    if data_service.dataset_engine(name) == ENGINE_SQL:
+        raise HTTPException(status_code=400, detail=f"Dataset {name} is queried with SQL and isn't held in memory")
+    return data_service.get_memory_report(name)
+
 @router.get("/debug")
 async def debug():
     """Debug endpoint providing system information"""
-    # Count files in storage directory
-    from app.services.conversation_service import STORAGE_DIR
-    file_count = len([f for f in os.listdir(STORAGE_DIR) if f.endswith('.json')])
+    # Count conversations from the session catalog instead of scanning storage
+    from app.services.conversation_service import storage, count_conversations, search_index, expiry_scheduler
+    persisted_count = count_conversations()
     
     return {
         "sessions_count": len(conversation_store),
         "session_ids": list(conversation_store.keys()),
-        "persisted_sessions_count": file_count,
+        "persisted_sessions_count": persisted_count,
+        "storage_backend": storage.name,
+        "session_registry": session_registry.get_stats(),
+        "llm": get_llm_provider().get_stats(),
+        "datasets": dataset_registry.get_stats(),
+        "code_cache": data_service.code_cache.get_stats(),
+        "executor": data_service.code_executor.get_stats(),
+        "compiler": data_service.expression_compiler.get_stats(),
+        "aggregate_cube": data_service.aggregate_cubes.get_stats(),
+        "sql_engine": data_service.sql_engine.get_stats(),
+        "coalescing": {
+            flights.name: flights.get_stats()
+            for flights in (classify_flights, data_service.query_flights, data_service.compute_flights)
+        },
+        "result_cache": data_service.result_cache.get_stats(),
+        "result_store": data_service.result_store.get_stats(),
+        "classifier": local_classifier.get_stats(),
+        "search_index": search_index.get_stats(),
+        "expiry": expiry_scheduler.get_stats(),
         "system_time": datetime.now().isoformat()
     }
 
 @router.get("/cleanup")
-async def cleanup_old_sessions(background_tasks: BackgroundTasks):
-    """Manually trigger cleanup of old sessions"""
-    background_tasks.add_task(cleanup_old_conversations)
-    
-    # Also clean up old conversation files
-    from app.services.conversation_service import cleanup_old_conversations as cleanup_files
-    deleted_count = cleanup_files(max_age_days=CONVERSATION_TIMEOUT_HOURS//24)
+async def cleanup_old_sessions():
+    """Manually run an expiry sweep: release idle sessions and delete conversations past retention"""
+    # Only sessions that are actually due are touched (see expiry_scheduler)
+    from app.services.conversation_service import expire_sessions
+    expired = expire_sessions()
     
     return {
-        "status": "cleanup scheduled", 
-        "files_deleted": deleted_count
+        "status": "cleanup complete", 
+        "sessions_released": expired.get("idle", 0),
+        "files_deleted": expired.get("retention", 0)
     }
\ No newline at end of file
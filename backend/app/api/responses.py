@@ -0,0 +1,48 @@
+# app/api/responses.py
+import datetime
+import decimal
+import json
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library encoder
+    orjson = None
+
+
+def _json_default(value: Any) -> Any:
+    """Encode values the JSON encoder doesn't know (pandas/numpy scalars, sets, decimals)"""
+    if isinstance(value, (pd.Timestamp, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, pd.Timedelta):
+        return str(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if value is pd.NaT or value is pd.NA:
+        return None
+    return str(value)
+
+
+def dumps_json(content: Any) -> bytes:
+    """Serialize content to UTF-8 JSON, with orjson when it is installed (NaN becomes null)"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson; also accepts pandas/numpy values in the content"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
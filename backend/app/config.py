@@ -8,11 +8,120 @@ load_dotenv()
 # Constants
 MAX_HISTORY_ENTRIES = 10
 CONVERSATION_TIMEOUT_HOURS = 24
-UNSAFE_CODE_PATTERNS = ['import', 'exec', 'eval', 'os.', 'system', '__', 'open', 'file', 'write']
 
 # Configure Google Gemini API
 API_KEY = os.getenv("GEMINI_API_KEY")
 if API_KEY:
     genai.configure(api_key=API_KEY)
 else:
-    print("GEMINI_API_KEY not found in environment variables!")
\ No newline at end of file
+    print("GEMINI_API_KEY not found in environment variables!")
+
+# LLM provider selection ("gemini" or "stub" for the local deterministic stand-in)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini").lower()
+# Stub provider latency distribution in seconds, e.g. "fixed:0.05", "uniform:0.02,0.08", "normal:0.05,0.01"
+LLM_STUB_LATENCY = os.getenv("LLM_STUB_LATENCY", "fixed:0")
+LLM_STUB_SEED = int(os.getenv("LLM_STUB_SEED", "0"))
+# Optional JSON file mapping prompt stage -> response (or list of responses to cycle through)
+LLM_STUB_SCRIPT = os.getenv("LLM_STUB_SCRIPT")
+
+# Data query pipeline mode: "multi_step" (separate mapping/codegen/length calls) or
+# "single_shot" (one JSON-structured call, falling back to multi_step on parse failure)
+QUERY_PIPELINE_MODE = os.getenv("QUERY_PIPELINE_MODE", "multi_step").lower()
+
+# Generated-code cache (normalized question + dataframe schema -> validated pandas expression)
+CODE_CACHE_ENABLED = os.getenv("CODE_CACHE_ENABLED", "true").lower() == "true"
+CODE_CACHE_PATH = os.getenv("CODE_CACHE_PATH", "data/code_cache.json")
+CODE_CACHE_MAX_ENTRIES = int(os.getenv("CODE_CACHE_MAX_ENTRIES", "1000"))
+CODE_CACHE_TTL_SECONDS = int(os.getenv("CODE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+CODE_CACHE_FLUSH_INTERVAL_SECONDS = float(os.getenv("CODE_CACHE_FLUSH_INTERVAL_SECONDS", "5.0"))
+
+# Local fuzzy column resolver; the mapping LLM call is only made below this confidence
+COLUMN_RESOLVER_ENABLED = os.getenv("COLUMN_RESOLVER_ENABLED", "true").lower() == "true"
+COLUMN_RESOLVER_THRESHOLD = float(os.getenv("COLUMN_RESOLVER_THRESHOLD", "0.8"))
+# Optional JSON file of extra synonyms: {"user term": "Column" or ["Column", ...]}
+COLUMN_SYNONYMS_PATH = os.getenv("COLUMN_SYNONYMS_PATH")
+
+# Local pre-classifier ahead of the LLM classification call
+LOCAL_CLASSIFIER_ENABLED = os.getenv("LOCAL_CLASSIFIER_ENABLED", "true").lower() == "true"
+# Column-match + keyword + category-value score at or above which a query is treated as DATA_ANALYSIS locally
+LOCAL_CLASSIFIER_DATA_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_DATA_THRESHOLD", "1.4"))
+# Score below which a query is treated as GENERAL_CONVERSATION locally; 0 (the default) leaves
+# everything but plain greetings to the LLM, since a question can reference data without matching any column
+LOCAL_CLASSIFIER_GENERAL_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_GENERAL_THRESHOLD", "0.0"))
+
+# Conversation storage backend: "json" (one file per session in STORAGE_DIR), "sqlite", or
+# "jsonl" (append-only per-session message logs with background compaction)
+CONVERSATION_STORAGE = os.getenv("CONVERSATION_STORAGE", "json").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data/conversations.db")
+JSONL_STORAGE_DIR = os.getenv("JSONL_STORAGE_DIR", "data/conversation_logs")
+# Number of log lines after which a session log is folded into its snapshot
+JSONL_COMPACT_AFTER = int(os.getenv("JSONL_COMPACT_AFTER", "100"))
+
+# Live session registry: how many sessions stay in memory, and how often their changes are
+# written to storage (0 writes every change immediately)
+SESSION_REGISTRY_MAX_SESSIONS = int(os.getenv("SESSION_REGISTRY_MAX_SESSIONS", "1000"))
+SESSION_FLUSH_INTERVAL_SECONDS = float(os.getenv("SESSION_FLUSH_INTERVAL_SECONDS", "2.0"))
+
+# Session expiry: live sessions idle for CONVERSATION_TIMEOUT_HOURS are released from memory by a
+# periodic worker. Stored conversations older than CONVERSATION_RETENTION_DAYS are deleted by
+# GET /cleanup, and also by the worker when CONVERSATION_AUTO_DELETE is true.
+EXPIRY_SWEEP_INTERVAL_SECONDS = float(os.getenv("EXPIRY_SWEEP_INTERVAL_SECONDS", "60"))
+CONVERSATION_RETENTION_DAYS = int(os.getenv("CONVERSATION_RETENTION_DAYS", str(CONVERSATION_TIMEOUT_HOURS // 24)))
+CONVERSATION_AUTO_DELETE = os.getenv("CONVERSATION_AUTO_DELETE", "false").lower() == "true"
+
+# Columnar cache of the spreadsheet (<file>.cache/ next to it), used instead of parsing the xlsx when fresh
+DATASET_CACHE_ENABLED = os.getenv("DATASET_CACHE_ENABLED", "true").lower() == "true"
+# How often the spreadsheet is checked for changes and hot-reloaded (0 disables the watcher)
+DATASET_RELOAD_INTERVAL_SECONDS = float(os.getenv("DATASET_RELOAD_INTERVAL_SECONDS", "5"))
+
+# Named datasets queries can select with QueryRequest.dataset: a JSON object {"name": "path"} or
+# comma-separated name=path pairs (.xlsx or .csv). Empty registers only the bundled employee data.
+DATASETS = os.getenv("DATASETS", "")
+DEFAULT_DATASET = os.getenv("DEFAULT_DATASET", "employees")
+# Memory budget for loaded datasets; least recently used ones are unloaded above it (0 = no limit)
+DATASET_MEMORY_BUDGET_MB = float(os.getenv("DATASET_MEMORY_BUDGET_MB", "1024"))
+# Query engine per dataset as name=engine pairs (or a JSON object): "pandas" (default) loads the frame
+# into memory and asks the model for a pandas expression; "sql" imports the file into a SQLite database
+# next to it (<file>.sqlite) and asks for a SELECT statement, which runs out of core
+DATASET_ENGINES = os.getenv("DATASET_ENGINES", "")
+SQL_TIMEOUT_SECONDS = float(os.getenv("SQL_TIMEOUT_SECONDS", "10"))
+SQL_MAX_RESULT_ROWS = int(os.getenv("SQL_MAX_RESULT_ROWS", "100000"))
+SQL_CACHE_MB = float(os.getenv("SQL_CACHE_MB", "64"))
+
+# Shrink dtypes at load: text with distinct values <= DATASET_CATEGORY_MAX_RATIO of its rows becomes
+# category, integers and exactly representable floats are downcast. Off by default: narrower integers
+# can overflow in arithmetic, and groupby on a category column lists groups a filter left empty.
+DATASET_COMPACT_DTYPES = os.getenv("DATASET_COMPACT_DTYPES", "false").lower() == "true"
+DATASET_CATEGORY_MAX_RATIO = float(os.getenv("DATASET_CATEGORY_MAX_RATIO", "0.5"))
+
+# Concurrent identical requests (same normalized question, data version and conversation context)
+# share one classification and one query pipeline run instead of each calling the model
+REQUEST_COALESCING_ENABLED = os.getenv("REQUEST_COALESCING_ENABLED", "true").lower() == "true"
+
+# Generated code runs in a pool of worker processes (0 evaluates in-process, without limits).
+# Each job gets a wall-clock timeout, a CPU-time limit and a memory limit on top of the worker's baseline.
+EXECUTOR_POOL_SIZE = int(os.getenv("EXECUTOR_POOL_SIZE", "2"))
+EXECUTOR_TIMEOUT_SECONDS = float(os.getenv("EXECUTOR_TIMEOUT_SECONDS", "10"))
+EXECUTOR_CPU_SECONDS = float(os.getenv("EXECUTOR_CPU_SECONDS", "10"))
+EXECUTOR_MEMORY_MB = float(os.getenv("EXECUTOR_MEMORY_MB", "1024"))
+
+# Memoized results of generated expressions per dataset version, bounded in MB (0 disables)
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "64"))
+
+# Precomputed count/sum/mean/min/max/idxmax of numeric columns, overall and grouped by every column
+# with at most AGGREGATE_CUBE_MAX_CARDINALITY values; matching expressions are answered without the frame
+AGGREGATE_CUBE_ENABLED = os.getenv("AGGREGATE_CUBE_ENABLED", "true").lower() == "true"
+AGGREGATE_CUBE_MAX_CARDINALITY = int(os.getenv("AGGREGATE_CUBE_MAX_CARDINALITY", "50"))
+# Cached rewrite plans per cube, least recently used dropped first
+AGGREGATE_CUBE_MAX_PLANS = int(os.getenv("AGGREGATE_CUBE_MAX_PLANS", "1024"))
+
+# Tables longer than RESULT_PREVIEW_ROWS are kept server-side and paged through GET /results/{id};
+# a stored result expires RESULT_STORE_TTL_SECONDS after it was last read
+RESULT_PREVIEW_ROWS = int(os.getenv("RESULT_PREVIEW_ROWS", "20"))
+RESULT_STORE_TTL_SECONDS = float(os.getenv("RESULT_STORE_TTL_SECONDS", "1800"))
+RESULT_STORE_MAX_RESULTS = int(os.getenv("RESULT_STORE_MAX_RESULTS", "500"))
+RESULT_STORE_MAX_MB = float(os.getenv("RESULT_STORE_MAX_MB", "256"))
+
+# Responses larger than this many bytes are gzip-compressed for clients that accept it (0 disables)
+RESPONSE_GZIP_MIN_BYTES = int(os.getenv("RESPONSE_GZIP_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
@@ -1,12 +1,18 @@
 from fastapi import FastAPI
 from fastapi import FastAPI, HTTPException, Request, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+import asyncio
 import logging
 import os
 from dotenv import load_dotenv
 
 from app.api.endpoints import router
-from app.services.data_service import get_dataframe
+from app.api.responses import FastJSONResponse
+from app.config import RESPONSE_GZIP_MIN_BYTES, RESPONSE_GZIP_LEVEL
+from app.services.data_service import get_dataset_context, dataset_registry, code_executor, code_cache
+from app.services.dataset_context import DatasetContext
+from app.services.conversation_service import build_conversation_indexes, shutdown_conversations
 
 # Configure logging
 logging.basicConfig(
@@ -23,7 +29,9 @@ load_dotenv()
 app = FastAPI(
     title="Data Analysis API",
     description="API for analyzing employee data using natural language queries",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson-rendered JSON for every route
+    default_response_class=FastJSONResponse
 )
 
 
@@ -36,6 +44,10 @@ app.add_middleware(
 )
 
 
+# Compress responses above the size threshold for clients that accept gzip (SSE streams are never compressed)
+if RESPONSE_GZIP_MIN_BYTES > 0:
+    app.add_middleware(GZipMiddleware, minimum_size=RESPONSE_GZIP_MIN_BYTES, compresslevel=RESPONSE_GZIP_LEVEL)
+
 # Include API routes
 app.include_router(router)
 
@@ -44,9 +56,32 @@ app.include_router(router)
 async def startup_event():
     """Initialize the app on startup"""
     logger.info("Starting Data Analysis API")
-    # Load dataframe on startup to verify it works
+    # Load the default dataset on startup to verify it works; the others load on first use
+    dataset = None
+    try:
+        dataset = get_dataset_context()
+        logger.info(f"Loaded dataframe with shape {dataset.shape} (data version {dataset.version})")
+    except Exception as e:
+        logger.error(f"Error loading dataframe: {str(e)}")
+    
+    # Start the code execution workers with the default dataset already loaded (unless it is queried with SQL)
+    code_executor.start(preload=dataset if isinstance(dataset, DatasetContext) else None)
+    
+    # Watch the loaded datasets' files and hot-reload them when they change
+    dataset_registry.start()
+    
+    # Build the conversation indexes now, in a thread, rather than on the event loop at the first request
     try:
-        df = get_dataframe()
-        logger.info(f"Loaded dataframe with shape {df.shape}")
+        await asyncio.get_running_loop().run_in_executor(None, build_conversation_indexes)
     except Exception as e:
-        logger.error(f"Error loading dataframe: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error building conversation indexes: {str(e)}")
+
+# Shutdown event
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background workers and write out pending conversation changes before exiting"""
+    dataset_registry.close()
+    code_executor.close()
+    code_cache.close()
+    shutdown_conversations()
+    logger.info("Flushed conversations on shutdown")
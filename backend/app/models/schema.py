@@ -5,12 +5,18 @@ from typing import Dict, List, Optional, Any, Union, Literal
 class QueryRequest(BaseModel):
     query: str = Field(..., description="The natural language query to process")
     session_id: Optional[str] = Field("default", description="Session identifier for conversation tracking")
+    dataset: Optional[str] = Field(None, description="Name of the dataset to query (the default dataset if omitted)")
 
 
 class QueryResponse(BaseModel):
     answer: str
     source: Literal["conversation", "dataframe", "error"]
     session_id: str
+    # Version of the dataset snapshot a data answer was computed from
+    data_version: Optional[int] = None
+    # Handle of a table result too large to inline, paged through GET /results/{result_id}
+    result_id: Optional[str] = None
+    result_rows: Optional[int] = None
     debug: Optional[Dict[str, Any]] = None
 
 
@@ -33,14 +39,49 @@ class SessionHistoryItem(BaseModel):
     title: str
     createdAt: str
     updatedAt: str
+    messageCount: int = 0
+    tags: List[str] = Field(default_factory=list)
 
 
 class SessionHistoryResponse(BaseModel):
     history: List[SessionHistoryItem]
+    nextCursor: Optional[str] = None
+    total: Optional[int] = None
+
+
+class SessionSearchResult(BaseModel):
+    sessionId: str
+    title: str
+    score: float
+    titleMatch: bool = False
+    messageIndexes: List[int] = Field(default_factory=list)
+    updatedAt: Optional[str] = None
+    messageCount: int = 0
+
+
+class SessionSearchResponse(BaseModel):
+    results: List[SessionSearchResult]
+    total: int
+
+
+class ResultPage(BaseModel):
+    resultId: str
+    offset: int
+    limit: int
+    total: int
+    rows: List[Dict[str, Any]]
+    nextOffset: Optional[int] = None
 
 
 class SessionResponse(BaseModel):
     id: str
     messages: List[Message]
     createdAt: str
-    updatedAt: str
\ No newline at end of file
+    updatedAt: str
+
+# Structured LLM output for the single-shot data query pipeline
+
+class QueryPlan(BaseModel):
+    column_mapping: Dict[str, str] = Field(default_factory=dict)
+    code: str = Field(..., min_length=1)
+    response_length: Literal["BRIEF", "MEDIUM", "DETAILED"] = "BRIEF"
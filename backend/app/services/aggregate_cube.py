@@ -0,0 +1,247 @@
+# app/services/aggregate_cube.py
+import ast
+import logging
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from app.services.expression_compiler import SAFE_BUILTINS
+
+logger = logging.getLogger(__name__)
+
+# Aggregations precomputed per (group column, numeric column); argmax is pandas' idxmax
+CUBE_AGGREGATIONS = ("count", "sum", "mean", "min", "max", "idxmax")
+
+# Key of a precomputed value: (group column or None for the whole frame, column, aggregation)
+CubeKey = Tuple[Optional[str], Optional[str], str]
+
+
+def _constant_string(node: ast.AST) -> Optional[str]:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def _is_df(node: ast.AST) -> bool:
+    return isinstance(node, ast.Name) and node.id == "df"
+
+
+def _aggregation_call(node: ast.AST) -> Optional[Tuple[ast.AST, str]]:
+    """(receiver, aggregation) for `<receiver>.mean()` or `<receiver>.agg('mean')`"""
+    if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute) or node.keywords:
+        return None
+    method = node.func.attr
+    if method in CUBE_AGGREGATIONS and not node.args:
+        return node.func.value, method
+    if method in ("agg", "aggregate") and len(node.args) == 1:
+        aggregation = _constant_string(node.args[0])
+        if aggregation in CUBE_AGGREGATIONS:
+            return node.func.value, aggregation
+    return None
+
+
+def _groupby_column(node: ast.AST) -> Optional[str]:
+    """Column of `df.groupby('<column>')`"""
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "groupby"
+            and _is_df(node.func.value) and len(node.args) == 1 and not node.keywords):
+        return _constant_string(node.args[0])
+    return None
+
+
+def match_cube_key(node: ast.AST) -> Optional[CubeKey]:
+    """Cube key of an expression node the cube can answer, if any
+
+    Recognized: df.groupby('G')['C'].<agg>(), df.groupby('G')['C'].agg('<agg>'), df['C'].<agg>(),
+    df.groupby('G').size() and df['G'].value_counts().
+    """
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and not node.args and not node.keywords:
+        if node.func.attr == "size":
+            group = _groupby_column(node.func.value)
+            if group is not None:
+                return group, None, "size"
+        if (node.func.attr == "value_counts" and isinstance(node.func.value, ast.Subscript)
+                and _is_df(node.func.value.value)):
+            column = _constant_string(node.func.value.slice)
+            if column is not None:
+                return None, column, "value_counts"
+
+    matched = _aggregation_call(node)
+    if matched is None:
+        return None
+    receiver, aggregation = matched
+    if not isinstance(receiver, ast.Subscript):
+        return None
+    column = _constant_string(receiver.slice)
+    if column is None:
+        return None
+    if _is_df(receiver.value):
+        return None, column, aggregation
+    group = _groupby_column(receiver.value)
+    if group is not None:
+        return group, column, aggregation
+    return None
+
+
+class _CubeRewriter(ast.NodeTransformer):
+    """Replaces every cube-answerable subexpression with a name bound to the precomputed value"""
+
+    def __init__(self, values: Dict[CubeKey, Any]):
+        self.values = values
+        self.bindings: Dict[str, CubeKey] = {}
+
+    def visit(self, node: ast.AST) -> ast.AST:
+        key = match_cube_key(node)
+        if key is not None and key in self.values:
+            name = f"cube_value_{len(self.bindings)}"
+            self.bindings[name] = key
+            return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        return super().visit(node)
+
+
+def _group_columns(df: pd.DataFrame, max_cardinality: int) -> List[str]:
+    columns = []
+    for column in df.columns:
+        if not isinstance(column, str) or df[column].dtype.kind == "f":
+            continue
+        if df[column].nunique(dropna=True) <= max_cardinality:
+            columns.append(column)
+    return columns
+
+
+def build_cube_values(df: pd.DataFrame, max_cardinality: int = 50) -> Dict[CubeKey, Any]:
+    """Precompute count/sum/mean/min/max/idxmax of every numeric column, overall and grouped by
+    every low-cardinality column, with the same pandas calls generated code would make"""
+    values: Dict[CubeKey, Any] = {}
+    numeric = [column for column in df.select_dtypes(include="number").columns if isinstance(column, str)]
+    groups = _group_columns(df, max_cardinality)
+
+    for column in numeric:
+        for aggregation in CUBE_AGGREGATIONS:
+            try:
+                values[(None, column, aggregation)] = getattr(df[column], aggregation)()
+            except (TypeError, ValueError):
+                continue
+    for group in groups:
+        values[(None, group, "value_counts")] = df[group].value_counts()
+        with warnings.catch_warnings():
+            # Category columns warn about the observed=False default; generated code uses the same default
+            warnings.simplefilter("ignore", FutureWarning)
+            grouped = df.groupby(group)
+        values[(group, None, "size")] = grouped.size()
+        for column in numeric:
+            if column == group:
+                continue
+            for aggregation in CUBE_AGGREGATIONS:
+                try:
+                    values[(group, column, aggregation)] = getattr(grouped[column], aggregation)()
+                except (TypeError, ValueError):
+                    continue
+    return values
+
+
+class AggregateCube:
+    """Precomputed aggregates of one dataset version, and evaluation of expressions against them
+
+    An expression is answerable when every reference to `df` sits inside a recognized aggregation;
+    those are replaced with their precomputed (small) results and the rest of the expression, such
+    as `.sort_values().head(3)` or `.idxmax()`, runs on them without touching the frame.
+    """
+
+    def __init__(self, dataset_name: str, version: int, values: Dict[CubeKey, Any], max_plans: int = 1024):
+        self.dataset_name = dataset_name
+        self.version = version
+        self.values = values
+        self.max_plans = max_plans
+        # LRU of source -> (rewritten code, name -> cube key), or None when the cube can't answer it
+        self._plans: "OrderedDict[str, Optional[Tuple[Any, Dict[str, CubeKey]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def evaluate(self, code: str) -> Tuple[bool, Any]:
+        """(True, result) if the cube answers code, else (False, None)"""
+        with self._lock:
+            if code in self._plans:
+                self._plans.move_to_end(code)
+                plan = self._plans[code]
+            else:
+                plan = self._plans[code] = self._plan(code)
+                while len(self._plans) > self.max_plans:
+                    self._plans.popitem(last=False)
+        if plan is None:
+            return False, None
+        compiled, bindings = plan
+        scope = {"pd": pd, "__builtins__": SAFE_BUILTINS}
+        for name, key in bindings.items():
+            value = self.values[key]
+            # Copies, so chained calls (e.g. inplace sorts) never modify the cube
+            scope[name] = value.copy() if isinstance(value, (pd.Series, pd.DataFrame)) else value
+        return True, eval(compiled, scope)
+
+    def _plan(self, code: str) -> Optional[Tuple[Any, Dict[str, CubeKey]]]:
+        try:
+            tree = ast.parse(code.strip(), mode="eval")
+        except SyntaxError:
+            return None
+        rewriter = _CubeRewriter(self.values)
+        tree = ast.fix_missing_locations(rewriter.visit(tree))
+        if not rewriter.bindings or any(_is_df(node) for node in ast.walk(tree)):
+            return None
+        return compile(tree, "<cube>", "eval"), rewriter.bindings
+
+
+class AggregateCubeStore:
+    """Aggregate cube of the current version of each dataset, rebuilt when a new version is published"""
+
+    def __init__(self, max_cardinality: int = 50, max_plans: int = 1024):
+        self.max_cardinality = max_cardinality
+        self.max_plans = max_plans
+        self._cubes: Dict[str, AggregateCube] = {}
+        self._lock = threading.Lock()
+        self.stats = {"builds": 0, "last_build_ms": 0.0, "hits": 0, "misses": 0, "errors": 0}
+
+    def rebuild(self, context) -> AggregateCube:
+        """Build the cube of a dataset snapshot (registered as a dataset listener)"""
+        start = time.perf_counter()
+        cube = AggregateCube(context.name, context.version, build_cube_values(context.df, self.max_cardinality),
+                             max_plans=self.max_plans)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            current = self._cubes.get(context.name)
+            if current is None or current.version <= context.version:
+                self._cubes[context.name] = cube
+            self.stats["builds"] += 1
+            self.stats["last_build_ms"] = round(elapsed_ms, 3)
+        logger.info(f"Built aggregate cube for {context.name!r} v{context.version} with {len(cube.values)} "
+                    f"values in {elapsed_ms:.1f} ms")
+        return cube
+
+    def evaluate(self, context, code: str) -> Tuple[bool, Any]:
+        """Answer code from the cube of this exact dataset version; (False, None) if it can't"""
+        with self._lock:
+            cube = self._cubes.get(context.name)
+        if cube is None or cube.version != context.version:
+            with self._lock:
+                self.stats["misses"] += 1
+            return False, None
+        try:
+            answered, result = cube.evaluate(code)
+        except Exception as e:
+            # Let the regular path run (and report) the expression
+            logger.warning(f"Error answering {code!r} from the aggregate cube: {e}")
+            answered, result = False, None
+            with self._lock:
+                self.stats["errors"] += 1
+        with self._lock:
+            self.stats["hits" if answered else "misses"] += 1
+        return answered, result
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                "cubes": {name: {"version": cube.version, "values": len(cube.values), "plans": len(cube._plans)}
+                          for name, cube in self._cubes.items()},
+            }
@@ -1,54 +1,111 @@
-import google.generativeai as genai
 import asyncio
 import logging
 import re
-from app.config import UNSAFE_CODE_PATTERNS
-from app.services.data_service import get_dataframe
+from app.config import (
+    LOCAL_CLASSIFIER_ENABLED, LOCAL_CLASSIFIER_DATA_THRESHOLD, LOCAL_CLASSIFIER_GENERAL_THRESHOLD,
+    REQUEST_COALESCING_ENABLED
+)
+from app.services.data_service import (
+    get_dataset_context, column_resolver, looks_like_follow_up, coalescing_key, run_coalesced
+)
+from app.services.llm_provider import (
+    get_llm_provider, STAGE_CLASSIFY, STAGE_LENGTH, STAGE_CONVERSATION
+)
+from app.services.query_classifier import LocalQueryClassifier
+from app.services.single_flight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+local_classifier = LocalQueryClassifier(
+    column_resolver,
+    data_threshold=LOCAL_CLASSIFIER_DATA_THRESHOLD,
+    general_threshold=LOCAL_CLASSIFIER_GENERAL_THRESHOLD,
+)
+
+# In-flight classifications shared by concurrent identical requests
+classify_flights = SingleFlight("classify")
+
 class AiModelService:
-    """Service for interacting with the Gemini AI model"""
+    """Service for interacting with the configured LLM provider (Gemini by default)"""
     
-    def __init__(self, model_name='gemini-1.5-flash'):
+    def __init__(self, model_name='gemini-1.5-flash', provider=None):
         self.model_name = model_name
-        print("Using model",model_name)
+        self.provider = provider or get_llm_provider()
         
-    async def generate_content(self, prompt):
-        """Async wrapper around the synchronous Gemini API"""
+    async def generate_content(self, prompt, stage=None, generation_config=None):
+        """Async wrapper around the synchronous provider API"""
         loop = asyncio.get_event_loop()
-        model = genai.GenerativeModel(self.model_name)
-        
         
         try:
             # Run in a thread pool to not block the event loop
-            response = await loop.run_in_executor(
-                None, lambda: model.generate_content(prompt)
+            response_text = await loop.run_in_executor(
+                None, lambda: self.provider.generate(prompt, self.model_name, stage, generation_config)
             )
-            return response.text.strip()
+            return response_text.strip()
         except Exception as e:
             logger.error(f"Error generating content with {self.model_name}: {str(e)}")
             raise
+    
+    async def stream_content(self, prompt, stage=None, generation_config=None):
+        """Async generator over response chunks from the provider's streaming API"""
+        loop = asyncio.get_event_loop()
+        chunks = iter(self.provider.stream(prompt, self.model_name, stage, generation_config))
+        done = object()
+        
+        try:
+            while True:
+                # Each blocking next() runs in the thread pool so the event loop stays free
+                chunk = await loop.run_in_executor(None, next, chunks, done)
+                if chunk is done:
+                    break
+                if chunk:
+                    yield chunk
+        except Exception as e:
+            logger.error(f"Error streaming content with {self.model_name}: {str(e)}")
+            raise
 
-async def classify_query_type(question: str, conversation_manager=None):
+async def classify_query_type(question: str, conversation_manager=None, debug_info=None, dataset_name=None):
+    """Classify a question as DATA_ANALYSIS or GENERAL_CONVERSATION; concurrent identical requests share one run"""
+    if not REQUEST_COALESCING_ENABLED:
+        return await _classify_query_type(question, conversation_manager, debug_info, dataset_name)
     try:
-        df = get_dataframe()
+        key = coalescing_key(question, conversation_manager, dataset_name)
+    except Exception as e:
+        logger.error(f"Error in query classification: {str(e)}")
+        return "GENERAL_CONVERSATION"
+    return await run_coalesced(
+        classify_flights, key,
+        lambda shared_debug: _classify_query_type(question, conversation_manager, shared_debug, dataset_name),
+        debug_info
+    )
+
+async def _classify_query_type(question: str, conversation_manager=None, debug_info=None, dataset_name=None):
+    try:
+        dataset = get_dataset_context(dataset_name)
+        
+        # Decide obvious cases (greetings, clear data questions, follow-ups) without a model call
+        if LOCAL_CLASSIFIER_ENABLED:
+            has_last_result = bool(conversation_manager and conversation_manager.get_context().get("last_result") is not None)
+            local_type, details = local_classifier.classify(
+                question, dataset, has_last_result=has_last_result, is_follow_up=looks_like_follow_up(question)
+            )
+            if debug_info is not None:
+                debug_info["classification"] = details
+            if local_type is not None:
+                logger.info(f"Classified locally as {local_type} ({details['reason']})")
+                return local_type
+        
         ai_service = AiModelService()
         
         context_text = ""
         if conversation_manager:
             context_text = conversation_manager.get_conversation_text(limit=3)
         
-        # DataFrame info
-        df_columns = list(df.columns)
-        
         prompt = f"""
         Task: Classify the user's query as either DATA_ANALYSIS or GENERAL_CONVERSATION.
         
         Available data in the system:
-        - DataFrame with columns: {df_columns}
-        - Sample data (first 2 rows):
-        {df.head(2).to_string()}
+        {dataset.classify_schema}
         
         Previous conversation context:
         {context_text}
@@ -84,7 +141,7 @@ async def classify_query_type(question: str, conversation_manager=None):
         Respond with ONLY one of these exact strings: "DATA_ANALYSIS" or "GENERAL_CONVERSATION"
         """
         
-        query_type = await ai_service.generate_content(prompt)
+        query_type = await ai_service.generate_content(prompt, stage=STAGE_CLASSIFY)
         
         # Make sure we get one of the expected responses
         if query_type not in ["DATA_ANALYSIS", "GENERAL_CONVERSATION"]:
@@ -97,110 +154,156 @@ async def classify_query_type(question: str, conversation_manager=None):
         logger.error(f"Error in query classification: {str(e)}")
         return "GENERAL_CONVERSATION"
 
+async def prepare_general_conversation(ai_service, question: str, conversation_manager=None):
+    """Pick a response length and build the conversation prompt
+    
+    Returns (prompt, response_length, generation_config).
+    """
+    context_text = ""
+    if conversation_manager:
+        context_text = conversation_manager.get_conversation_text(limit=3)
+    
+    # Determine appropriate response length first
+    length_analysis_prompt = f"""
+    Analyze this conversational query: "{question}"
+    
+    Determine if this query requires:
+    1. A brief, direct response (1-2 sentences)
+    2. A medium-length response (3-5 sentences)
+    3. A detailed, comprehensive response (multiple paragraphs)
+    
+    Return ONLY one of these options without explanation: "BRIEF", "MEDIUM", or "DETAILED"
+    """
+    
+    response_length = await ai_service.generate_content(length_analysis_prompt, stage=STAGE_LENGTH)
+    response_length = response_length.strip().upper()
+    
+    # Default to BRIEF for conversation if the response isn't one of the expected values
+    if response_length not in ["BRIEF", "MEDIUM", "DETAILED"]:
+        response_length = "BRIEF"
+        
+    logger.info(f"Determined conversation response length: {response_length}")
+    
+    # Set length parameters based on analysis
+    if response_length == "BRIEF":
+        length_instruction = "Provide a brief, concise response of 1-2 sentences only. Maximum 50 words."
+        max_tokens = 75
+    elif response_length == "MEDIUM":
+        length_instruction = "Provide a moderately detailed response of 3-5 sentences only. Maximum 100 words."
+        max_tokens = 150
+    else:  # DETAILED
+        length_instruction = "Provide a comprehensive, detailed response with thorough information. Maximum 250 words."
+        max_tokens = 300
+    
+    # Create a more structured prompt that enforces a single response
+    prompt = f"""
+    You are an AI assistant for a data analysis application responding to a general query.
+    
+    Previous conversation context:
+    {context_text}
+    
+    User query: "{question}"
+    
+    IMPORTANT INSTRUCTIONS:
+    1. Response length: {length_instruction}
+    2. Format: Provide ONLY ONE natural conversational response with no labels or prefixes
+    3. DO NOT output multiple versions of your response
+    4. DO NOT prefix your response with "BRIEF:", "MEDIUM:", or "DETAILED:"
+    5. DO NOT mention anything about response length or formatting in your answer
+    6. Answer conversationally as if you're having a normal discussion
+    7. Only mention the data if specifically asked about it
+
+    Guidelines:
+    - Keep responses concise and to the point
+    - Avoid overly technical language or jargon
+    - Provide a human-like, engaging response
+    
+    
+    Your response:
+    """
+    
+    generation_config = {
+        "max_output_tokens": max_tokens,
+        "temperature": 0.7,  
+        "top_p": 0.95,
+        "top_k": 40
+    }
+    return prompt, response_length, generation_config
+
+def clean_conversation_response(response_text: str, response_length: str) -> str:
+    """Strip length labels and duplicate sections the model sometimes adds"""
+    # Additional post-processing to ensure no labels remain
+    response_text = re.sub(r'^\s*(BRIEF|MEDIUM|DETAILED):\s*', '', response_text, flags=re.IGNORECASE)
+    
+    # Check if the response still contains multiple sections and take only the appropriate one
+    if "BRIEF:" in response_text or "MEDIUM:" in response_text or "DETAILED:" in response_text:
+        # If model still generated multiple sections, extract only the appropriate one
+        pattern = rf"({response_length}:.*?)(?:BRIEF:|MEDIUM:|DETAILED:|$)"
+        match = re.search(pattern, response_text, re.IGNORECASE | re.DOTALL)
+        if match:
+            section = match.group(1)
+            # Remove the label
+            response_text = re.sub(r'^\s*(BRIEF|MEDIUM|DETAILED):\s*', '', section, flags=re.IGNORECASE).strip()
+        else:
+            # If we can't find the right section, take the first paragraph as a fallback
+            response_text = response_text.split('\n\n')[0]
+    
+    return response_text
+
+# A length label the model put at the start of its answer, and one starting a further section
+LEADING_LABEL_PATTERN = re.compile(r'^\s*(BRIEF|MEDIUM|DETAILED):\s*', re.IGNORECASE)
+SECTION_LABEL_PATTERN = re.compile(r'(BRIEF|MEDIUM|DETAILED):')
+# Streamed text this close to the end is held back until it can no longer turn into a label
+LABEL_HOLDBACK = len("DETAILED:")
+
+def _streamable_conversation_text(raw: str, finished: bool) -> str:
+    """The cleaned answer as far as it is known from the text streamed so far"""
+    text = raw.lstrip()
+    if not finished and len(text) < LABEL_HOLDBACK:
+        return ""
+    text = LEADING_LABEL_PATTERN.sub('', text, count=1)
+    match = SECTION_LABEL_PATTERN.search(text)
+    if match:
+        return text[:match.start()].rstrip()
+    if not finished:
+        text = text[:len(text) - LABEL_HOLDBACK]
+    return text.rstrip()
+
+async def stream_conversation_response(chunks):
+    """Clean a streamed conversation answer as it arrives, yielding the cleaned text in pieces
+
+    Like clean_conversation_response, a leading length label is dropped; when the model writes
+    several labelled sections the stream keeps the first one, since later text can't be unsent.
+    The joined pieces are the answer to store.
+    """
+    raw = ""
+    emitted = ""
+    async for chunk in chunks:
+        raw += chunk
+        text = _streamable_conversation_text(raw, finished=False)
+        if len(text) > len(emitted):
+            yield text[len(emitted):]
+            emitted = text
+    text = _streamable_conversation_text(raw, finished=True)
+    if len(text) > len(emitted):
+        yield text[len(emitted):]
+
 async def handle_general_conversation(question: str, conversation_manager=None):
     """Handle general conversation queries with direct answers"""
     try:
         ai_service = AiModelService()
-        
-        context_text = ""
-        if conversation_manager:
-            context_text = conversation_manager.get_conversation_text(limit=3)
-        
-        # Determine appropriate response length first
-        length_analysis_prompt = f"""
-        Analyze this conversational query: "{question}"
-        
-        Determine if this query requires:
-        1. A brief, direct response (1-2 sentences)
-        2. A medium-length response (3-5 sentences)
-        3. A detailed, comprehensive response (multiple paragraphs)
-        
-        Return ONLY one of these options without explanation: "BRIEF", "MEDIUM", or "DETAILED"
-        """
-        
-        response_length = await ai_service.generate_content(length_analysis_prompt)
-        response_length = response_length.strip().upper()
-        
-        # Default to BRIEF for conversation if the response isn't one of the expected values
-        if response_length not in ["BRIEF", "MEDIUM", "DETAILED"]:
-            response_length = "BRIEF"
-            
-        logger.info(f"Determined conversation response length: {response_length}")
-        
-        # Set length parameters based on analysis
-        if response_length == "BRIEF":
-            length_instruction = "Provide a brief, concise response of 1-2 sentences only. Maximum 50 words."
-            max_tokens = 75
-        elif response_length == "MEDIUM":
-            length_instruction = "Provide a moderately detailed response of 3-5 sentences only. Maximum 100 words."
-            max_tokens = 150
-        else:  # DETAILED
-            length_instruction = "Provide a comprehensive, detailed response with thorough information. Maximum 250 words."
-            max_tokens = 300
-        
-        # Create a more structured prompt that enforces a single response
-        prompt = f"""
-        You are an AI assistant for a data analysis application responding to a general query.
-        
-        Previous conversation context:
-        {context_text}
-        
-        User query: "{question}"
-        
-        IMPORTANT INSTRUCTIONS:
-        1. Response length: {length_instruction}
-        2. Format: Provide ONLY ONE natural conversational response with no labels or prefixes
-        3. DO NOT output multiple versions of your response
-        4. DO NOT prefix your response with "BRIEF:", "MEDIUM:", or "DETAILED:"
-        5. DO NOT mention anything about response length or formatting in your answer
-        6. Answer conversationally as if you're having a normal discussion
-        7. Only mention the data if specifically asked about it
-
-        Guidelines:
-        - Keep responses concise and to the point
-        - Avoid overly technical language or jargon
-        - Provide a human-like, engaging response
-        
-        
-        Your response:
-        """
-        
-        # Use Gemini's generation config to enforce token limits
-        model = genai.GenerativeModel(
-            model_name=ai_service.model_name,
-            generation_config={
-                "max_output_tokens": max_tokens,
-                "temperature": 0.7,  
-                "top_p": 0.95,
-                "top_k": 40
-            }
+        prompt, response_length, generation_config = await prepare_general_conversation(
+            ai_service, question, conversation_manager
         )
         
-        # Run in a thread pool to not block the event loop
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None, lambda: model.generate_content(prompt)
+        # Use the generation config to enforce token limits
+        response_text = await ai_service.generate_content(
+            prompt,
+            stage=STAGE_CONVERSATION,
+            generation_config=generation_config
         )
         
-        response_text = response.text.strip()
-        
-        # Additional post-processing to ensure no labels remain
-        response_text = re.sub(r'^\s*(BRIEF|MEDIUM|DETAILED):\s*', '', response_text, flags=re.IGNORECASE)
-        
-        # Check if the response still contains multiple sections and take only the appropriate one
-        if "BRIEF:" in response_text or "MEDIUM:" in response_text or "DETAILED:" in response_text:
-            # If model still generated multiple sections, extract only the appropriate one
-            pattern = rf"({response_length}:.*?)(?:BRIEF:|MEDIUM:|DETAILED:|$)"
-            match = re.search(pattern, response_text, re.IGNORECASE | re.DOTALL)
-            if match:
-                section = match.group(1)
-                # Remove the label
-                response_text = re.sub(r'^\s*(BRIEF|MEDIUM|DETAILED):\s*', '', section, flags=re.IGNORECASE).strip()
-            else:
-                # If we can't find the right section, take the first paragraph as a fallback
-                response_text = response_text.split('\n\n')[0]
-        
-        return response_text
+        return clean_conversation_response(response_text, response_length)
         
     except Exception as e:
         logger.error(f"Error in conversation handling: {str(e)}")
@@ -0,0 +1,197 @@
+# app/services/code_cache.py
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_TRAILING_PUNCTUATION_PATTERN = re.compile(r"[\s?!.,;:]+$")
+
+
+def normalize_question(question: str) -> str:
+    """Fold case, whitespace and trailing sentence punctuation so equivalent questions share a cache key
+
+    Everything else is kept: "salary > 50000" and "salary < 50000" must not share generated code.
+    """
+    text = _WHITESPACE_PATTERN.sub(" ", question.lower()).strip()
+    return _TRAILING_PUNCTUATION_PATTERN.sub("", text)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase words of a text with punctuation and whitespace folded to single spaces"""
+    text = _PUNCTUATION_PATTERN.sub(" ", text.lower())
+    return _WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+def schema_fingerprint(df: pd.DataFrame) -> str:
+    """Fingerprint of a dataframe's shape, column names and dtypes"""
+    schema = [df.shape[0], [[str(col), str(dtype)] for col, dtype in df.dtypes.items()]]
+    return hashlib.sha1(json.dumps(schema).encode("utf-8")).hexdigest()[:16]
+
+
+class GeneratedCodeCache:
+    """LRU/TTL cache of validated pandas expressions, optionally backed by a JSON file
+
+    Entries are keyed by schema fingerprint. Each dataset's entries are dropped when that dataset's
+    fingerprint changes; other datasets' entries are left alone. Changes only mark the cache dirty;
+    a background thread writes the file every `flush_interval` seconds, and `close()` writes it at
+    shutdown, so lookups and puts on the event loop never wait for disk.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 1000, ttl_seconds: float = 86400,
+                 flush_interval: float = 5.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.flush_interval = flush_interval
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Serializes file writes, which run outside _lock
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        # Dataset name -> the schema fingerprint its entries were last used with
+        self._fingerprints: Dict[str, str] = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "flushes": 0}
+        self._load()
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        if path and flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="code-cache-flusher", daemon=True)
+            self._flusher.start()
+
+    @staticmethod
+    def make_key(question: str, fingerprint: str) -> str:
+        return f"{fingerprint}:{normalize_question(question)}"
+
+    def get(self, question: str, fingerprint: str, dataset_name: str = "default") -> Optional[Dict[str, Any]]:
+        """Look up a cached entry, counting the hit or miss"""
+        key = self.make_key(question, fingerprint)
+        with self._lock:
+            self._check_fingerprint(dataset_name, fingerprint)
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return dict(entry)
+
+    def put(self, question: str, fingerprint: str, code: str, response_length: Optional[str] = None,
+            dataset_name: str = "default") -> None:
+        """Store a validated expression; the file is written by the next flush"""
+        key = self.make_key(question, fingerprint)
+        with self._lock:
+            self._check_fingerprint(dataset_name, fingerprint)
+            self._entries[key] = {
+                "code": code,
+                "response_length": response_length,
+                "fingerprint": fingerprint,
+                "dataset": dataset_name,
+                "created_at": time.time(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            self._save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._save()
+
+    def flush(self) -> bool:
+        """Write the cache file if anything changed since the last write; returns whether it wrote"""
+        with self._write_lock:
+            with self._lock:
+                if not self.path or not self._dirty:
+                    return False
+                entries = list(self._entries.items())
+                self._dirty = False
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump({"entries": entries}, f)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.error(f"Error saving code cache {self.path}: {e}")
+                with self._lock:
+                    self._dirty = True
+                return False
+            with self._lock:
+                self.stats["flushes"] += 1
+            return True
+
+    def close(self) -> None:
+        """Stop the flusher thread and write out pending changes"""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _check_fingerprint(self, dataset_name: str, fingerprint: str) -> None:
+        """Drop a dataset's entries generated for a different shape/schema of it"""
+        if self._fingerprints.get(dataset_name) == fingerprint:
+            return
+        stale = [
+            key for key, entry in self._entries.items()
+            if entry.get("dataset", "default") == dataset_name and entry.get("fingerprint") != fingerprint
+        ]
+        for key in stale:
+            del self._entries[key]
+        if stale:
+            self.stats["invalidations"] += len(stale)
+            logger.info(f"Invalidated {len(stale)} cached code entries after {dataset_name!r} changed")
+            self._save()
+        self._fingerprints[dataset_name] = fingerprint
+
+    def _is_expired(self, entry: Dict[str, Any]) -> bool:
+        return self.ttl_seconds > 0 and time.time() - entry.get("created_at", 0) > self.ttl_seconds
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            for key, entry in data.get("entries", []):
+                if not self._is_expired(entry):
+                    self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            logger.info(f"Loaded {len(self._entries)} cached code entries from {self.path}")
+        except Exception as e:
+            logger.error(f"Error loading code cache {self.path}: {e}")
+
+    def _save(self) -> None:
+        """Mark the cache for the next flush; called with _lock held"""
+        if self.path:
+            self._dirty = True
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
@@ -0,0 +1,342 @@
+# app/services/code_executor.py
+import asyncio
+import logging
+import multiprocessing
+import pickle
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+
+from app.services.expression_compiler import ExpressionCompiler, SAFE_BUILTINS
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; workers then run without CPU/memory limits
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionError(Exception):
+    """Raised when generated code fails in (or kills) its worker process"""
+
+
+class ExecutionTimeoutError(ExecutionError):
+    """Raised when generated code runs past the wall-clock timeout; its worker is killed"""
+
+
+class _CpuLimitExceeded(Exception):
+    pass
+
+
+# Validated code objects by source text; each worker process keeps its own
+expression_compiler = ExpressionCompiler()
+
+
+def evaluate_expression(code: str, df: pd.DataFrame) -> Any:
+    """Evaluate a whitelisted pandas expression with only `df`, `pd` and safe builtins in scope
+
+    The expression sees a shallow copy, so adding, removing or renaming columns can't reach the
+    shared frame even if the whitelist misses a mutating call.
+    """
+    compiled = expression_compiler.compile(code, df.columns)
+    return eval(compiled, {"df": df.copy(deep=False), "pd": pd, "__builtins__": SAFE_BUILTINS})
+
+
+def _on_cpu_limit(signum, frame):
+    raise _CpuLimitExceeded()
+
+
+def _set_limits(cpu_seconds: float, memory_bytes: int) -> None:
+    """Limit the CPU time and address space the next job may add on top of what the worker uses now"""
+    if resource is None:
+        return
+    if cpu_seconds > 0:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = usage.ru_utime + usage.ru_stime
+        resource.setrlimit(resource.RLIMIT_CPU, (int(used + cpu_seconds) + 1, resource.RLIM_INFINITY))
+    if memory_bytes > 0:
+        try:
+            with open("/proc/self/statm") as f:
+                baseline = int(f.read().split()[0]) * resource.getpagesize()
+        except (OSError, ValueError):
+            baseline = 0
+        resource.setrlimit(resource.RLIMIT_AS, (baseline + memory_bytes, resource.RLIM_INFINITY))
+
+
+def _clear_limits() -> None:
+    if resource is None:
+        return
+    resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+    resource.setrlimit(resource.RLIMIT_AS, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+
+
+def _worker_main(conn) -> None:
+    """Worker loop: keeps the latest version of each dataset it was sent and evaluates jobs against it"""
+    if hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    # Ctrl+C goes to the whole process group; let the parent decide when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    datasets: Dict[str, Tuple[int, pd.DataFrame]] = {}
+    while True:
+        try:
+            message = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError):
+            return
+        kind = message[0]
+        if kind == "stop":
+            return
+        if kind == "load":
+            _, name, version, payload = message
+            datasets[name] = (version, pickle.loads(payload))
+            conn.send_bytes(pickle.dumps(("loaded", version)))
+            continue
+        if kind == "unload":
+            # No reply: sent between jobs, so the parent isn't waiting on this worker
+            datasets.pop(message[1], None)
+            continue
+
+        _, name, version, code, cpu_seconds, memory_bytes = message
+        entry = datasets.get(name)
+        if entry is None or entry[0] != version:
+            reply = ("error", f"Dataset {name!r} version {version} is not loaded in the worker")
+        else:
+            try:
+                _set_limits(cpu_seconds, memory_bytes)
+                reply = ("ok", evaluate_expression(code, entry[1]))
+            except _CpuLimitExceeded:
+                reply = ("cpu_limit", f"CPU time limit of {cpu_seconds}s exceeded")
+            except MemoryError:
+                reply = ("memory_limit", "Memory limit exceeded")
+            except Exception as e:
+                reply = ("error", str(e))
+            finally:
+                _clear_limits()
+        try:
+            data = pickle.dumps(reply, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            data = pickle.dumps(("error", f"Result could not be returned: {e}"))
+        conn.send_bytes(data)
+
+
+class _Worker:
+    def __init__(self, mp_context, index: int):
+        self.conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(target=_worker_main, args=(child_conn,), name=f"code-worker-{index}",
+                                          daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.index = index
+        # Dataset name -> version this worker holds
+        self.datasets: Dict[str, int] = {}
+
+    def send(self, message: tuple) -> None:
+        self.conn.send_bytes(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[tuple]:
+        """Next reply, or None if none arrived within timeout seconds"""
+        if timeout is not None and not self.conn.poll(timeout):
+            return None
+        return pickle.loads(self.conn.recv_bytes())
+
+    def kill(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=1)
+        self.conn.close()
+
+
+class CodeExecutor:
+    """Runs generated pandas expressions in a pool of worker processes
+
+    Each worker keeps the dataset snapshots it has been sent, so a frame is pickled once per
+    version and transferred once per worker; `unload(name)` releases those copies when the dataset
+    leaves memory (idle workers at once, busy ones when their job finishes). A job runs under a CPU-time limit and an address-space
+    limit on top of the worker's current usage (Unix only), and the caller waits at most
+    `timeout_seconds`; a worker that runs over is killed and replaced. With pool_size=0 expressions
+    are evaluated in a thread of this process instead, without limits.
+    """
+
+    def __init__(self, pool_size: int = 2, timeout_seconds: float = 10.0, cpu_seconds: float = 10.0,
+                 memory_mb: float = 1024, start_method: str = "spawn"):
+        self.pool_size = pool_size
+        self.timeout_seconds = timeout_seconds
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = int(memory_mb * 1024 * 1024)
+        self._mp_context = multiprocessing.get_context(start_method)
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._workers_started = 0
+        self._threads: Optional[ThreadPoolExecutor] = None
+        # Dataset name -> (version, pickled frame) of the latest snapshot sent to workers
+        self._payloads: Dict[str, Tuple[int, bytes]] = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "jobs": 0, "completed": 0, "failed": 0, "timed_out": 0, "cpu_limited": 0, "memory_limited": 0,
+            "workers_killed": 0, "dataset_transfers": 0, "total_ms": 0.0,
+        }
+
+    def start(self, preload=None) -> None:
+        """Start the worker processes, optionally sending each one a dataset snapshot up front"""
+        with self._lock:
+            if self.pool_size <= 0 or self._threads is not None:
+                return
+            start = time.perf_counter()
+            workers = [self._spawn() for _ in range(self.pool_size)]
+            self._threads = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="code-executor")
+        for worker in workers:
+            try:
+                if preload is not None:
+                    self._ensure_dataset(worker, preload)
+            except Exception as e:
+                logger.error(f"Error preloading dataset into worker {worker.index}: {e}")
+                worker = self._replace(worker)
+            self._idle.put(worker)
+        logger.info(f"Started {self.pool_size} code execution workers in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    async def run(self, code: str, dataset) -> Any:
+        """Evaluate `code` against a DatasetContext and return the result
+
+        Raises ExecutionTimeoutError past the wall-clock timeout and ExecutionError for code that
+        failed, hit a resource limit or killed its worker.
+        """
+        loop = asyncio.get_event_loop()
+        if self.pool_size <= 0:
+            return await loop.run_in_executor(None, evaluate_expression, code, dataset.df)
+        self.start()
+        return await loop.run_in_executor(self._threads, self._run_blocking, code, dataset)
+
+    def unload(self, name: str) -> None:
+        """Drop the pickled copy of a dataset and have workers release theirs (a registry unload listener)"""
+        with self._lock:
+            self._payloads.pop(name, None)
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for worker in idle:
+            self._release_unloaded(worker)
+            self._idle.put(worker)
+
+    def close(self) -> None:
+        with self._lock:
+            threads, self._threads = self._threads, None
+        if threads is not None:
+            threads.shutdown(wait=False)
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                worker.send(("stop",))
+                worker.process.join(timeout=1)
+            except OSError:
+                pass
+            worker.kill()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "pool_size": self.pool_size,
+            "idle_workers": self._idle.qsize(),
+            "workers_started": self._workers_started,
+            "timeout_seconds": self.timeout_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "memory_bytes": self.memory_bytes,
+        }
+
+    def _spawn(self) -> _Worker:
+        self._workers_started += 1
+        return _Worker(self._mp_context, self._workers_started)
+
+    def _replace(self, worker: _Worker) -> _Worker:
+        worker.kill()
+        with self._lock:
+            self.stats["workers_killed"] += 1
+            return self._spawn()
+
+    def _payload(self, dataset) -> bytes:
+        with self._lock:
+            cached = self._payloads.get(dataset.name)
+            if cached is not None and cached[0] == dataset.version:
+                return cached[1]
+        payload = pickle.dumps(dataset.df, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            cached = self._payloads.get(dataset.name)
+            if cached is None or cached[0] <= dataset.version:
+                self._payloads[dataset.name] = (dataset.version, payload)
+        return payload
+
+    def _release_unloaded(self, worker: _Worker) -> None:
+        """Tell an idle worker to drop datasets unloaded since it received them"""
+        with self._lock:
+            unloaded = [name for name in worker.datasets if name not in self._payloads]
+        for name in unloaded:
+            self._drop_dataset(worker, name)
+
+    def _drop_dataset(self, worker: _Worker, name: str) -> None:
+        """Have an idle worker forget a dataset, so its next job reloads it"""
+        try:
+            worker.send(("unload", name))
+        except OSError:
+            pass
+        worker.datasets.pop(name, None)
+
+    def _ensure_dataset(self, worker: _Worker, dataset) -> None:
+        if worker.datasets.get(dataset.name) == dataset.version:
+            return
+        worker.send(("load", dataset.name, dataset.version, self._payload(dataset)))
+        worker.receive()
+        worker.datasets[dataset.name] = dataset.version
+        with self._lock:
+            self.stats["dataset_transfers"] += 1
+
+    def _run_blocking(self, code: str, dataset) -> Any:
+        worker = self._idle.get()
+        start = time.perf_counter()
+        outcome = "failed"
+        reply = None
+        try:
+            self._ensure_dataset(worker, dataset)
+            worker.send(("run", dataset.name, dataset.version, code, self.cpu_seconds, self.memory_bytes))
+            reply = worker.receive(timeout=self.timeout_seconds)
+            if reply is None:
+                outcome = "timed_out"
+                worker = self._replace(worker)
+                raise ExecutionTimeoutError(f"Execution took longer than {self.timeout_seconds}s")
+        except (EOFError, OSError) as e:
+            logger.error(f"Code execution worker {worker.index} exited: {e}")
+            worker = self._replace(worker)
+            self._record(outcome, start)
+            raise ExecutionError("The execution worker exited unexpectedly")
+        except ExecutionTimeoutError:
+            self._record(outcome, start)
+            raise
+        finally:
+            if reply is not None and reply[0] != "ok":
+                # A failed job may have left the worker's copy of the frame modified
+                self._drop_dataset(worker, dataset.name)
+            self._release_unloaded(worker)
+            self._idle.put(worker)
+
+        status, value = reply
+        if status == "ok":
+            self._record("completed", start)
+            return value
+        self._record({"cpu_limit": "cpu_limited", "memory_limit": "memory_limited"}.get(status, "failed"), start)
+        raise ExecutionError(value)
+
+    def _record(self, outcome: str, start: float) -> None:
+        with self._lock:
+            self.stats["jobs"] += 1
+            self.stats[outcome] += 1
+            self.stats["total_ms"] = round(self.stats["total_ms"] + (time.perf_counter() - start) * 1000, 3)
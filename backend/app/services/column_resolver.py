@@ -0,0 +1,178 @@
+# app/services/column_resolver.py
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Default synonym table: user term -> column name (or candidate column names, first present wins)
+DEFAULT_COLUMN_SYNONYMS: Dict[str, Union[str, List[str]]] = {
+    "dept": "Department",
+    "depts": "Department",
+    "division": "Department",
+    "team": "Department",
+    "workers": ["EmployeeID", "Name"],
+    "worker": ["EmployeeID", "Name"],
+    "employees": ["EmployeeID", "Name"],
+    "employee": ["EmployeeID", "Name"],
+    "staff": ["EmployeeID", "Name"],
+    "people": ["EmployeeID", "Name"],
+    "pay": "Salary",
+    "wage": "Salary",
+    "wages": "Salary",
+    "earn": "Salary",
+    "earns": "Salary",
+    "income": "Salary",
+    "compensation": "Salary",
+    "rating": "Performance",
+    "score": "Performance",
+    "tenure": "Experience",
+    "seniority": "Experience",
+}
+
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "by", "with", "and", "or", "is", "are",
+    "was", "were", "be", "what", "which", "who", "whom", "how", "many", "much", "me", "show", "list",
+    "give", "tell", "all", "each", "per", "from", "than", "that", "this", "there", "their", "do",
+    "does", "did", "has", "have", "most", "least", "top", "highest", "lowest", "average", "mean",
+    "total", "sum", "count", "number", "max", "min", "maximum", "minimum", "between", "over", "under",
+    "whose", "where", "when", "can", "you", "please", "our", "my", "it",
+}
+
+# Scores for the different kinds of match
+EXACT_SCORE = 1.0
+SYNONYM_SCORE = 1.0
+STEM_SCORE = 0.95
+PART_SCORE = 0.85
+FUZZY_MAX_SCORE = 0.9
+MIN_MATCH_SCORE = 0.75
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+_CAMEL_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+@dataclass
+class ColumnResolution:
+    mapping: Dict[str, str] = field(default_factory=dict)
+    scores: Dict[str, float] = field(default_factory=dict)
+    confidence: float = 0.0
+
+
+def stem(word: str) -> str:
+    """Very small singular/plural stemmer ("salaries" -> "salary", "sales" -> "sale")"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("sses", "ches", "shes", "xes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance between two strings"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            ))
+        previous = current
+    return previous[-1]
+
+
+def similarity(a: str, b: str) -> float:
+    if not a or not b:
+        return 0.0
+    return 1.0 - edit_distance(a, b) / max(len(a), len(b))
+
+
+def split_column_name(column: str) -> List[str]:
+    """Split a column name like "EmployeeID" or "hire_date" into lowercase words"""
+    return [part.lower() for part in _CAMEL_PATTERN.findall(str(column))]
+
+
+def load_synonyms(path: Optional[str]) -> Dict[str, Union[str, List[str]]]:
+    """Load the synonym table, merging an optional JSON file over the defaults"""
+    synonyms = dict(DEFAULT_COLUMN_SYNONYMS)
+    if path:
+        try:
+            with open(path, 'r') as f:
+                synonyms.update({key.lower(): value for key, value in json.load(f).items()})
+        except Exception as e:
+            logger.error(f"Error loading column synonyms {path}: {e}")
+    return synonyms
+
+
+class ColumnResolver:
+    """Local fuzzy matcher from question terms to dataframe column names"""
+
+    def __init__(self, synonyms: Optional[Dict[str, Union[str, List[str]]]] = None):
+        self.synonyms = {key.lower(): value for key, value in (synonyms or DEFAULT_COLUMN_SYNONYMS).items()}
+
+    def resolve(self, question: str, columns: Iterable) -> ColumnResolution:
+        """Map question terms to columns; confidence is the weakest accepted match (0 if none)"""
+        columns = [str(col) for col in columns]
+        column_keys = {col: "".join(split_column_name(col)) for col in columns}
+        column_parts = {col: split_column_name(col) for col in columns}
+
+        tokens = _TOKEN_PATTERN.findall(question.lower())
+        candidates = [t for t in tokens if t not in STOPWORDS]
+        # Adjacent word pairs catch multi-word column names ("hire date" -> HireDate)
+        candidates += [a + b for a, b in zip(tokens, tokens[1:]) if a not in STOPWORDS and b not in STOPWORDS]
+
+        resolution = ColumnResolution()
+        for term in candidates:
+            column, score = self._match_term(term, columns, column_keys, column_parts)
+            if column is None or score < MIN_MATCH_SCORE:
+                continue
+            if score > resolution.scores.get(term, 0.0):
+                resolution.mapping[term] = column
+                resolution.scores[term] = round(score, 3)
+
+        if resolution.scores:
+            resolution.confidence = min(resolution.scores.values())
+        return resolution
+
+    def _match_term(self, term, columns, column_keys, column_parts):
+        synonym = self.synonyms.get(term)
+        if synonym is not None:
+            for target in ([synonym] if isinstance(synonym, str) else synonym):
+                if target in columns:
+                    return target, SYNONYM_SCORE
+
+        if len(term) < 3:
+            return None, 0.0
+
+        best_column, best_score = None, 0.0
+        term_stem = stem(term)
+        for column in columns:
+            key = column_keys[column]
+            if term == key:
+                score = EXACT_SCORE
+            elif term_stem == stem(key):
+                score = STEM_SCORE
+            elif len(column_parts[column]) > 1 and term_stem in {stem(p) for p in column_parts[column] if len(p) > 2}:
+                score = PART_SCORE
+            else:
+                score = self._fuzzy_score(term_stem, stem(key))
+            if score > best_score:
+                best_column, best_score = column, score
+        return best_column, best_score
+
+    @staticmethod
+    def _fuzzy_score(term: str, key: str) -> float:
+        """Typo tolerance: one edit for short words, two for long ones; never as strong as a stem match"""
+        if min(len(term), len(key)) < 5:
+            return 0.0
+        allowed = 1 if max(len(term), len(key)) <= 7 else 2
+        if edit_distance(term, key) > allowed:
+            return 0.0
+        return min(FUZZY_MAX_SCORE, similarity(term, key))
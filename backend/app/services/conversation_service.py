@@ -3,9 +3,18 @@ from typing import Any, List, Dict, Optional, Tuple
 import logging
 import json
 import os
-import shutil
+import threading
 from app.models.schema import Message
-from app.config import MAX_HISTORY_ENTRIES
+from app.config import (
+    MAX_HISTORY_ENTRIES, CONVERSATION_STORAGE, SQLITE_PATH, JSONL_STORAGE_DIR, JSONL_COMPACT_AFTER,
+    SESSION_REGISTRY_MAX_SESSIONS, SESSION_FLUSH_INTERVAL_SECONDS, CONVERSATION_TIMEOUT_HOURS,
+    EXPIRY_SWEEP_INTERVAL_SECONDS, CONVERSATION_RETENTION_DAYS, CONVERSATION_AUTO_DELETE
+)
+from app.services.conversation_storage import create_storage, default_metadata, _parse_timestamp
+from app.services.expiry_scheduler import ExpiryScheduler
+from app.services.session_catalog import SessionCatalog
+from app.services.search_index import ConversationSearchIndex
+from app.services.session_registry import SessionRegistry
 
 logger = logging.getLogger(__name__)
 
@@ -13,37 +22,73 @@ logger = logging.getLogger(__name__)
 STORAGE_DIR = os.getenv("STORAGE_DIR", "data/conversations")
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
+storage = create_storage(CONVERSATION_STORAGE, STORAGE_DIR, SQLITE_PATH, JSONL_STORAGE_DIR, JSONL_COMPACT_AFTER)
+
+# Summaries of all sessions, built from storage once and then updated on every write
+session_catalog = SessionCatalog(lambda: storage.iter_conversations())
+
+# Full-text index over titles and messages, maintained the same way
+search_index = ConversationSearchIndex(lambda: storage.iter_conversations())
+
+def _access_time(last_access: Any) -> float:
+    """Epoch seconds of a stored last_access value (now if missing or unparseable)"""
+    try:
+        return _parse_timestamp(last_access).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return datetime.now().timestamp()
+
+# Time-ordered expiry of sessions, seeded from the catalog on the first sweep
+expiry_scheduler = ExpiryScheduler(
+    interval=EXPIRY_SWEEP_INTERVAL_SECONDS,
+    seed=lambda: ((entry["session_id"], _access_time(entry["last_access"])) for entry in session_catalog.entries())
+)
+
+def _record_write(session_id: str, data: Dict[str, Any]):
+    """Keep the session catalog and expiry schedule in step with a conversation change"""
+    session_catalog.update(session_id, data)
+    expiry_scheduler.touch(session_id, _access_time(data.get("last_access")))
+
 # Keep this for backward compatibility
 conversation_store = {}
 
 class ConversationManager:
-    def __init__(self, session_id: str):
+    def __init__(self, session_id: str, write_behind: bool = False):
         self.session_id = session_id
         self.max_history = MAX_HISTORY_ENTRIES
-        self.storage_path = os.path.join(STORAGE_DIR, f"{session_id}.json")
+        
+        # With write_behind, changes are kept in memory until flush() (called by the session registry)
+        self.write_behind = write_behind
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._dirty = False
+        self._pending_messages: List[Dict[str, Any]] = []
+        self._pending_trimmed = 0
         
         # Load existing conversation or initialize new one
         self.conversation_data = self._load_conversation()
         
         # Update access time
-        self.conversation_data["last_access"] = datetime.now().isoformat()
-        
-        # For backward compatibility, keep the conversation store updated
-        conversation_store[session_id] = {
-            "messages": self.conversation_data["messages"],
-            "last_access": datetime.now(),
-            "context": self.conversation_data["context"],
-        }
+        self.touch()
+    
+    def touch(self):
+        """Record an access to the conversation"""
+        with self._lock:
+            self.conversation_data["last_access"] = datetime.now().isoformat()
+            
+            # For backward compatibility, keep the conversation store updated
+            conversation_store[self.session_id] = {
+                "messages": self.conversation_data["messages"],
+                "last_access": datetime.now(),
+                "context": self.conversation_data["context"],
+            }
         
-        self._save_conversation()
+        self._save_state()
     
     def _load_conversation(self) -> Dict[str, Any]:
-        """Load conversation from disk or initialize new one if not exists"""
-        if os.path.exists(self.storage_path):
-            try:
-                with open(self.storage_path, 'r') as f:
-                    data = json.load(f)
-                    
+        """Load conversation from storage or initialize new one if not exists"""
+        try:
+            data = storage.load(self.session_id)
+            if data is not None:
                 # Convert string timestamps back to Message objects
                 if "messages" in data:
                     messages = []
@@ -52,50 +97,106 @@ class ConversationManager:
                     data["messages"] = messages
                     
                 return data
-            except Exception as e:
-                logger.error(f"Error loading conversation {self.session_id}: {e}")
+        except Exception as e:
+            logger.error(f"Error loading conversation {self.session_id}: {e}")
         
-        # Return new conversation data if file doesn't exist or there was an error
+        # Return new conversation data if it doesn't exist or there was an error
         return {
             "messages": [],
             "last_access": datetime.now().isoformat(),
             "context": {},
-            "metadata": {
-                "created_at": datetime.now().isoformat(),
-                "title": f"Conversation {self.session_id[:8]}",
-                "tags": []
-            }
+            "metadata": default_metadata(self.session_id)
         }
     
+    def _serialize_conversation(self) -> Dict[str, Any]:
+        """Convert the conversation to a JSON-serializable document"""
+        # Convert Message objects to dicts for JSON serialization
+        data_to_save = self.conversation_data.copy()
+        data_to_save["messages"] = [msg.model_dump() for msg in self.conversation_data["messages"]]
+        data_to_save["context"] = dict(self.conversation_data["context"])
+        
+        # Ensure metadata exists
+        if "metadata" not in data_to_save:
+            data_to_save["metadata"] = default_metadata(self.session_id)
+        
+        # Serialize context data that might not be JSON serializable
+        if "last_result" in data_to_save["context"]:
+            # You might need a custom serialization approach depending on what's in last_result
+            try:
+                json.dumps(data_to_save["context"]["last_result"])
+            except (TypeError, OverflowError):
+                # If not serializable, store a placeholder or string representation
+                data_to_save["context"]["last_result"] = str(data_to_save["context"]["last_result"])
+        
+        return data_to_save
+    
+    @property
+    def is_dirty(self) -> bool:
+        return self._dirty
+    
     def _save_conversation(self):
-        """Save conversation to disk"""
+        """Save the whole conversation to storage (immediately, superseding any pending changes)"""
+        with self._flush_lock:
+            try:
+                with self._lock:
+                    data = self._serialize_conversation()
+                    self._dirty = False
+                    self._pending_messages = []
+                    self._pending_trimmed = 0
+                _record_write(self.session_id, data)
+                storage.save(self.session_id, data)
+            except Exception as e:
+                logger.error(f"Error saving conversation {self.session_id}: {e}")
+    
+    def _save_state(self):
+        """Persist a change to last access, metadata or context (no new messages)"""
+        _record_write(self.session_id, self.conversation_data)
+        with self._lock:
+            if self.write_behind:
+                self._dirty = True
+                return
         try:
-            # Convert Message objects to dicts for JSON serialization
-            data_to_save = self.conversation_data.copy()
-            data_to_save["messages"] = [msg.dict() for msg in self.conversation_data["messages"]]
-            
-            # Ensure metadata exists
-            if "metadata" not in data_to_save:
-                data_to_save["metadata"] = {
-                    "created_at": datetime.now().isoformat(),
-                    "title": f"Conversation {self.session_id[:8]}",
-                    "tags": []
-                }
-            
-            # Serialize context data that might not be JSON serializable
-            if "last_result" in data_to_save["context"]:
-                # You might need a custom serialization approach depending on what's in last_result
-                try:
-                    json.dumps(data_to_save["context"]["last_result"])
-                except (TypeError, OverflowError):
-                    # If not serializable, store a placeholder or string representation
-                    data_to_save["context"]["last_result"] = str(data_to_save["context"]["last_result"])
-            
-            with open(self.storage_path, 'w') as f:
-                json.dump(data_to_save, f, indent=2)
+            storage.update_state(self.session_id, self._serialize_conversation())
         except Exception as e:
             logger.error(f"Error saving conversation {self.session_id}: {e}")
     
+    def flush(self) -> bool:
+        """Write pending write-behind changes to storage; returns whether anything was written"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                data = self._serialize_conversation()
+                messages, trimmed = self._pending_messages, self._pending_trimmed
+                self._dirty = False
+                self._pending_messages = []
+                self._pending_trimmed = 0
+            
+            try:
+                if messages:
+                    storage.append_messages(self.session_id, data, messages, trimmed)
+                else:
+                    storage.update_state(self.session_id, data)
+                return True
+            except Exception as e:
+                logger.error(f"Error saving conversation {self.session_id}: {e}")
+                # Keep the changes pending so the next flush retries them
+                with self._lock:
+                    self._dirty = True
+                    self._pending_messages = messages + self._pending_messages
+                    self._pending_trimmed += trimmed
+                return False
+    
+    def detach(self) -> bool:
+        """Switch to write-through and write out pending changes (the registry no longer flushes this manager)
+
+        Called when the manager leaves the session registry while a request may still hold it, so its
+        later writes go straight to storage instead of being left dirty with nothing to flush them.
+        """
+        with self._lock:
+            self.write_behind = False
+        return self.flush()
+    
     def add_message(self, user_message: str, system_response: str, result_data: Any = None):
         # Create user message
         user_msg = Message(
@@ -113,6 +214,10 @@ class ConversationManager:
             isError=False
         )
         
+        with self._lock:
+            self._add_messages(user_message, user_msg, system_msg, result_data)
+    
+    def _add_messages(self, user_message: str, user_msg: Message, system_msg: Message, result_data: Any):
         # Add messages to store
         self.conversation_data["messages"].append(user_msg)
         self.conversation_data["messages"].append(system_msg)
@@ -125,11 +230,14 @@ class ConversationManager:
             # Generate a title from the first user message (max 50 chars)
             first_msg = user_message[:50] + "..." if len(user_message) > 50 else user_message
             self.conversation_data["metadata"]["title"] = first_msg
+            search_index.set_title(self.session_id, first_msg)
         
         # Trim history if too long (accounting for pairs of messages)
+        trimmed = 0
         if len(self.conversation_data["messages"]) > self.max_history * 2:
             # Remove two messages at a time (user + system)
             self.conversation_data["messages"] = self.conversation_data["messages"][2:]
+            trimmed = 2
         
         # Update last access time
         self.conversation_data["last_access"] = datetime.now().isoformat()
@@ -145,8 +253,27 @@ class ConversationManager:
             "context": self.conversation_data["context"],
         }
         
-        # Save to disk
-        self._save_conversation()
+        _record_write(self.session_id, self.conversation_data)
+        search_index.add_messages(self.session_id, [user_msg.text, system_msg.text], trimmed,
+                                  len(self.conversation_data["messages"]))
+        
+        new_messages = [user_msg.model_dump(), system_msg.model_dump()]
+        if self.write_behind:
+            self._pending_messages.extend(new_messages)
+            self._pending_trimmed += trimmed
+            self._dirty = True
+            return
+        
+        # Save to disk; backends that support it only append the new messages
+        try:
+            storage.append_messages(
+                self.session_id,
+                self._serialize_conversation(),
+                new_messages,
+                trimmed
+            )
+        except Exception as e:
+            logger.error(f"Error saving conversation {self.session_id}: {e}")
     
     def get_messages(self) -> List[Message]:
         """Get all messages in the conversation"""
@@ -190,11 +317,12 @@ class ConversationManager:
         
         if title is not None:
             self.conversation_data["metadata"]["title"] = title
+            search_index.set_title(self.session_id, title)
         
         if tags is not None:
             self.conversation_data["metadata"]["tags"] = tags
         
-        self._save_conversation()
+        self._save_state()
         return self.conversation_data["metadata"]
     
     def get_metadata(self) -> Dict[str, Any]:
@@ -205,7 +333,7 @@ class ConversationManager:
                 "title": f"Conversation {self.session_id[:8]}",
                 "tags": []
             }
-            self._save_conversation()
+            self._save_state()
         
         return self.conversation_data["metadata"]
     
@@ -214,6 +342,7 @@ class ConversationManager:
         self.conversation_data["messages"] = []
         self.conversation_data["context"] = {}
         self._save_conversation()
+        search_index.clear_messages(self.session_id)
         
         # Update in-memory store
         conversation_store[self.session_id]["messages"] = []
@@ -222,8 +351,14 @@ class ConversationManager:
     def delete_conversation(self) -> bool:
         """Delete the conversation completely"""
         try:
-            if os.path.exists(self.storage_path):
-                os.remove(self.storage_path)
+            with self._flush_lock:
+                self._dirty = False
+                self._pending_messages = []
+                self._pending_trimmed = 0
+                storage.delete(self.session_id)
+            session_catalog.remove(self.session_id)
+            expiry_scheduler.forget(self.session_id)
+            search_index.remove(self.session_id)
             
             # Remove from in-memory store
             if self.session_id in conversation_store:
@@ -243,83 +378,52 @@ def list_conversations(limit: int = 10, offset: int = 0,
     List all conversations with pagination, filtering and search
     Returns: (conversations list, total count)
     """
-    conversations = []
+    if not search_query:
+        return session_catalog.slice(limit, offset, tag=filter_tag)
     
-    # Get all conversation files
-    files = [f for f in os.listdir(STORAGE_DIR) if f.endswith('.json')]
-    
-    # Process each file to extract metadata
-    for filename in files:
-        file_path = os.path.join(STORAGE_DIR, filename)
-        try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-            
-            session_id = filename.replace('.json', '')
-            
-            # Extract basic metadata
-            metadata = data.get("metadata", {
-                "title": f"Conversation {session_id[:8]}",
-                "created_at": data.get("last_access", datetime.now().isoformat()),
-                "tags": []
-            })
-            
-            # Add session_id to metadata
-            metadata["session_id"] = session_id
-            
-            # Count messages
-            message_count = len(data.get("messages", []))
-            metadata["message_count"] = message_count
-            
-            # Apply tag filter if provided
-            if filter_tag and filter_tag not in metadata.get("tags", []):
-                continue
-            
-            # Apply search query if provided
-            if search_query:
-                search_query = search_query.lower()
-                title = metadata.get("title", "").lower()
-                
-                # Search in title
-                if search_query not in title:
-                    # If not in title, check first few messages
-                    found = False
-                    for msg in data.get("messages", [])[:6]:  # Check first 3 exchanges
-                        if isinstance(msg, dict) and search_query in msg.get("text", "").lower():
-                            found = True
-                            break
-                    
-                    if not found:
-                        continue
-            
-            conversations.append(metadata)
-        except Exception as e:
-            logger.error(f"Error reading conversation file {filename}: {e}")
-    
-    # Sort by last access time (most recent first)
-    conversations.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-    
-    # Get total count before pagination
-    total_count = len(conversations)
-    
-    # Apply pagination
-    paginated = conversations[offset:offset+limit] if offset < len(conversations) else []
-    
-    return paginated, total_count
+    # Ranked full-text matches, most relevant first
+    conversations = []
+    for match in search_index.search(search_query, limit=None)[0]:
+        entry = session_catalog.get(match["session_id"])
+        if entry is None or (filter_tag and filter_tag not in entry.get("tags", [])):
+            continue
+        conversations.append(entry)
+    return conversations[offset:offset + limit], len(conversations)
+
+def search_conversations(query: str, limit: int = 20, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Full-text search over conversation titles and messages, ranked by relevance
+    Returns: (matches with session summaries, total match count)
+    """
+    matches, total_count = search_index.search(query, limit=limit, offset=offset)
+    results = []
+    for match in matches:
+        entry = session_catalog.get(match["session_id"]) or {}
+        results.append({**entry, **match})
+    return results, total_count
+
+def list_conversation_page(limit: int = 20, cursor: Optional[str] = None,
+                           filter_tag: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    List conversations newest first from the session catalog, continuing after `cursor`
+    Returns: (conversations list, cursor for the next page or None)
+    """
+    return session_catalog.page(limit, cursor=cursor, tag=filter_tag)
+
+def count_conversations() -> int:
+    """Number of known conversations"""
+    return session_catalog.count()
 
 def export_conversation(session_id: str, format: str = "json") -> Tuple[bool, str, Any]:
     """
     Export a conversation in the specified format
     Returns: (success, filename, data)
     """
-    file_path = os.path.join(STORAGE_DIR, f"{session_id}.json")
-    
-    if not os.path.exists(file_path):
-        return False, "", None
-    
     try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
+        session_registry.flush_all()
+        data = storage.load(session_id)
+        if data is None:
+            return False, "", None
         
         if format.lower() == "json":
             return True, f"{session_id}.json", data
@@ -411,10 +515,10 @@ def import_conversation(file_path: str) -> Tuple[bool, Optional[str]]:
         # Add import timestamp
         data["metadata"]["imported_at"] = datetime.now().isoformat()
         
-        # Save to the conversations directory
-        dest_path = os.path.join(STORAGE_DIR, f"{session_id}.json")
-        with open(dest_path, 'w') as f:
-            json.dump(data, f, indent=2)
+        # Save to the conversation storage
+        storage.save(session_id, data)
+        _record_write(session_id, data)
+        search_index.index_conversation(session_id, data)
         
         return True, session_id
         
@@ -438,16 +542,11 @@ def backup_all_conversations(backup_dir: Optional[str] = None) -> Tuple[bool, st
     os.makedirs(backup_path, exist_ok=True)
     
     try:
-        # Copy all conversation files to the backup folder
-        files_copied = 0
-        for filename in os.listdir(STORAGE_DIR):
-            if filename.endswith('.json'):
-                src_path = os.path.join(STORAGE_DIR, filename)
-                dst_path = os.path.join(backup_path, filename)
-                shutil.copy2(src_path, dst_path)
-                files_copied += 1
-        
-        logger.info(f"Backed up {files_copied} conversation files to {backup_path}")
+        # Copy all conversations to the backup folder
+        session_registry.flush_all()
+        conversations_copied = storage.backup(backup_path)
+        
+        logger.info(f"Backed up {conversations_copied} conversations to {backup_path}")
         return True, backup_path
         
     except Exception as e:
@@ -455,44 +554,71 @@ def backup_all_conversations(backup_dir: Optional[str] = None) -> Tuple[bool, st
         return False, ""
 
 def cleanup_old_conversations(max_age_days: int = 30):
-    """Remove conversation files older than max_age_days"""
-    now = datetime.now()
+    """Remove conversations not accessed for more than max_age_days"""
     deleted_count = 0
-    
-    for filename in os.listdir(STORAGE_DIR):
-        if not filename.endswith('.json'):
-            continue
-            
-        file_path = os.path.join(STORAGE_DIR, filename)
-        try:
-            # Get the last modified time of the file
-            file_mtime = os.path.getmtime(file_path)
-            last_modified = datetime.fromtimestamp(file_mtime)
-            age_days = (now - last_modified).days
-            
-            # Also check last_access inside the file for more accuracy
-            try:
-                with open(file_path, 'r') as f:
-                    data = json.load(f)
-                    
-                if "last_access" in data:
-                    last_access = datetime.fromisoformat(data["last_access"].replace('Z', '+00:00'))
-                    file_age_days = (now - last_access).days
-                    # Use the most recent of file modification time and last_access
-                    age_days = min(age_days, file_age_days)
-            except:
-                # If we can't read the file, fall back to file system date
-                pass
-                
-            if age_days > max_age_days:
-                os.remove(file_path)
-                deleted_count += 1
-                logger.info(f"Removed old conversation file: {filename}")
-        except Exception as e:
-            logger.error(f"Error cleaning up file {filename}: {e}")
-    
+    for session_id in session_catalog.expired(max_age_days):
+        if delete_conversation(session_id):
+            deleted_count += 1
+            logger.info(f"Removed old conversation: {session_id}")
     return deleted_count
 
+# Live managers shared across requests; with a flush interval of 0 every change is written immediately
+session_registry = SessionRegistry(
+    lambda session_id: ConversationManager(session_id, write_behind=SESSION_FLUSH_INTERVAL_SECONDS > 0),
+    max_sessions=SESSION_REGISTRY_MAX_SESSIONS,
+    flush_interval=SESSION_FLUSH_INTERVAL_SECONDS
+)
+
 def get_conversation_manager(session_id: str = "default"):
     """Dependency for FastAPI to inject a ConversationManager instance"""
-    return ConversationManager(session_id)
\ No newline at end of file
+    return session_registry.get(session_id)
+
+def delete_conversation(session_id: str) -> bool:
+    """Delete a conversation from storage and the session registry"""
+    manager = session_registry.discard(session_id)
+    if manager is not None:
+        return manager.delete_conversation()
+    
+    try:
+        storage.delete(session_id)
+        session_catalog.remove(session_id)
+        search_index.remove(session_id)
+        expiry_scheduler.forget(session_id)
+        conversation_store.pop(session_id, None)
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting conversation {session_id}: {e}")
+        return False
+
+def release_session(session_id: str):
+    """Drop an idle session from memory, writing out its pending changes first"""
+    manager = session_registry.discard(session_id)
+    if manager is not None:
+        manager.detach()
+    conversation_store.pop(session_id, None)
+
+# Idle sessions leave memory; stored conversations past the retention age are deleted
+# (the retention deadline matches the old `.days > max_age_days` check)
+expiry_scheduler.add_policy("idle", CONVERSATION_TIMEOUT_HOURS * 3600, release_session)
+expiry_scheduler.add_policy(
+    "retention", (CONVERSATION_RETENTION_DAYS + 1) * 86400, delete_conversation,
+    seeded=True, automatic=CONVERSATION_AUTO_DELETE
+)
+expiry_scheduler.start()
+
+def expire_sessions() -> Dict[str, int]:
+    """Run an expiry sweep now, including non-automatic policies"""
+    return expiry_scheduler.sweep()
+
+def build_conversation_indexes():
+    """Build the session catalog and search index from storage; blocks for full passes, so run it
+    off the event loop"""
+    session_catalog.load()
+    search_index.load()
+
+def shutdown_conversations():
+    """Flush pending session changes and release the storage backend"""
+    expiry_scheduler.close()
+    session_registry.close()
+    storage.close()
+
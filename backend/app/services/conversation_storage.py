@@ -0,0 +1,656 @@
+# app/services/conversation_storage.py
+import json
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Number of leading messages (3 exchanges) searched besides the title
+SEARCH_MESSAGE_LIMIT = 6
+
+
+def default_metadata(session_id: str) -> Dict[str, Any]:
+    return {
+        "created_at": datetime.now().isoformat(),
+        "title": f"Conversation {session_id[:8]}",
+        "tags": []
+    }
+
+
+def _parse_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _filter_and_page(conversations_iter: Iterator[Tuple[str, Dict[str, Any]]], limit: int, offset: int,
+                     filter_tag: Optional[str], search_query: Optional[str]) -> Tuple[List[Dict[str, Any]], int]:
+    """Summarize, filter, sort and paginate full conversation documents"""
+    conversations = []
+    if search_query:
+        search_query = search_query.lower()
+
+    for session_id, data in conversations_iter:
+        # Extract basic metadata
+        metadata = data.get("metadata", {
+            "title": f"Conversation {session_id[:8]}",
+            "created_at": data.get("last_access", datetime.now().isoformat()),
+            "tags": []
+        })
+        metadata["session_id"] = session_id
+        metadata["last_access"] = data.get("last_access", metadata.get("created_at"))
+        metadata["message_count"] = len(data.get("messages", []))
+
+        # Apply tag filter if provided
+        if filter_tag and filter_tag not in metadata.get("tags", []):
+            continue
+
+        # Apply search query if provided: title first, then the first few messages
+        if search_query and search_query not in metadata.get("title", "").lower():
+            if not any(
+                isinstance(msg, dict) and search_query in msg.get("text", "").lower()
+                for msg in data.get("messages", [])[:SEARCH_MESSAGE_LIMIT]
+            ):
+                continue
+
+        conversations.append(metadata)
+
+    # Sort by creation time (most recent first)
+    conversations.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+    total_count = len(conversations)
+    return conversations[offset:offset + limit], total_count
+
+
+class ConversationStorage:
+    """Persistence backend for conversation documents
+
+    A conversation document is a plain dict: {"messages": [message dicts], "last_access": iso str,
+    "context": {...}, "metadata": {"created_at", "title", "tags", ...}}.
+    """
+
+    name = "base"
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def save(self, session_id: str, data: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def update_state(self, session_id: str, data: Dict[str, Any]) -> None:
+        """Persist a last_access/metadata/context change; data is the full document"""
+        self.save(session_id, data)
+
+    def append_messages(self, session_id: str, data: Dict[str, Any], messages: List[Dict[str, Any]],
+                        trimmed: int = 0) -> None:
+        """Persist newly added messages (and `trimmed` messages dropped from the front); data is the full document"""
+        self.save(session_id, data)
+
+    def delete(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Flush and release any resources held by the backend"""
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def iter_conversations(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        raise NotImplementedError
+
+    def list_summaries(self, limit: int, offset: int, filter_tag: Optional[str] = None,
+                       search_query: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        raise NotImplementedError
+
+    def cleanup(self, max_age_days: int) -> int:
+        raise NotImplementedError
+
+    def backup(self, backup_path: str) -> int:
+        raise NotImplementedError
+
+
+class JsonFileStorage(ConversationStorage):
+    """One <session_id>.json document per conversation in a directory"""
+
+    name = "json"
+
+    def __init__(self, storage_dir: str):
+        self.storage_dir = storage_dir
+        os.makedirs(storage_dir, exist_ok=True)
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.json")
+
+    def _filenames(self) -> List[str]:
+        return [f for f in os.listdir(self.storage_dir) if f.endswith('.json')]
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        path = self._path(session_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def save(self, session_id: str, data: Dict[str, Any]) -> None:
+        with open(self._path(session_id), 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def delete(self, session_id: str) -> None:
+        path = self._path(session_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def count(self) -> int:
+        return len(self._filenames())
+
+    def iter_conversations(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for filename in self._filenames():
+            try:
+                with open(os.path.join(self.storage_dir, filename), 'r') as f:
+                    data = json.load(f)
+            except Exception as e:
+                logger.error(f"Error reading conversation file {filename}: {e}")
+                continue
+            yield filename[:-len('.json')], data
+
+    def list_summaries(self, limit: int, offset: int, filter_tag: Optional[str] = None,
+                       search_query: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        return _filter_and_page(self.iter_conversations(), limit, offset, filter_tag, search_query)
+
+    def cleanup(self, max_age_days: int) -> int:
+        now = datetime.now()
+        deleted_count = 0
+
+        for filename in self._filenames():
+            file_path = os.path.join(self.storage_dir, filename)
+            try:
+                # Get the last modified time of the file
+                last_modified = datetime.fromtimestamp(os.path.getmtime(file_path))
+                age_days = (now - last_modified).days
+
+                # Also check last_access inside the file for more accuracy
+                try:
+                    with open(file_path, 'r') as f:
+                        data = json.load(f)
+                    if "last_access" in data:
+                        file_age_days = (now - _parse_timestamp(data["last_access"])).days
+                        # Use the most recent of file modification time and last_access
+                        age_days = min(age_days, file_age_days)
+                except Exception:
+                    # If we can't read the file, fall back to file system date
+                    pass
+
+                if age_days > max_age_days:
+                    os.remove(file_path)
+                    deleted_count += 1
+                    logger.info(f"Removed old conversation file: {filename}")
+            except Exception as e:
+                logger.error(f"Error cleaning up file {filename}: {e}")
+
+        return deleted_count
+
+    def backup(self, backup_path: str) -> int:
+        files_copied = 0
+        for filename in self._filenames():
+            shutil.copy2(os.path.join(self.storage_dir, filename), os.path.join(backup_path, filename))
+            files_copied += 1
+        return files_copied
+
+
+class SqliteStorage(ConversationStorage):
+    """SQLite (WAL mode) backend with separate sessions and messages tables"""
+
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        last_access TEXT NOT NULL,
+        tags TEXT NOT NULL DEFAULT '[]',
+        metadata TEXT NOT NULL DEFAULT '{}',
+        context TEXT NOT NULL DEFAULT '{}',
+        message_count INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions(last_access);
+    CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions(created_at);
+    CREATE TABLE IF NOT EXISTS messages (
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        sender TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        source TEXT,
+        is_error INTEGER,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            messages = self._conn.execute(
+                "SELECT text, sender, timestamp, source, is_error FROM messages WHERE session_id = ? ORDER BY seq",
+                (session_id,)
+            ).fetchall()
+        return self._row_to_document(row, messages)
+
+    def save(self, session_id: str, data: Dict[str, Any]) -> None:
+        messages = data.get("messages", [])
+        with self._lock, self._conn:
+            self._upsert_session(session_id, data)
+            # History is capped at MAX_HISTORY_ENTRIES pairs, so rewriting it is bounded
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._insert_messages(session_id, 0, messages)
+
+    def update_state(self, session_id: str, data: Dict[str, Any]) -> None:
+        with self._lock, self._conn:
+            self._upsert_session(session_id, data)
+
+    def append_messages(self, session_id: str, data: Dict[str, Any], messages: List[Dict[str, Any]],
+                        trimmed: int = 0) -> None:
+        with self._lock, self._conn:
+            stored, last_seq = self._conn.execute(
+                "SELECT COUNT(*), MAX(seq) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if stored + len(messages) - trimmed != len(data.get("messages", [])):
+                # The stored history doesn't match the document this append builds on: rewrite it
+                self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                self._insert_messages(session_id, 0, data.get("messages", []))
+            else:
+                # Sequence numbers keep increasing after a trim, so new rows go after the highest one
+                self._insert_messages(session_id, 0 if last_seq is None else last_seq + 1, messages)
+                if trimmed:
+                    self._conn.execute(
+                        "DELETE FROM messages WHERE session_id = ? AND seq IN "
+                        "(SELECT seq FROM messages WHERE session_id = ? ORDER BY seq LIMIT ?)",
+                        (session_id, session_id, trimmed)
+                    )
+            self._upsert_session(session_id, data)
+
+    def _upsert_session(self, session_id: str, data: Dict[str, Any]) -> None:
+        metadata = data.get("metadata") or default_metadata(session_id)
+        self._conn.execute(
+            """
+            INSERT INTO sessions (session_id, title, created_at, last_access, tags, metadata, context, message_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                title = excluded.title, created_at = excluded.created_at, last_access = excluded.last_access,
+                tags = excluded.tags, metadata = excluded.metadata, context = excluded.context,
+                message_count = excluded.message_count
+            """,
+            (
+                session_id,
+                metadata.get("title", f"Conversation {session_id[:8]}"),
+                metadata.get("created_at", datetime.now().isoformat()),
+                data.get("last_access", datetime.now().isoformat()),
+                json.dumps(metadata.get("tags", [])),
+                json.dumps(metadata),
+                json.dumps(data.get("context", {}), default=str),
+                len(data.get("messages", [])),
+            )
+        )
+
+    def _insert_messages(self, session_id: str, first_seq: int, messages: List[Dict[str, Any]]) -> None:
+        self._conn.executemany(
+            "INSERT INTO messages (session_id, seq, text, sender, timestamp, source, is_error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (session_id, seq, msg.get("text", ""), msg.get("sender", "user"), msg.get("timestamp", ""),
+                 msg.get("source"), None if msg.get("isError") is None else int(msg["isError"]))
+                for seq, msg in enumerate(messages, start=first_seq)
+            ]
+        )
+
+    def delete(self, session_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def iter_conversations(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            session_ids = [row[0] for row in self._conn.execute("SELECT session_id FROM sessions")]
+        for session_id in session_ids:
+            data = self.load(session_id)
+            if data is not None:
+                yield session_id, data
+
+    def list_summaries(self, limit: int, offset: int, filter_tag: Optional[str] = None,
+                       search_query: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        conditions = []
+        params: List[Any] = []
+        if filter_tag:
+            conditions.append("EXISTS (SELECT 1 FROM json_each(s.tags) WHERE json_each.value = ?)")
+            params.append(filter_tag)
+        if search_query:
+            pattern = f"%{search_query.lower()}%"
+            conditions.append(
+                "(lower(s.title) LIKE ? OR EXISTS (SELECT 1 FROM messages m WHERE m.session_id = s.session_id "
+                "AND m.seq < (SELECT MIN(seq) FROM messages WHERE session_id = s.session_id) + ? "
+                "AND lower(m.text) LIKE ?))"
+            )
+            params.extend([pattern, SEARCH_MESSAGE_LIMIT, pattern])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self._lock:
+            total_count = self._conn.execute(f"SELECT COUNT(*) FROM sessions s {where}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT session_id, metadata, last_access, message_count FROM sessions s {where} "
+                f"ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                params + [limit, offset]
+            ).fetchall()
+
+        conversations = []
+        for row in rows:
+            metadata = json.loads(row["metadata"])
+            metadata["session_id"] = row["session_id"]
+            metadata["last_access"] = row["last_access"]
+            metadata["message_count"] = row["message_count"]
+            conversations.append(metadata)
+        return conversations, total_count
+
+    def cleanup(self, max_age_days: int) -> int:
+        # Match the JSON backend: delete when the age in whole days exceeds max_age_days
+        cutoff = (datetime.now() - timedelta(days=max_age_days + 1)).isoformat()
+        with self._lock, self._conn:
+            session_ids = [row[0] for row in self._conn.execute(
+                "SELECT session_id FROM sessions WHERE last_access <= ?", (cutoff,)
+            )]
+            self._conn.executemany("DELETE FROM messages WHERE session_id = ?", [(s,) for s in session_ids])
+            self._conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(s,) for s in session_ids])
+        for session_id in session_ids:
+            logger.info(f"Removed old conversation: {session_id}")
+        return len(session_ids)
+
+    def backup(self, backup_path: str) -> int:
+        destination = sqlite3.connect(os.path.join(backup_path, os.path.basename(self.db_path)))
+        try:
+            with self._lock:
+                self._conn.backup(destination)
+        finally:
+            destination.close()
+        return self.count()
+
+    @staticmethod
+    def _row_to_document(row: sqlite3.Row, messages: List[sqlite3.Row]) -> Dict[str, Any]:
+        return {
+            "messages": [
+                {
+                    "text": msg["text"],
+                    "sender": msg["sender"],
+                    "timestamp": msg["timestamp"],
+                    "source": msg["source"],
+                    "isError": None if msg["is_error"] is None else bool(msg["is_error"]),
+                }
+                for msg in messages
+            ],
+            "last_access": row["last_access"],
+            "context": json.loads(row["context"]),
+            "metadata": json.loads(row["metadata"]),
+        }
+
+
+class JsonlLogStorage(ConversationStorage):
+    """Append-only per-session log (<id>.log.jsonl) replayed over a snapshot (<id>.snapshot.json)
+
+    Every write appends one line, so its cost doesn't depend on history length. Each line carries
+    an increasing sequence number; the snapshot records the last sequence it includes, so a crash
+    between writing a snapshot and truncating the log never replays a line twice. A torn final
+    line is skipped on replay. Sessions whose log grows past `compact_after` lines are compacted
+    into a new snapshot (atomic rename) by a background thread.
+    """
+
+    name = "jsonl"
+    SNAPSHOT_SUFFIX = ".snapshot.json"
+    LOG_SUFFIX = ".log.jsonl"
+
+    def __init__(self, storage_dir: str, compact_after: int = 100):
+        self.storage_dir = storage_dir
+        self.compact_after = compact_after
+        os.makedirs(storage_dir, exist_ok=True)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        # Per-session (next sequence number, lines in the current log), filled on first access
+        self._positions: Dict[str, Tuple[int, int]] = {}
+        self._compaction_queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._pending_compactions = set()
+        self._worker = threading.Thread(target=self._compaction_worker, name="jsonl-compactor", daemon=True)
+        self._worker.start()
+        self.stats = {"appends": 0, "compactions": 0}
+
+    def _snapshot_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}{self.SNAPSHOT_SUFFIX}")
+
+    def _log_path(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}{self.LOG_SUFFIX}")
+
+    def _lock_for(self, session_id: str) -> threading.Lock:
+        with self._locks_guard:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = self._locks[session_id] = threading.Lock()
+            return lock
+
+    def _session_ids(self) -> List[str]:
+        session_ids = set()
+        for filename in os.listdir(self.storage_dir):
+            for suffix in (self.SNAPSHOT_SUFFIX, self.LOG_SUFFIX):
+                if filename.endswith(suffix):
+                    session_ids.add(filename[:-len(suffix)])
+        return sorted(session_ids)
+
+    def _replay(self, session_id: str) -> Tuple[Optional[Dict[str, Any]], int, int]:
+        """Rebuild a document from snapshot + log; returns (document, next seq, log line count)"""
+        data = None
+        last_seq = 0
+        snapshot_path = self._snapshot_path(session_id)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            data = snapshot["data"]
+            last_seq = snapshot.get("seq", 0)
+
+        log_lines = 0
+        log_path = self._log_path(session_id)
+        if os.path.exists(log_path):
+            with open(log_path, 'r') as f:
+                for line in f:
+                    log_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping torn log line in conversation {session_id}")
+                        continue
+                    if record["seq"] <= last_seq:
+                        continue
+                    data = self._apply(data, record)
+                    last_seq = record["seq"]
+        return data, last_seq + 1, log_lines
+
+    @staticmethod
+    def _apply(data: Optional[Dict[str, Any]], record: Dict[str, Any]) -> Dict[str, Any]:
+        if record["op"] == "snapshot":
+            return record["data"]
+        if data is None:
+            data = {"messages": [], "context": {}, "metadata": {}}
+        if record["op"] == "append":
+            data["messages"].extend(record["messages"])
+            if record.get("trimmed"):
+                del data["messages"][:record["trimmed"]]
+        data.update(record["state"])
+        return data
+
+    @staticmethod
+    def _state(data: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in data.items() if key != "messages"}
+
+    def _append(self, session_id: str, record: Dict[str, Any]) -> None:
+        lock = self._lock_for(session_id)
+        with lock:
+            position = self._positions.get(session_id)
+            if position is None:
+                _, next_seq, log_lines = self._replay(session_id)
+            else:
+                next_seq, log_lines = position
+            record["seq"] = next_seq
+            with open(self._log_path(session_id), 'a') as f:
+                f.write(json.dumps(record, default=str) + "\n")
+            log_lines += 1
+            self._positions[session_id] = (next_seq + 1, log_lines)
+            self.stats["appends"] += 1
+
+        if log_lines >= self.compact_after:
+            self._schedule_compaction(session_id)
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock_for(session_id):
+            data, next_seq, log_lines = self._replay(session_id)
+            self._positions[session_id] = (next_seq, log_lines)
+        return data
+
+    def save(self, session_id: str, data: Dict[str, Any]) -> None:
+        # A full save is written as a snapshot record; compaction folds it into the snapshot file
+        self._append(session_id, {"op": "snapshot", "data": data})
+
+    def update_state(self, session_id: str, data: Dict[str, Any]) -> None:
+        self._append(session_id, {"op": "state", "state": self._state(data)})
+
+    def append_messages(self, session_id: str, data: Dict[str, Any], messages: List[Dict[str, Any]],
+                        trimmed: int = 0) -> None:
+        self._append(session_id, {"op": "append", "messages": messages, "trimmed": trimmed, "state": self._state(data)})
+
+    def delete(self, session_id: str) -> None:
+        with self._lock_for(session_id):
+            for path in (self._log_path(session_id), self._snapshot_path(session_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._positions.pop(session_id, None)
+
+    def compact(self, session_id: str) -> bool:
+        """Fold the log into a new snapshot (atomic rename) and truncate the log"""
+        with self._lock_for(session_id):
+            data, next_seq, log_lines = self._replay(session_id)
+            if data is None or log_lines == 0:
+                return False
+            snapshot_path = self._snapshot_path(session_id)
+            tmp_path = f"{snapshot_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({"seq": next_seq - 1, "data": data}, f, default=str)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, snapshot_path)
+            # Lines at or below the snapshot's seq are ignored on replay, so truncating last is crash-safe
+            os.remove(self._log_path(session_id))
+            self._positions[session_id] = (next_seq, 0)
+            self.stats["compactions"] += 1
+            return True
+
+    def _schedule_compaction(self, session_id: str) -> None:
+        with self._locks_guard:
+            if session_id in self._pending_compactions:
+                return
+            self._pending_compactions.add(session_id)
+        self._compaction_queue.put(session_id)
+
+    def _compaction_worker(self) -> None:
+        while True:
+            session_id = self._compaction_queue.get()
+            if session_id is None:
+                return
+            with self._locks_guard:
+                self._pending_compactions.discard(session_id)
+            try:
+                self.compact(session_id)
+            except Exception as e:
+                logger.error(f"Error compacting conversation log {session_id}: {e}")
+            finally:
+                self._compaction_queue.task_done()
+
+    def close(self) -> None:
+        self._compaction_queue.put(None)
+        self._worker.join(timeout=5)
+
+    def count(self) -> int:
+        return len(self._session_ids())
+
+    def iter_conversations(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for session_id in self._session_ids():
+            try:
+                data = self.load(session_id)
+            except Exception as e:
+                logger.error(f"Error reading conversation log {session_id}: {e}")
+                continue
+            if data is not None:
+                yield session_id, data
+
+    def list_summaries(self, limit: int, offset: int, filter_tag: Optional[str] = None,
+                       search_query: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        return _filter_and_page(self.iter_conversations(), limit, offset, filter_tag, search_query)
+
+    def cleanup(self, max_age_days: int) -> int:
+        now = datetime.now()
+        deleted_count = 0
+        for session_id, data in list(self.iter_conversations()):
+            try:
+                if (now - _parse_timestamp(data.get("last_access", now.isoformat()))).days > max_age_days:
+                    self.delete(session_id)
+                    deleted_count += 1
+                    logger.info(f"Removed old conversation: {session_id}")
+            except Exception as e:
+                logger.error(f"Error cleaning up conversation {session_id}: {e}")
+        return deleted_count
+
+    def backup(self, backup_path: str) -> int:
+        session_ids = self._session_ids()
+        for session_id in session_ids:
+            with self._lock_for(session_id):
+                for path in (self._snapshot_path(session_id), self._log_path(session_id)):
+                    if os.path.exists(path):
+                        shutil.copy2(path, os.path.join(backup_path, os.path.basename(path)))
+        return len(session_ids)
+
+
+def create_storage(backend: str, storage_dir: str, sqlite_path: str, log_dir: Optional[str] = None,
+                   compact_after: int = 100) -> ConversationStorage:
+    """Create the configured conversation storage backend"""
+    if backend == "sqlite":
+        return SqliteStorage(sqlite_path)
+    if backend == "jsonl":
+        return JsonlLogStorage(log_dir or storage_dir, compact_after=compact_after)
+    if backend != "json":
+        logger.warning(f"Unknown CONVERSATION_STORAGE '{backend}', falling back to json")
+    return JsonFileStorage(storage_dir)
+
+
+def migrate_conversations(source: ConversationStorage, target: ConversationStorage) -> int:
+    """Copy every conversation from one backend to another; returns the number migrated"""
+    migrated = 0
+    for session_id, data in source.iter_conversations():
+        try:
+            target.save(session_id, data)
+            migrated += 1
+        except Exception as e:
+            logger.error(f"Error migrating conversation {session_id}: {e}")
+    return migrated
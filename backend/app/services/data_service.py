@@ -1,224 +1,619 @@
 # app/services/data_service.py
 import pandas as pd
 import logging
-from functools import lru_cache
-import os
 import re
+import json
+from typing import Optional
+from pydantic import ValidationError
+from app.config import (
+    QUERY_PIPELINE_MODE, CODE_CACHE_ENABLED, CODE_CACHE_PATH, CODE_CACHE_MAX_ENTRIES, CODE_CACHE_TTL_SECONDS,
+    CODE_CACHE_FLUSH_INTERVAL_SECONDS,
+    COLUMN_RESOLVER_ENABLED, COLUMN_RESOLVER_THRESHOLD, COLUMN_SYNONYMS_PATH, DATASET_CACHE_ENABLED,
+    DATASET_RELOAD_INTERVAL_SECONDS, DATASETS, DEFAULT_DATASET, DATASET_MEMORY_BUDGET_MB,
+    DATASET_COMPACT_DTYPES, DATASET_CATEGORY_MAX_RATIO, DATASET_ENGINES, SQL_TIMEOUT_SECONDS,
+    SQL_MAX_RESULT_ROWS, SQL_CACHE_MB, REQUEST_COALESCING_ENABLED,
+    EXECUTOR_POOL_SIZE, EXECUTOR_TIMEOUT_SECONDS, EXECUTOR_CPU_SECONDS, EXECUTOR_MEMORY_MB, RESULT_CACHE_MAX_MB,
+    AGGREGATE_CUBE_ENABLED, AGGREGATE_CUBE_MAX_CARDINALITY, AGGREGATE_CUBE_MAX_PLANS,
+    RESULT_PREVIEW_ROWS, RESULT_STORE_TTL_SECONDS, RESULT_STORE_MAX_RESULTS, RESULT_STORE_MAX_MB
+)
+from app.models.schema import QueryPlan
+from app.services.aggregate_cube import AggregateCubeStore
+from app.services.code_cache import GeneratedCodeCache, normalize_question
+from app.services.code_executor import CodeExecutor, ExecutionTimeoutError, expression_compiler
+from app.services.expression_compiler import UnsafeExpressionError
+from app.services.result_cache import ResultCache
+from app.services.result_store import ResultStore, frame_records, series_frame
+from app.services.column_resolver import ColumnResolver, load_synonyms
+from app.services.dataset_cache import read_dataset
+from app.services.dataset_context import DatasetContext
+from app.services.dataset_registry import DatasetRegistry, parse_dataset_sources
+from app.services.dataset_store import DatasetStore
+from app.services.dtype_compaction import compact_with_report, memory_report
+from app.services.single_flight import SingleFlight
+from app.services.sql_engine import (
+    ENGINE_PANDAS, ENGINE_SQL, ENGINES, SqlDatasetContext, SqlDatasetStore, SqlEngine, validate_sql
+)
+from app.services.llm_provider import (
+    STAGE_MAPPING, STAGE_CODEGEN, STAGE_LENGTH, STAGE_EXPLANATION, STAGE_PLAN
+)
 
 logger = logging.getLogger(__name__)
-UNSAFE_CODE_PATTERNS = ['import', 'exec', 'eval', 'os.', 'system', '__', 'open', 'file', 'write']
 
-# Cache for dataframe to avoid reloading
-@lru_cache(maxsize=1)
-def get_dataframe():
-    """Load or create the employee dataframe with caching"""
-    try:
+# Words that make a question depend on earlier turns, so its generated code can't be reused
+# ("it" is matched case-sensitively so the department name "IT" doesn't count)
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b((?-i:[Ii]ts?)|that|those|these|them|they|this|same|above|previous|instead|also|"
+    r"what about|how about|and for|and the|what else)\b",
+    re.IGNORECASE
+)
 
-        filepath="./app/data/Fake_Employee_Data.xlsx"
-        if os.path.exists(filepath):
-            print("file exists")
-        else:
-            print("file not exists")
-        df = pd.read_excel(filepath, engine='openpyxl')
-        print("df",df)
+code_cache = GeneratedCodeCache(
+    path=CODE_CACHE_PATH if CODE_CACHE_ENABLED else None,
+    max_entries=CODE_CACHE_MAX_ENTRIES,
+    ttl_seconds=CODE_CACHE_TTL_SECONDS,
+    flush_interval=CODE_CACHE_FLUSH_INTERVAL_SECONDS,
+)
+
+column_resolver = ColumnResolver(load_synonyms(COLUMN_SYNONYMS_PATH))
+
+# Worker processes that evaluate generated code off the event loop, with time and memory limits
+code_executor = CodeExecutor(
+    pool_size=EXECUTOR_POOL_SIZE,
+    timeout_seconds=EXECUTOR_TIMEOUT_SECONDS,
+    cpu_seconds=EXECUTOR_CPU_SECONDS,
+    memory_mb=EXECUTOR_MEMORY_MB,
+)
+
+def looks_like_follow_up(question: str) -> bool:
+    """Check whether a question refers back to earlier conversation turns"""
+    return bool(FOLLOW_UP_PATTERN.search(question))
+
+DATA_FILE_PATH = "./app/data/Fake_Employee_Data.xlsx"
+
+def load_dataframe(path: str = DATA_FILE_PATH):
+    """Load a dataset file (the employee spreadsheet by default)"""
+    # Reads the columnar cache next to the file when it is fresh, else the spreadsheet
+    return read_dataset(path, use_cache=DATASET_CACHE_ENABLED)
+
+def _sample_dataframe():
+    """Sample data used when the spreadsheet can't be loaded at startup"""
+    data = {
+        'EmployeeID': [f'Employee_{i}' for i in range(1, 11)],
+        'Department': ['IT', 'Marketing', 'Sales', 'HR', 'Finance', 'IT', 'Marketing', 'Sales', 'HR', 'Finance'],
+        'Salary': [85000, 70000, 65000, 60000, 75000, 90000, 72000, 68000, 62000, 78000],
+        'Experience': [5, 3, 4, 2, 6, 7, 4, 5, 3, 8],
+        'Performance': [4.2, 3.8, 3.5, 4.0, 4.5, 4.8, 3.9, 3.7, 4.1, 4.3]
+    }
+    return pd.DataFrame(data)
+
+# Per-column memory before and after dtype compaction of the last load of each dataset
+memory_reports = {}
+
+def _load_dataset(name: str, path: str):
+    """Load a dataset file, compacting its dtypes when enabled"""
+    df = load_dataframe(path)
+    if DATASET_COMPACT_DTYPES:
+        df, memory_reports[name] = compact_with_report(df, DATASET_CATEGORY_MAX_RATIO)
+    return df
+
+def get_memory_report(dataset_name: Optional[str] = None) -> dict:
+    """Per-column memory of a dataset, before and after dtype compaction"""
+    context = get_dataset_context(dataset_name)
+    if isinstance(context, SqlDatasetContext):
+        raise ValueError(f"Dataset {context.name!r} is queried with SQL and isn't held in memory")
+    report = memory_reports.get(context.name)
+    if report is None:
+        # Not compacted: before and after are the same frame
+        report = memory_report(context.df, context.df)
+    return {"dataset": context.name, "version": context.version, "compacted": context.name in memory_reports,
+            **report}
+
+def _parse_dataset_engines(spec: str) -> dict:
+    """Engine of each dataset listed in DATASET_ENGINES (same formats as DATASETS)"""
+    engines = parse_dataset_sources(spec)
+    for name, engine in engines.items():
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r} for dataset {name!r}, expected one of {ENGINES}")
+    return engines
+
+dataset_engines = _parse_dataset_engines(DATASET_ENGINES)
+
+def dataset_engine(dataset_name: Optional[str] = None) -> str:
+    """Query engine of a dataset, "pandas" or "sql" (the default dataset if no name is given)"""
+    return dataset_engines.get(dataset_name or DEFAULT_DATASET, ENGINE_PANDAS)
+
+def _create_dataset_store(name: str, path: str) -> DatasetStore:
+    """Versioned snapshots of one dataset, hot-reloaded when its file changes"""
+    if dataset_engine(name) == ENGINE_SQL:
+        # Imported into a SQLite file; only query results are ever loaded into memory
+        return SqlDatasetStore(path, reload_interval=DATASET_RELOAD_INTERVAL_SECONDS, name=name)
+    return DatasetStore(
+        path, lambda: _load_dataset(name, path),
+        reload_interval=DATASET_RELOAD_INTERVAL_SECONDS,
+        # Only the default dataset falls back to sample data if its file can't be loaded
+        fallback=_sample_dataframe if name == DEFAULT_DATASET else None,
+        name=name
+    )
+
+dataset_registry = DatasetRegistry(
+    parse_dataset_sources(DATASETS) or {DEFAULT_DATASET: DATA_FILE_PATH},
+    DEFAULT_DATASET,
+    store_factory=_create_dataset_store,
+    memory_budget_bytes=int(DATASET_MEMORY_BUDGET_MB * 1024 * 1024)
+)
+
+# Datasets unloaded for the memory budget are released by the worker processes too
+dataset_registry.add_unload_listener(code_executor.unload)
+
+# Results of generated expressions per dataset version, dropped when a new version is published
+result_cache = ResultCache(max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024))
+dataset_registry.add_listener(lambda context: result_cache.invalidate(context.name, context.version))
+
+# Group-by aggregates of every dataset version, built when the version is published
+aggregate_cubes = AggregateCubeStore(max_cardinality=AGGREGATE_CUBE_MAX_CARDINALITY,
+                                     max_plans=AGGREGATE_CUBE_MAX_PLANS)
+if AGGREGATE_CUBE_ENABLED:
+    # SQL datasets aggregate in the database instead
+    dataset_registry.add_listener(
+        lambda context: aggregate_cubes.rebuild(context) if isinstance(context, DatasetContext) else None
+    )
+
+# Runs generated SQL for datasets using the sql engine
+sql_engine = SqlEngine(timeout_seconds=SQL_TIMEOUT_SECONDS, max_rows=SQL_MAX_RESULT_ROWS, cache_mb=SQL_CACHE_MB)
+
+# Full tables behind result handles, paged through GET /results/{id}
+result_store = ResultStore(
+    ttl_seconds=RESULT_STORE_TTL_SECONDS,
+    max_results=RESULT_STORE_MAX_RESULTS,
+    max_bytes=int(RESULT_STORE_MAX_MB * 1024 * 1024)
+)
+
+# In-flight query pipelines shared by concurrent identical requests
+compute_flights = SingleFlight("compute")
+query_flights = SingleFlight("query")
 
-        return df
+def get_dataframe(dataset_name: Optional[str] = None):
+    """Get the dataframe of the current snapshot of a dataset (pandas engine only)"""
+    return get_dataset_context(dataset_name).df
+
+def get_dataset_context(dataset_name: Optional[str] = None) -> DatasetContext:
+    """Get the current snapshot of a dataset (the default one if no name is given) with its
+    prerendered schema/prompt context; a SqlDatasetContext for datasets using the sql engine
+    
+    Callers should fetch it once per request and keep using it, so a concurrent reload doesn't
+    mix data versions within one query. Raises UnknownDatasetError for an unregistered name.
+    """
+    return dataset_registry.get(dataset_name)
+
+def coalescing_key(question: str, conversation_manager=None, dataset_name: Optional[str] = None) -> tuple:
+    """Requests with equal keys get the same answer: same normalized question (operators and numbers
+    kept), dataset version and conversation context (the recent turns and whether there is an earlier result)"""
+    dataset = get_dataset_context(dataset_name)
+    context_text = ""
+    has_last_result = False
+    if conversation_manager:
+        context_text = conversation_manager.get_conversation_text(limit=3)
+        has_last_result = conversation_manager.get_context().get("last_result") is not None
+    return normalize_question(question), dataset.name, dataset.version, context_text, has_last_result
+
+async def run_coalesced(flights: SingleFlight, key: tuple, compute, debug_info: Optional[dict] = None):
+    """Run `compute(debug_info)` once for concurrent calls with the same key; each caller gets the
+    result and the debug details of the shared run, plus whether it was coalesced"""
+    async def compute_shared():
+        shared_debug = {}
+        return await compute(shared_debug), shared_debug
+    
+    (result, shared_debug), coalesced = await flights.run(key, compute_shared)
+    if debug_info is not None:
+        debug_info.update(shared_debug)
+        debug_info["coalesced"] = coalesced
+    return result
+
+def _strip_code_fences(text: str) -> str:
+    """Remove markdown code fences from an LLM response"""
+    text = re.sub(r'```(?:python|json|sql)?\s*', '', text)
+    return text.strip()
+
+async def resolve_column_mapping(ai_service, question: str, dataset: DatasetContext, debug_info: Optional[dict] = None) -> str:
+    """Map question terms to column names locally, asking the model only when confidence is low"""
+    if COLUMN_RESOLVER_ENABLED:
+        resolution = column_resolver.resolve(question, dataset.columns)
+        if debug_info is not None:
+            debug_info["column_mapping"] = resolution.mapping
+            debug_info["column_mapping_confidence"] = resolution.confidence
+        if resolution.confidence >= COLUMN_RESOLVER_THRESHOLD:
+            if debug_info is not None:
+                debug_info["column_mapping_source"] = "local"
+            return json.dumps(resolution.mapping)
+        logger.info(f"Local column mapping confidence {resolution.confidence:.2f} below threshold, asking model")
+    
+    if debug_info is not None:
+        debug_info["column_mapping_source"] = "llm"
+    
+    mapping_prompt = f"""
+    User question: "{question}"
+    
+    DataFrame columns: {dataset.columns_text}
+    
+    Task: Identify all potential column references in the user's question and map them to the EXACT column names in the DataFrame.
+    
+    Consider these variations:
+    1. Singular vs plural forms (e.g., "sale" → "Sales")
+    2. Case differences (e.g., "department" → "Department")
+    3. Synonyms or related terms (e.g., "workers" → "EmployeeID")
+    4. Misspellings or typos (e.g., "performence" → "Performance")
+    
+    Return a JSON object with mappings from user terms to actual column names.
+    Example: {{"sale": "Sales", "workers": "EmployeeID"}}
+    
+    Return only the JSON object, nothing else.
+    """
+    
+    return await ai_service.generate_content(mapping_prompt, stage=STAGE_MAPPING)
+
+async def generate_code_multi_step(ai_service, question: str, dataset: DatasetContext, context_text: str = "",
+                                   debug_info: Optional[dict] = None):
+    """Generate pandas code with separate column-mapping and code-generation calls"""
+    column_mapping_response = await resolve_column_mapping(ai_service, question, dataset, debug_info)
+    
+    # Now generate the code with this mapping knowledge
+    prompt = f"""
+    DataFrame Analysis Task:
+    
+    DataFrame 'df' specifications:
+    {dataset.codegen_schema}
+    
+    Previous context:
+    {context_text}
+    
+    User question: "{question}"
+    
+    Column mapping analysis:
+    {column_mapping_response}
+    
+    Instructions:
+    1. Return EXACTLY ONE pandas operation/statement using only the 'df' DataFrame
+    2. Use only pandas built-in functions and methods
+    4. Focus on answering the current question directly
+    5. Handle potential NULL/NaN values appropriately
+    6. If aggregating, use appropriate grouping
+    7. IMPORTANT: Make sure to use the EXACT column names from the DataFrame, not the user's variations
+    8. If the user refers to a column in singular form but the actual column is plural (or vice versa), use the correct column name
+    9. If the user refers to a column using a synonym or related term, map it to the correct actual column name
+    
+    Generate ONLY executable pandas code without any explanations or comments.
+    """
+    
+    return await ai_service.generate_content(prompt, stage=STAGE_CODEGEN)
+
+async def generate_sql_multi_step(ai_service, question: str, dataset: SqlDatasetContext, context_text: str = "",
+                                  debug_info: Optional[dict] = None):
+    """Generate a SQL query with separate column-mapping and code-generation calls"""
+    column_mapping_response = await resolve_column_mapping(ai_service, question, dataset, debug_info)
+    
+    prompt = f"""
+    SQL Analysis Task:
+    
+    SQLite table specifications:
+    {dataset.codegen_schema}
+    
+    Previous context:
+    {context_text}
+    
+    User question: "{question}"
+    
+    Column mapping analysis:
+    {column_mapping_response}
+    
+    Instructions:
+    1. Return EXACTLY ONE SQLite SELECT statement that reads only from the table above
+    2. Quote column names with double quotes
+    3. Focus on answering the current question directly
+    4. Handle NULL values appropriately
+    5. If aggregating, use GROUP BY with appropriate grouping
+    6. IMPORTANT: Make sure to use the EXACT column names from the table, not the user's variations
+    7. If the user refers to a column using a synonym or related term, map it to the correct actual column name
+    
+    Generate ONLY the SQL query without any explanations or comments.
+    """
+    
+    return await ai_service.generate_content(prompt, stage=STAGE_CODEGEN)
+
+async def determine_response_length(ai_service, question: str) -> str:
+    """Ask the model whether the answer should be BRIEF, MEDIUM or DETAILED"""
+    length_analysis_prompt = f"""
+    Analyze this question: "{question}"
+    
+    Determine if this query requires:
+    1. A brief, direct answer (1-2 sentences)
+    2. A medium-length explanation (3-5 sentences)
+    3. A detailed, comprehensive response (multiple paragraphs)
+    
+    Return ONLY one of these options: "BRIEF", "MEDIUM", or "DETAILED"
+    """
+    
+    response_length = await ai_service.generate_content(length_analysis_prompt, stage=STAGE_LENGTH)
+    response_length = response_length.strip().upper()
+    
+    # Default to BRIEF if the response isn't one of the expected values
+    if response_length not in ["BRIEF", "MEDIUM", "DETAILED"]:
+        response_length = "BRIEF"
+        
+    logger.info(f"Determined response length for query: {response_length}")
+    return response_length
+
+def parse_query_plan(response_text: str) -> Optional[QueryPlan]:
+    """Parse and validate a single-shot JSON response; returns None if it doesn't match the schema"""
+    try:
+        payload = json.loads(_strip_code_fences(response_text))
+        plan = QueryPlan.model_validate(payload)
+    except (ValueError, ValidationError) as e:
+        logger.warning(f"Could not parse query plan: {e}")
+        return None
+    
+    plan.code = _strip_code_fences(plan.code)
+    if not plan.code:
+        return None
+    return plan
+
+async def generate_query_plan(ai_service, question: str, dataset: DatasetContext, context_text: str = "") -> Optional[QueryPlan]:
+    """Generate column mapping, pandas code and response length in one structured call"""
+    prompt = f"""
+    DataFrame Analysis Task:
+    
+    DataFrame 'df' specifications:
+    {dataset.codegen_schema}
+    
+    Previous context:
+    {context_text}
+    
+    User question: "{question}"
+    
+    Tasks:
+    1. Map every column reference in the question to the EXACT column name in the DataFrame, handling
+       singular/plural forms, case differences, synonyms and misspellings (e.g., "performence" → "Performance")
+    2. Write EXACTLY ONE pandas expression using only the 'df' DataFrame and pandas built-in functions that
+       answers the question directly, handles NULL/NaN values and uses the exact column names
+    3. Decide whether the answer should be BRIEF (1-2 sentences), MEDIUM (3-5 sentences) or DETAILED (multiple paragraphs)
+    
+    Return ONLY a JSON object with exactly these keys:
+    {{"column_mapping": {{"<user term>": "<column name>"}}, "code": "<pandas expression>", "response_length": "BRIEF" | "MEDIUM" | "DETAILED"}}
+    """
+    
+    try:
+        response = await ai_service.generate_content(
+            prompt,
+            stage=STAGE_PLAN,
+            generation_config={"response_mime_type": "application/json"}
+        )
     except Exception as e:
-        logger.warning(f"Could not load employee_data.xlsx: {e}. Creating sample data instead.")
-        # Create sample data if file isn't found
-        data = {
-            'EmployeeID': [f'Employee_{i}' for i in range(1, 11)],
-            'Department': ['IT', 'Marketing', 'Sales', 'HR', 'Finance', 'IT', 'Marketing', 'Sales', 'HR', 'Finance'],
-            'Salary': [85000, 70000, 65000, 60000, 75000, 90000, 72000, 68000, 62000, 78000],
-            'Experience': [5, 3, 4, 2, 6, 7, 4, 5, 3, 8],
-            'Performance': [4.2, 3.8, 3.5, 4.0, 4.5, 4.8, 3.9, 3.7, 4.1, 4.3]
-        }
-        df = pd.DataFrame(data)
-        # os.makedirs('data', exist_ok=True)
-        # df.to_excel(os.path.join('data', 'employee_data.xlsx'), index=False)
-        return df
-
-async def process_dataframe_query(question: str, conversation_manager=None):
-    """Process a question against the dataframe with conversation context"""
+        logger.error(f"Error generating query plan: {str(e)}")
+        return None
+    
+    return parse_query_plan(response)
+
+async def compute_dataframe_result(question: str, conversation_manager=None, debug_info: Optional[dict] = None,
+                                   dataset_name: Optional[str] = None):
+    """Generate and run pandas code (or SQL, for datasets using the sql engine) for a question against
+    the named dataset (default if None), without the final explanation call
+    
+    Returns (result_data, code, response_length, error_answer); error_answer is set when the
+    code was rejected or failed to run. Concurrent identical requests share one run.
+    """
+    if not REQUEST_COALESCING_ENABLED:
+        return await _compute_dataframe_result(question, conversation_manager, debug_info, dataset_name)
+    return await run_coalesced(
+        compute_flights, coalescing_key(question, conversation_manager, dataset_name),
+        lambda shared_debug: _compute_dataframe_result(question, conversation_manager, shared_debug, dataset_name),
+        debug_info
+    )
+
+async def _compute_dataframe_result(question: str, conversation_manager=None, debug_info: Optional[dict] = None,
+                                    dataset_name: Optional[str] = None):
+    dataset = get_dataset_context(dataset_name)
+    is_sql = isinstance(dataset, SqlDatasetContext)
+    if debug_info is not None:
+        debug_info["dataset"] = dataset.name
+        debug_info["data_version"] = dataset.version
+        debug_info["engine"] = ENGINE_SQL if is_sql else ENGINE_PANDAS
+    
+    # Delayed import of AiModelService to avoid circular imports
+    from app.services.ai_service import AiModelService
+    ai_service = AiModelService()
+    
+    # Get conversation context for better understanding
+    context_text = ""
+    last_result = None
+    
+    if conversation_manager:
+        context_text = conversation_manager.get_conversation_text(limit=3)
+        context_dict = conversation_manager.get_context()
+        last_result = context_dict.get("last_result")
+    
+    code = None
+    response_length = None
+    fingerprint = None
+    cache_hit = False
+    
+    # Reuse previously validated code for standalone questions against the same schema
+    if CODE_CACHE_ENABLED and not (context_text and looks_like_follow_up(question)):
+        fingerprint = dataset.fingerprint
+        cached = code_cache.get(question, fingerprint, dataset.name)
+        if cached is not None:
+            code = cached["code"]
+            response_length = cached.get("response_length")
+            cache_hit = True
+            logger.info("Using cached generated code")
+    
+    if debug_info is not None:
+        debug_info["code_cache_hit"] = cache_hit
+    
+    # The single-shot plan asks for a pandas expression, so SQL datasets always use the multi-step prompts
+    if code is None and QUERY_PIPELINE_MODE == "single_shot" and not is_sql:
+        # Request mapping, code and response length in one structured call
+        plan = await generate_query_plan(ai_service, question, dataset, context_text)
+        if plan is not None:
+            code = plan.code
+            response_length = plan.response_length
+        else:
+            logger.warning("Single-shot query plan was invalid, falling back to multi-step pipeline")
+    
+    if code is None and is_sql:
+        code = await generate_sql_multi_step(ai_service, question, dataset, context_text, debug_info)
+    elif code is None:
+        code = await generate_code_multi_step(ai_service, question, dataset, context_text, debug_info)
+    
+    # Clean up code (remove markdown formatting, etc.)
+    code = _strip_code_fences(code)
+    
+    # For debugging
+    logger.info(f"Generated code: {code}")
+    
+    # Parse and check the expression against the whitelist once; the compiled result is cached by source
     try:
-        df = get_dataframe()
-        
-        # Delayed import of AiModelService to avoid circular imports
-        from app.services.ai_service import AiModelService
-        ai_service = AiModelService()
-        
-        # Get conversation context for better understanding
-        context_text = ""
-        last_result = None
-        
-        if conversation_manager:
-            context_text = conversation_manager.get_conversation_text(limit=3)
-            context_dict = conversation_manager.get_context()
-            last_result = context_dict.get("last_result")
-        
-        # Get the shape of the DataFrame
-        df_shape = df.shape  # (rows, columns)
-        
-        # First, let's add a step to help the AI understand potential variations
-        mapping_prompt = f"""
-        User question: "{question}"
-        
-        DataFrame columns: {list(df.columns)}
-        
-        Task: Identify all potential column references in the user's question and map them to the EXACT column names in the DataFrame.
-        
-        Consider these variations:
-        1. Singular vs plural forms (e.g., "sale" → "Sales")
-        2. Case differences (e.g., "department" → "Department")
-        3. Synonyms or related terms (e.g., "workers" → "EmployeeID")
-        4. Misspellings or typos (e.g., "performence" → "Performance")
-        
-        Return a JSON object with mappings from user terms to actual column names.
-        Example: {{"sale": "Sales", "workers": "EmployeeID"}}
-        
-        Return only the JSON object, nothing else.
-        """
-        
-        column_mapping_response = await ai_service.generate_content(mapping_prompt)
-        
-        # Now generate the code with this mapping knowledge
-        prompt = f"""
-        DataFrame Analysis Task:
-        
-        DataFrame 'df' specifications:
-        - Dimensions: {df_shape[0]} rows × {df_shape[1]} columns
-        - Available columns: {list(df.columns)}
-        - Data types: {df.dtypes.to_dict()}
-        - Sample data (first 3 rows):
-        {df.head(3).to_string()}
-        
-        Previous context:
-        {context_text}
-        
-        User question: "{question}"
-        
-        Column mapping analysis:
-        {column_mapping_response}
-        
-        Instructions:
-        1. Return EXACTLY ONE pandas operation/statement using only the 'df' DataFrame
-        2. Use only pandas built-in functions and methods
-        4. Focus on answering the current question directly
-        5. Handle potential NULL/NaN values appropriately
-        6. If aggregating, use appropriate grouping
-        7. IMPORTANT: Make sure to use the EXACT column names from the DataFrame, not the user's variations
-        8. If the user refers to a column in singular form but the actual column is plural (or vice versa), use the correct column name
-        9. If the user refers to a column using a synonym or related term, map it to the correct actual column name
-        
-        Generate ONLY executable pandas code without any explanations or comments.
-        """
-        
-        code = await ai_service.generate_content(prompt)
-        
-        # Clean up code (remove markdown formatting, etc.)
-        code = re.sub(r'```python\s*', '', code)
-        code = re.sub(r'```\s*', '', code)
-        code = code.strip()
-        
-        # For debugging
-        logger.info(f"Generated code: {code}")
-        
-        # Enhanced security check
-        if any(unsafe_term in code.lower() for unsafe_term in UNSAFE_CODE_PATTERNS):
-            logger.warning(f"Unsafe code detected: {code}")
-            return None, "I cannot process this query as it might involve unsafe operations.", None
-        
-        # Execute the code with limited globals
-        safe_globals = {
-            "df": df, 
-            "pd": pd,
-        }
-        
-        # Execute in try block to catch any runtime errors
-        try:
-            result = eval(code, safe_globals)
-        except Exception as exec_error:
-            logger.error(f"Error executing generated code: {str(exec_error)}")
-            return None, f"I couldn't process that query correctly. The specific error was: {str(exec_error)}", None
-        
-        # Rest of the function remains the same...
-        
-        # Convert result to appropriate format
-        if isinstance(result, pd.DataFrame):
-            # Limit large result sets
-            if len(result) > 100:
-                result = result.head(100)
-                limited_result = True
-            else:
-                limited_result = False
-                
-            result_data = result.to_dict(orient="records")
-            if limited_result:
-                result_note = f"(Showing first 100 of {len(result)} results)"
-            else:
-                result_note = f"(Found {len(result)} results)"
-                
-        elif isinstance(result, pd.Series):
-            result_data = result.to_dict()
-            result_note = ""
+        if is_sql:
+            code = validate_sql(code)
         else:
-            result_data = result
-            result_note = ""
-        
-        logger.info(f"Result type: {type(result).__name__}")
-        
-        # Analyze the question to determine appropriate response length
-        length_analysis_prompt = f"""
-        Analyze this question: "{question}"
-        
-        Determine if this query requires:
-        1. A brief, direct answer (1-2 sentences)
-        2. A medium-length explanation (3-5 sentences)
-        3. A detailed, comprehensive response (multiple paragraphs)
-        
-        Return ONLY one of these options: "BRIEF", "MEDIUM", or "DETAILED"
-        """
-        
-        response_length = await ai_service.generate_content(length_analysis_prompt)
-        response_length = response_length.strip().upper()
-        
-        # Default to BRIEF if the response isn't one of the expected values
-        if response_length not in ["BRIEF", "MEDIUM", "DETAILED"]:
-            response_length = "BRIEF"
+            expression_compiler.compile(code, dataset.columns)
+    except UnsafeExpressionError as e:
+        logger.warning(f"Unsafe code detected: {code} ({e})")
+        return None, None, None, "I cannot process this query as it might involve unsafe operations."
+    except SyntaxError as e:
+        logger.error(f"Generated code is not a single expression: {e}")
+        return None, None, None, f"I couldn't process that query correctly. The specific error was: {str(e)}"
+    
+    # Reuse the result of the same expression on the same data version
+    answered, result = result_cache.get(dataset.name, dataset.version, code)
+    if debug_info is not None:
+        debug_info["result_cache_hit"] = answered
+    
+    # Aggregations over low-cardinality columns are answered from the precomputed cube, without the frame
+    if not answered and AGGREGATE_CUBE_ENABLED and not is_sql:
+        answered, result = aggregate_cubes.evaluate(dataset, code)
+        if debug_info is not None:
+            debug_info["cube_hit"] = answered
+    
+    # Execute in a worker process with only df and pd in scope, under time and memory limits;
+    # SQL runs read-only in the dataset's database file
+    try:
+        if not answered and is_sql:
+            result, truncated = await sql_engine.run(code, dataset)
+            if debug_info is not None:
+                debug_info["result_truncated"] = truncated
+            result_cache.put(dataset.name, dataset.version, code, result)
+        elif not answered:
+            result = await code_executor.run(code, dataset)
+            result_cache.put(dataset.name, dataset.version, code, result)
+    except ExecutionTimeoutError as timeout_error:
+        logger.warning(f"Generated code timed out: {timeout_error}")
+        return None, None, None, "That query took too long to run. Please try a simpler or more specific question."
+    except Exception as exec_error:
+        logger.error(f"Error executing generated code: {str(exec_error)}")
+        return None, None, None, f"I couldn't process that query correctly. The specific error was: {str(exec_error)}"
+    
+    # Convert result to appropriate format; long series are previewed and stored like tables
+    if isinstance(result, pd.Series) and len(result) > RESULT_PREVIEW_ROWS:
+        result = series_frame(result)
+    if isinstance(result, pd.DataFrame):
+        # Large frames stay server-side under a result handle; the answer is built from a preview
+        if len(result) > RESULT_PREVIEW_ROWS:
+            result_data = frame_records(result.head(RESULT_PREVIEW_ROWS))
+            if debug_info is not None:
+                debug_info["result_id"] = result_store.put(result)
+        else:
+            result_data = frame_records(result)
+        if debug_info is not None:
+            debug_info["result_rows"] = len(result)
             
-        logger.info(f"Determined response length for query: {response_length}")
+    elif isinstance(result, pd.Series):
+        result_data = result.to_dict()
+    else:
+        result_data = result
+    
+    logger.info(f"Result type: {type(result).__name__}")
+    
+    # Analyze the question to determine appropriate response length
+    if response_length is None:
+        response_length = await determine_response_length(ai_service, question)
+    
+    if fingerprint is not None and not cache_hit:
+        code_cache.put(question, fingerprint, code, response_length, dataset.name)
+    
+    return result_data, code, response_length, None
+
+def build_explanation_prompt(question: str, result_data, response_length: str, total_rows: Optional[int] = None) -> str:
+    """Build the prompt that turns a computed result into a conversational answer
+    
+    total_rows is the full row count when result_data is only a preview of a larger table.
+    """
+    if total_rows is not None and isinstance(result_data, list) and total_rows > len(result_data):
+        result_data = f"{result_data} (first {len(result_data)} of {total_rows} rows)"
+    return f"""
+    Question: {question}
+    Data result: {result_data}
+    
+    Create a natural, conversational response that directly answers the question.
+    
+    Response requirements:
+    1. Be concise and to the point - prefer 1-2 sentences when possible
+    2. Include the specific answer/number from the data result
+    3. Sound like a human answering a question, not an AI analyzing data
+    4. DO NOT reveal how the analysis was performed or refer to dataframes/columns
+    5. DO NOT explain the methodology or details about how you arrived at the answer
+    6. DO NOT add unnecessary context, explanations, or interpretations
+    7. DO NOT mention limitations of the analysis or suggest further analysis
+    
+    Make your response length {response_length.lower()}:
+    - BRIEF: Just 1-2 direct sentences with the answer
+    - MEDIUM: 3-4 sentences with minimal context
+    - DETAILED: 5-6 sentences including relevant context
+    
+    Examples of good responses:
+    - "The average salary in the Sales department is $66,500."
+    - "Marketing has the highest average performance rating at 4.2, followed by IT at 4.0."
+    - "Based on the data, John has the most experience with 8 years, while the company average is 4.5 years."
+    """
+
+async def process_dataframe_query(question: str, conversation_manager=None, debug_info: Optional[dict] = None,
+                                  dataset_name: Optional[str] = None):
+    """Process a question against the named dataset (default if None) with conversation context
+    
+    If debug_info is given, it is filled with diagnostics about how the answer was produced.
+    Concurrent identical requests share one run, including the explanation.
+    """
+    if debug_info is None:
+        debug_info = {}
+    if not REQUEST_COALESCING_ENABLED:
+        return await _process_dataframe_query(question, conversation_manager, debug_info, dataset_name)
+    try:
+        key = coalescing_key(question, conversation_manager, dataset_name)
+    except Exception as e:
+        logger.error(f"Error processing dataframe query: {str(e)}", exc_info=True)
+        return None, f"Error processing query: {str(e)}", None
+    return await run_coalesced(
+        query_flights, key,
+        lambda shared_debug: _process_dataframe_query(question, conversation_manager, shared_debug, dataset_name),
+        debug_info
+    )
+
+async def _process_dataframe_query(question: str, conversation_manager, debug_info: dict,
+                                   dataset_name: Optional[str] = None):
+    try:
+        result_data, code, response_length, error_answer = await compute_dataframe_result(
+            question, conversation_manager, debug_info, dataset_name
+        )
+        if error_answer is not None:
+            return None, error_answer, None
         
         # Generate a human-friendly explanation based on determined length
-        explanation_prompt = f"""
-        Question: {question}
-        Data result: {result_data}
-        
-        Create a natural, conversational response that directly answers the question.
-        
-        Response requirements:
-        1. Be concise and to the point - prefer 1-2 sentences when possible
-        2. Include the specific answer/number from the data result
-        3. Sound like a human answering a question, not an AI analyzing data
-        4. DO NOT reveal how the analysis was performed or refer to dataframes/columns
-        5. DO NOT explain the methodology or details about how you arrived at the answer
-        6. DO NOT add unnecessary context, explanations, or interpretations
-        7. DO NOT mention limitations of the analysis or suggest further analysis
-        
-        Make your response length {response_length.lower()}:
-        - BRIEF: Just 1-2 direct sentences with the answer
-        - MEDIUM: 3-4 sentences with minimal context
-        - DETAILED: 5-6 sentences including relevant context
-        
-        Examples of good responses:
-        - "The average salary in the Sales department is $66,500."
-        - "Marketing has the highest average performance rating at 4.2, followed by IT at 4.0."
-        - "Based on the data, John has the most experience with 8 years, while the company average is 4.5 years."
-        """
-        
-        explanation = await ai_service.generate_content(explanation_prompt)
+        from app.services.ai_service import AiModelService
+        explanation_prompt = build_explanation_prompt(
+            question, result_data, response_length, debug_info.get("result_rows")
+        )
+        explanation = await AiModelService().generate_content(explanation_prompt, stage=STAGE_EXPLANATION)
         
         return result_data, explanation, code
         
     except Exception as e:
         logger.error(f"Error processing dataframe query: {str(e)}", exc_info=True)
-        return None, f"Error processing query: {str(e)}", None
\ No newline at end of file
+        return None, f"Error processing query: {str(e)}", None
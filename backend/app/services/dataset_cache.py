@@ -0,0 +1,175 @@
+# app/services/dataset_cache.py
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+
+
+def default_cache_dir(source_path: str) -> str:
+    """Columnar cache directory written next to the source file"""
+    return f"{source_path}.cache"
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_stat(path: str) -> Dict[str, int]:
+    stat = os.stat(path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _encode_column(series: pd.Series) -> Optional[Dict[str, Any]]:
+    """Arrays and layout for one column, or None if the dtype isn't supported"""
+    dtype = series.dtype
+    if dtype == object:
+        mask = series.isna().to_numpy()
+        values = series.to_numpy()
+        if not all(isinstance(value, str) for value in values[~mask]):
+            return None
+        return {"kind": "string", "arrays": {"values": np.where(mask, "", values).astype(str), "mask": mask}}
+    if isinstance(dtype, np.dtype) and dtype.kind in "biufmM":
+        return {"kind": "numpy", "arrays": {"values": series.to_numpy()}}
+    return None
+
+
+def _decode_column(layout: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> pd.Series:
+    if layout["kind"] == "string":
+        values = arrays["values"].astype(object)
+        values[arrays["mask"]] = np.nan
+        return pd.Series(values, dtype=object)
+    return pd.Series(arrays["values"])
+
+
+def source_signature(source_path: str) -> Dict[str, Any]:
+    """mtime, size and content hash of the source file"""
+    return {**_source_stat(source_path), "sha256": file_digest(source_path)}
+
+
+def source_unchanged(source_path: str, signature: Dict[str, Any]) -> bool:
+    """Whether the source file still matches a signature taken earlier"""
+    # Same mtime and size is taken as unchanged; otherwise compare content hashes
+    stat = _source_stat(source_path)
+    if (stat["mtime_ns"], stat["size"]) == (signature["mtime_ns"], signature["size"]):
+        return True
+    return stat["size"] == signature["size"] and file_digest(source_path) == signature["sha256"]
+
+
+def write_columnar_cache(df: pd.DataFrame, source_path: str, cache_dir: Optional[str] = None,
+                         signature: Optional[Dict[str, Any]] = None) -> bool:
+    """Write df as one .npy file per column plus a manifest keyed by the source's signature
+
+    Pass the signature taken before reading the source, so a file changed during the read is
+    not cached under its new signature.
+    """
+    cache_dir = cache_dir or default_cache_dir(source_path)
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+        logger.info("Not caching dataset: index is not a default RangeIndex")
+        return False
+    if not all(isinstance(column, str) for column in df.columns) or df.columns.has_duplicates:
+        logger.info("Not caching dataset: column names must be unique strings")
+        return False
+
+    layouts = []
+    encoded = []
+    for column in df.columns:
+        layout = _encode_column(df[column])
+        if layout is None:
+            logger.info(f"Not caching dataset: unsupported dtype {df[column].dtype} in column {column!r}")
+            return False
+        encoded.append(layout.pop("arrays"))
+        layouts.append({"name": column, **layout})
+
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    try:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for i, arrays in enumerate(encoded):
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, f"{i}.{name}.npy"), array, allow_pickle=False)
+        manifest = {
+            "version": CACHE_FORMAT_VERSION,
+            "source": signature or source_signature(source_path),
+            "rows": len(df),
+            "columns": layouts,
+            "arrays": [sorted(arrays) for arrays in encoded],
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f)
+        # Swap the finished directory in; readers only trust a directory with a manifest
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+        return True
+    except Exception as e:
+        logger.error(f"Error writing dataset cache {cache_dir}: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+
+
+def read_columnar_cache(source_path: str, cache_dir: Optional[str] = None) -> Optional[pd.DataFrame]:
+    """Load the cached frame if it was built from the current source file, else None"""
+    cache_dir = cache_dir or default_cache_dir(source_path)
+    manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get("version") != CACHE_FORMAT_VERSION:
+            return None
+
+        if not source_unchanged(source_path, manifest["source"]):
+            return None
+
+        columns = {}
+        for i, (layout, names) in enumerate(zip(manifest["columns"], manifest["arrays"])):
+            arrays = {name: np.load(os.path.join(cache_dir, f"{i}.{name}.npy"), allow_pickle=False)
+                      for name in names}
+            columns[layout["name"]] = _decode_column(layout, arrays)
+        df = pd.DataFrame(columns)
+        if len(df) != manifest["rows"]:
+            return None
+        return df
+    except Exception as e:
+        logger.error(f"Error reading dataset cache {cache_dir}: {e}")
+        return None
+
+
+def _read_source(source_path: str) -> pd.DataFrame:
+    if source_path.lower().endswith(".csv"):
+        return pd.read_csv(source_path)
+    return pd.read_excel(source_path, engine='openpyxl')
+
+
+def read_dataset(source_path: str, use_cache: bool = True, cache_dir: Optional[str] = None) -> pd.DataFrame:
+    """Read a spreadsheet or CSV file, preferring a fresh columnar cache and refreshing it after a slow read"""
+    start = time.perf_counter()
+    if use_cache:
+        df = read_columnar_cache(source_path, cache_dir)
+        if df is not None:
+            logger.info(f"Loaded dataset {source_path} {df.shape} from columnar cache in "
+                        f"{(time.perf_counter() - start) * 1000:.1f} ms")
+            return df
+
+    signature = source_signature(source_path) if use_cache else None
+    df = _read_source(source_path)
+    logger.info(f"Loaded dataset {source_path} {df.shape} from source file in "
+                f"{(time.perf_counter() - start) * 1000:.1f} ms")
+    if use_cache:
+        write_columnar_cache(df, source_path, cache_dir, signature)
+    return df
@@ -0,0 +1,86 @@
+# app/services/dataset_context.py
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Tuple
+
+import pandas as pd
+
+from app.services.code_cache import normalize_text, schema_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Text columns with more distinct values than this are not treated as categories
+MAX_CATEGORY_VALUES = 50
+
+
+@dataclass(frozen=True)
+class DatasetContext:
+    """Schema details and prerendered prompt fragments for one version of a dataframe"""
+    df: pd.DataFrame
+    version: int
+    columns: List[str]
+    shape: Tuple[int, int]
+    dtypes: Dict[str, Any]
+    fingerprint: str
+    category_values: FrozenSet[str]
+    # Prompt fragments, rendered once per data version
+    columns_text: str
+    sample_text_2: str
+    sample_text_3: str
+    classify_schema: str
+    codegen_schema: str
+    # Registry name of the dataset this snapshot belongs to
+    name: str = "default"
+
+
+def _category_values(df: pd.DataFrame) -> FrozenSet[str]:
+    """Normalized values of low-cardinality text columns"""
+    values = set()
+    for column in df.select_dtypes(include=["object", "category", "string"]).columns:
+        uniques = df[column].dropna().unique()
+        if len(uniques) <= MAX_CATEGORY_VALUES:
+            values.update(normalize_text(str(value)) for value in uniques)
+    values.discard("")
+    return frozenset(values)
+
+
+def build_dataset_context(df: pd.DataFrame, version: int = 1, name: str = "default") -> DatasetContext:
+    """Render the schema and sample-data prompt fragments for a dataframe"""
+    start = time.perf_counter()
+    columns = list(df.columns)
+    dtypes = df.dtypes.to_dict()
+    columns_text = str(columns)
+    sample_text_2 = df.head(2).to_string()
+    sample_text_3 = df.head(3).to_string()
+
+    classify_schema = (
+        f"- DataFrame with columns: {columns_text}\n"
+        f"        - Sample data (first 2 rows):\n"
+        f"        {sample_text_2}"
+    )
+    codegen_schema = (
+        f"- Dimensions: {df.shape[0]} rows × {df.shape[1]} columns\n"
+        f"    - Available columns: {columns_text}\n"
+        f"    - Data types: {dtypes}\n"
+        f"    - Sample data (first 3 rows):\n"
+        f"    {sample_text_3}"
+    )
+
+    context = DatasetContext(
+        df=df,
+        version=version,
+        columns=columns,
+        shape=df.shape,
+        dtypes=dtypes,
+        fingerprint=schema_fingerprint(df),
+        category_values=_category_values(df),
+        columns_text=columns_text,
+        sample_text_2=sample_text_2,
+        sample_text_3=sample_text_3,
+        classify_schema=classify_schema,
+        codegen_schema=codegen_schema,
+        name=name,
+    )
+    logger.info(f"Built dataset context {name} v{version} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return context
@@ -0,0 +1,186 @@
+# app/services/dataset_registry.py
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from app.services.dataset_context import DatasetContext
+from app.services.dataset_store import DatasetStore
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownDatasetError(KeyError):
+    """Raised for a dataset name that isn't registered"""
+
+
+def parse_dataset_sources(spec: Optional[str]) -> Dict[str, str]:
+    """Parse a dataset list: a JSON object {"name": "path"} or comma-separated name=path pairs"""
+    spec = (spec or "").strip()
+    if not spec:
+        return {}
+    if spec.startswith("{"):
+        sources = json.loads(spec)
+        if not isinstance(sources, dict):
+            raise ValueError("Dataset list must be a JSON object of name -> path")
+        return {str(name): str(path) for name, path in sources.items()}
+    sources = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, sep, path = item.partition("=")
+        if not sep or not name.strip() or not path.strip():
+            raise ValueError(f"Invalid dataset entry {item!r}, expected name=path")
+        sources[name.strip()] = path.strip()
+    return sources
+
+
+class DatasetRegistry:
+    """Named datasets, each loaded into its own DatasetStore on first use, within a memory budget
+
+    Every published snapshot is accounted with `DataFrame.memory_usage(deep=True)`. When the loaded
+    datasets exceed `memory_budget_bytes` (0 means no limit), the least recently used ones are
+    unloaded; their next use loads them again (from the columnar cache when it is fresh). The
+    dataset just loaded is never evicted, and requests already holding an evicted snapshot keep it.
+    Unload listeners are told the name of every evicted dataset, so copies held elsewhere can go too.
+    """
+
+    def __init__(self, sources: Dict[str, str], default: str,
+                 store_factory: Callable[[str, str], DatasetStore], memory_budget_bytes: int = 0):
+        if default not in sources:
+            raise ValueError(f"Default dataset {default!r} is not among the registered datasets")
+        self.default = default
+        self.memory_budget_bytes = memory_budget_bytes
+        self._sources = dict(sources)
+        self._store_factory = store_factory
+        self._stores: Dict[str, DatasetStore] = {}
+        # Loaded datasets in least-recently-used order -> bytes in memory
+        self._usage: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._started = False
+        self._listeners: List[Callable[[DatasetContext], Any]] = []
+        self._unload_listeners: List[Callable[[str], Any]] = []
+        self.stats = {"evictions": 0, "evicted_bytes": 0}
+
+    def names(self) -> List[str]:
+        return list(self._sources)
+
+    def source(self, name: str) -> str:
+        if name not in self._sources:
+            raise UnknownDatasetError(name)
+        return self._sources[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sources
+
+    def store(self, name: Optional[str] = None) -> DatasetStore:
+        """The store of a dataset (the default one if name is None), created on first use"""
+        name = name or self.default
+        if name not in self._sources:
+            raise UnknownDatasetError(name)
+        with self._lock:
+            store = self._stores.get(name)
+            if store is None:
+                store = self._store_factory(name, self._sources[name])
+                store.add_listener(lambda context, name=name: self._account(name, context))
+                for callback in self._listeners:
+                    store.add_listener(callback)
+                self._stores[name] = store
+                if self._started:
+                    store.start()
+            return store
+
+    def get(self, name: Optional[str] = None) -> DatasetContext:
+        """Current snapshot of a dataset, loading it if needed and marking it most recently used"""
+        name = name or self.default
+        context = self.store(name).current()
+        with self._lock:
+            if name in self._usage:
+                self._usage.move_to_end(name)
+        return context
+
+    def add_listener(self, callback: Callable[[DatasetContext], Any]) -> None:
+        """Call `callback(context)` after every new snapshot of any dataset, including ones created later"""
+        with self._lock:
+            self._listeners.append(callback)
+            stores = list(self._stores.values())
+        for store in stores:
+            store.add_listener(callback)
+
+    def add_unload_listener(self, callback: Callable[[str], Any]) -> None:
+        """Call `callback(name)` after a dataset is unloaded to stay within the memory budget"""
+        with self._lock:
+            self._unload_listeners.append(callback)
+
+    def start(self) -> None:
+        """Start the reload watchers of created stores, and of stores created from now on"""
+        with self._lock:
+            self._started = True
+            stores = list(self._stores.values())
+        for store in stores:
+            store.start()
+
+    def close(self) -> None:
+        with self._lock:
+            stores = list(self._stores.values())
+        for store in stores:
+            store.close()
+
+    def memory_used(self) -> int:
+        with self._lock:
+            return sum(self._usage.values())
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stores = dict(self._stores)
+            usage = dict(self._usage)
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "default": self.default,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "memory_used_bytes": sum(usage.values()),
+            "datasets": {
+                name: {
+                    **(stores[name].get_stats() if name in stores else {"source": source, "loaded": False}),
+                    "memory_bytes": usage.get(name, 0),
+                }
+                for name, source in self._sources.items()
+            },
+        }
+
+    def _account(self, name: str, context: DatasetContext) -> None:
+        """Record a new snapshot's size and evict least recently used datasets over the budget"""
+        if not isinstance(context, DatasetContext):
+            # Datasets served from a database file aren't held in memory
+            return
+        size = int(context.df.memory_usage(deep=True).sum())
+        unloaded = []
+        with self._lock:
+            self._usage[name] = size
+            self._usage.move_to_end(name)
+            if self.memory_budget_bytes <= 0:
+                return
+            total = sum(self._usage.values())
+            for other in list(self._usage):
+                if total <= self.memory_budget_bytes:
+                    break
+                if other == name or not self._stores[other].unload():
+                    continue
+                evicted = self._usage.pop(other)
+                total -= evicted
+                unloaded.append(other)
+                self.stats["evictions"] += 1
+                self.stats["evicted_bytes"] += evicted
+                logger.info(f"Evicted dataset {other!r} ({evicted} bytes) to stay within the memory budget")
+            if total > self.memory_budget_bytes:
+                logger.warning(f"Loaded datasets use {total} bytes, over the budget of "
+                               f"{self.memory_budget_bytes} bytes")
+            listeners = list(self._unload_listeners)
+        for other in unloaded:
+            for callback in listeners:
+                try:
+                    callback(other)
+                except Exception as e:
+                    logger.error(f"Error in dataset unload listener: {e}")
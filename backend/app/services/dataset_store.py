@@ -0,0 +1,168 @@
+# app/services/dataset_store.py
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from app.services.dataset_context import DatasetContext, build_dataset_context
+
+logger = logging.getLogger(__name__)
+
+
+def _source_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class DatasetStore:
+    """Holds the current dataset snapshot and swaps in new versions when the source file changes
+
+    Each snapshot is an immutable DatasetContext with an increasing version. Requests take the
+    current snapshot once and keep using it, so a reload never changes data under a running query.
+    A watcher thread polls the source's mtime/size every `reload_interval` seconds (when > 0) and
+    loads a changed file in the background; the swap itself is a single reference assignment.
+    """
+
+    def __init__(self, source_path: str, loader: Callable[[], pd.DataFrame], reload_interval: float = 0,
+                 fallback: Optional[Callable[[], pd.DataFrame]] = None, name: str = "default"):
+        self.name = name
+        self.source_path = source_path
+        self.loader = loader
+        self.reload_interval = reload_interval
+        # Used only if the very first load fails; a failed reload keeps the current snapshot instead
+        self.fallback = fallback
+        self._current: Optional[DatasetContext] = None
+        self._signature: Optional[Tuple[int, int]] = None
+        # Versions keep increasing across unloads, so a reloaded snapshot never reuses a version
+        self._version = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        self._listeners: List[Callable[[DatasetContext], Any]] = []
+        self.stats = {"reloads": 0, "failed_reloads": 0, "last_load_ms": 0.0, "loaded_at": None}
+
+    def current(self) -> DatasetContext:
+        """The latest snapshot, loading the first one on demand"""
+        context = self._current
+        if context is not None:
+            return context
+        with self._lock:
+            if self._current is None:
+                signature = _source_signature(self.source_path)
+                try:
+                    df = self._load()
+                except Exception as e:
+                    if self.fallback is None:
+                        raise
+                    logger.warning(f"Could not load {self.source_path}: {e}. Creating sample data instead.")
+                    df = self.fallback()
+                return self._publish(df, signature)
+            return self._current
+
+    def publish(self, df: pd.DataFrame) -> DatasetContext:
+        """Swap in a new snapshot built from df"""
+        with self._lock:
+            return self._publish(df, _source_signature(self.source_path))
+
+    def unload(self) -> bool:
+        """Drop the current snapshot so the next `current()` loads the source again
+
+        Never waits: returns False without unloading while a load is in progress. Requests that
+        already hold the snapshot keep using it.
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._current = None
+            self._signature = None
+            return True
+        finally:
+            self._lock.release()
+
+    @property
+    def loaded(self) -> bool:
+        return self._current is not None
+
+    def reload_if_changed(self) -> bool:
+        """Load and swap in the source file if it changed since the current snapshot"""
+        # Nothing to refresh until the first use; current() then reads the latest file
+        if self._current is None:
+            return False
+        signature = _source_signature(self.source_path)
+        if signature == self._signature:
+            return False
+        try:
+            df = self._load()
+        except Exception as e:
+            self.stats["failed_reloads"] += 1
+            logger.error(f"Error reloading dataset {self.source_path}, keeping version "
+                         f"{self._current.version if self._current else None}: {e}")
+            return False
+        with self._lock:
+            if self._current is None:
+                # Unloaded while reading; leave it to the next use
+                return False
+            self._publish(df, signature)
+        self.stats["reloads"] += 1
+        return True
+
+    def add_listener(self, callback: Callable[[DatasetContext], Any]) -> None:
+        """Call `callback(context)` after every new snapshot (e.g. to invalidate derived caches)"""
+        self._listeners.append(callback)
+
+    def start(self) -> None:
+        if self.reload_interval > 0 and self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, name=f"dataset-watcher-{self.name}", daemon=True)
+            self._watcher.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=5)
+
+    def get_stats(self) -> Dict[str, Any]:
+        context = self._current
+        return {
+            **self.stats,
+            "source": self.source_path,
+            "loaded": context is not None,
+            "version": context.version if context is not None else None,
+            "shape": context.shape if context is not None else None,
+            "watching": self._watcher is not None,
+        }
+
+    def _load(self) -> pd.DataFrame:
+        start = time.perf_counter()
+        df = self.loader()
+        self.stats["last_load_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        return df
+
+    def _build_context(self, df: pd.DataFrame, version: int) -> DatasetContext:
+        return build_dataset_context(df, version, self.name)
+
+    def _publish(self, df: pd.DataFrame, signature: Optional[Tuple[int, int]]) -> DatasetContext:
+        self._version += 1
+        context = self._build_context(df, self._version)
+        self._current = context
+        self._signature = signature
+        self.stats["loaded_at"] = time.time()
+        logger.info(f"Dataset {self.name!r} version {self._version} is live with shape {context.shape}")
+        for callback in self._listeners:
+            try:
+                callback(context)
+            except Exception as e:
+                logger.error(f"Error in dataset listener: {e}")
+        return context
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.reload_interval):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                logger.error(f"Error watching dataset {self.source_path}: {e}")
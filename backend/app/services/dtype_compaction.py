@@ -0,0 +1,94 @@
+# app/services/dtype_compaction.py
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (enables pandas' Arrow-backed string dtype)
+except ImportError:  # High-cardinality text stays object dtype without pyarrow
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+
+def _compact_text(series: pd.Series, max_category_ratio: float) -> Optional[pd.Series]:
+    """category for low-cardinality text, Arrow-backed strings for the rest (when pyarrow is installed)"""
+    values = series.dropna()
+    if not all(isinstance(value, str) for value in values):
+        return None
+    if len(values) and values.nunique() <= max_category_ratio * len(values):
+        return series.astype("category")
+    if pyarrow is not None:
+        return series.astype(pd.StringDtype("pyarrow"))
+    return None
+
+
+def _compact_numeric(series: pd.Series) -> Optional[pd.Series]:
+    """Smallest integer or float dtype holding exactly the same values"""
+    kind = series.dtype.kind
+    if kind in "iu":
+        compacted = pd.to_numeric(series, downcast="unsigned" if kind == "u" else "integer")
+    elif kind == "f" and series.dtype.itemsize > 4:
+        # to_numeric's float downcast tolerates rounding, so check the round trip exactly
+        compacted = series.astype(np.float32)
+        if not np.array_equal(compacted.to_numpy(np.float64), series.to_numpy(), equal_nan=True):
+            return None
+    else:
+        return None
+    return compacted if compacted.dtype != series.dtype else None
+
+
+def compact_dataframe(df: pd.DataFrame, max_category_ratio: float = 0.5) -> pd.DataFrame:
+    """Copy of df with smaller dtypes where values are unchanged
+
+    Text columns whose distinct values are at most `max_category_ratio` of their values become
+    `category`; integer columns and exactly representable float columns are downcast.
+    """
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if series.dtype == object:
+            compacted = _compact_text(series, max_category_ratio)
+        elif isinstance(series.dtype, np.dtype) and series.dtype.kind in "iuf":
+            compacted = _compact_numeric(series)
+        else:
+            compacted = None
+        columns[column] = series if compacted is None else compacted
+    return pd.DataFrame(columns, index=df.index)
+
+
+def memory_report(before: pd.DataFrame, after: pd.DataFrame) -> Dict[str, Any]:
+    """Per-column dtype and bytes (memory_usage(deep=True)) of a frame before and after compaction"""
+    bytes_before = before.memory_usage(deep=True, index=False)
+    bytes_after = after.memory_usage(deep=True, index=False)
+    columns: List[Dict[str, Any]] = [
+        {
+            "name": str(column),
+            "dtypeBefore": str(before[column].dtype),
+            "dtypeAfter": str(after[column].dtype),
+            "bytesBefore": int(bytes_before[column]),
+            "bytesAfter": int(bytes_after[column]),
+        }
+        for column in before.columns
+    ]
+    return {
+        "bytesBefore": int(bytes_before.sum()),
+        "bytesAfter": int(bytes_after.sum()),
+        "columns": columns,
+    }
+
+
+def compact_with_report(df: pd.DataFrame, max_category_ratio: float = 0.5) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """Compact a frame and log how much memory each changed column saved"""
+    compacted = compact_dataframe(df, max_category_ratio)
+    report = memory_report(df, compacted)
+    changed = ", ".join(
+        f"{column['name']} {column['dtypeBefore']}->{column['dtypeAfter']} "
+        f"{column['bytesBefore']}->{column['bytesAfter']} B"
+        for column in report["columns"] if column["dtypeBefore"] != column["dtypeAfter"]
+    )
+    logger.info(f"Compacted dataframe {df.shape} from {report['bytesBefore']} to {report['bytesAfter']} bytes"
+                f" ({changed or 'no columns changed'})")
+    return compacted, report
@@ -0,0 +1,166 @@
+# app/services/expiry_scheduler.py
+import heapq
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryPolicy:
+    """One expiry rule: sessions idle for `ttl_seconds` are passed to `on_expire`
+
+    Keeps a min-heap of (due time, session id) plus the current due time per session. Touching a
+    session pushes a new heap entry instead of updating the old one; outdated entries are skipped
+    when they surface, and the heap is rebuilt when they make up most of it.
+    """
+
+    def __init__(self, name: str, ttl_seconds: float, on_expire: Callable[[str], Any], seeded: bool = False,
+                 automatic: bool = True):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.on_expire = on_expire
+        self.seeded = seeded
+        self.automatic = automatic
+        self._heap: List[Tuple[float, str]] = []
+        self._due: Dict[str, float] = {}
+        self.stats = {"expired": 0, "stale_entries_skipped": 0, "errors": 0}
+
+    def touch(self, session_id: str, last_access: float) -> None:
+        due = last_access + self.ttl_seconds
+        # Access times only move forward; an older timestamp (e.g. from storage) never shortens the deadline
+        if self._due.get(session_id, float("-inf")) >= due:
+            return
+        self._due[session_id] = due
+        heapq.heappush(self._heap, (due, session_id))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due, session_id) for session_id, due in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def forget(self, session_id: str) -> None:
+        self._due.pop(session_id, None)
+
+    def pop_due(self, now: float) -> List[str]:
+        """Remove and return sessions whose due time has passed; touches only those entries"""
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            due, session_id = heapq.heappop(self._heap)
+            if self._due.get(session_id) != due:
+                self.stats["stale_entries_skipped"] += 1
+                continue
+            del self._due[session_id]
+            expired.append(session_id)
+        return expired
+
+    def next_due(self) -> Optional[float]:
+        return self._heap[0][0] if self._heap else None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+
+class ExpiryScheduler:
+    """Periodic worker that expires sessions by last access time, one heap per policy"""
+
+    def __init__(self, interval: float = 60.0, seed: Optional[Callable[[], Iterable[Tuple[str, float]]]] = None):
+        self.interval = interval
+        # Called once before the first sweep to register already-persisted sessions
+        self.seed = seed
+        self._seeded = seed is None
+        self._policies: Dict[str, ExpiryPolicy] = {}
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.stats = {"sweeps": 0, "last_sweep_ms": 0.0, "total_sweep_ms": 0.0, "last_sweep_expired": 0}
+        self._worker: Optional[threading.Thread] = None
+
+    def add_policy(self, name: str, ttl_seconds: float, on_expire: Callable[[str], Any],
+                   seeded: bool = False, automatic: bool = True) -> None:
+        """Register a policy; `seeded` policies also receive the sessions from `seed`, and only
+        `automatic` policies are swept by the background worker (the others on explicit sweeps)"""
+        with self._lock:
+            self._policies[name] = ExpiryPolicy(name, ttl_seconds, on_expire, seeded, automatic)
+
+    def start(self) -> None:
+        if self.interval > 0 and self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="session-expiry", daemon=True)
+            self._worker.start()
+
+    def touch(self, session_id: str, last_access: float, policies: Optional[Iterable[str]] = None) -> None:
+        """Record a session's last access (epoch seconds) for all policies, or only the named ones"""
+        with self._lock:
+            for name in (policies if policies is not None else self._policies):
+                self._policies[name].touch(session_id, last_access)
+
+    def forget(self, session_id: str) -> None:
+        with self._lock:
+            for policy in self._policies.values():
+                policy.forget(session_id)
+
+    def sweep(self, now: Optional[float] = None, automatic_only: bool = False) -> Dict[str, int]:
+        """Expire every session that is due; returns the number expired per policy"""
+        with self._sweep_lock:
+            self._ensure_seeded()
+            start = time.perf_counter()
+            now = time.time() if now is None else now
+            with self._lock:
+                due = [(policy, policy.pop_due(now)) for policy in self._policies.values()
+                       if policy.automatic or not automatic_only]
+
+            expired_counts = {}
+            for policy, session_ids in due:
+                expired_counts[policy.name] = 0
+                for session_id in session_ids:
+                    try:
+                        policy.on_expire(session_id)
+                        expired_counts[policy.name] += 1
+                    except Exception as e:
+                        policy.stats["errors"] += 1
+                        logger.error(f"Error expiring session {session_id} ({policy.name}): {e}")
+                with self._lock:
+                    policy.stats["expired"] += expired_counts[policy.name]
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.stats["sweeps"] += 1
+                self.stats["last_sweep_ms"] = round(elapsed_ms, 3)
+                self.stats["total_sweep_ms"] = round(self.stats["total_sweep_ms"] + elapsed_ms, 3)
+                self.stats["last_sweep_expired"] = sum(expired_counts.values())
+        if any(expired_counts.values()):
+            logger.info(f"Expired sessions {expired_counts} in {elapsed_ms:.1f} ms")
+        return expired_counts
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join(timeout=5)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["interval_seconds"] = self.interval
+            stats["policies"] = {
+                name: {**policy.stats, "tracked": len(policy), "ttl_seconds": policy.ttl_seconds,
+                       "automatic": policy.automatic, "next_due": policy.next_due()}
+                for name, policy in self._policies.items()
+            }
+        return stats
+
+    def _ensure_seeded(self) -> None:
+        if self._seeded:
+            return
+        self._seeded = True
+        seeded_policies = [name for name, policy in self._policies.items() if policy.seeded]
+        count = 0
+        for session_id, last_access in self.seed():
+            self.touch(session_id, last_access, seeded_policies)
+            count += 1
+        logger.info(f"Scheduled expiry for {count} stored sessions")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep(automatic_only=True)
+            except Exception as e:
+                logger.error(f"Error sweeping expired sessions: {e}")
@@ -0,0 +1,291 @@
+# app/services/expression_compiler.py
+import ast
+import builtins
+import logging
+import re
+import threading
+from collections import OrderedDict
+from types import CodeType
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Set, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class UnsafeExpressionError(ValueError):
+    """Raised for generated code that uses syntax, names or methods outside the whitelist"""
+
+
+# Syntax a single pandas expression may use; statements can't be parsed in "eval" mode at all
+ALLOWED_NODES = tuple(getattr(ast, name) for name in [
+    "Expression", "Call", "keyword", "Attribute", "Name", "Load", "Store", "Constant", "Subscript", "Slice",
+    "Index", "Tuple", "List", "Dict", "Set", "BinOp", "UnaryOp", "BoolOp", "Compare", "IfExp",
+    "Lambda", "arguments", "arg", "ListComp", "SetComp", "DictComp", "GeneratorExp", "comprehension",
+    "JoinedStr", "FormattedValue",
+    "Add", "Sub", "Mult", "Div", "FloorDiv", "Mod", "Pow", "LShift", "RShift", "BitOr", "BitXor", "BitAnd",
+    "Invert", "Not", "UAdd", "USub", "And", "Or",
+    "Eq", "NotEq", "Lt", "LtE", "Gt", "GtE", "Is", "IsNot", "In", "NotIn",
+] if hasattr(ast, name))
+
+SAFE_BUILTINS = {
+    name: getattr(builtins, name) for name in [
+        "abs", "all", "any", "bool", "dict", "enumerate", "float", "int", "len", "list", "max", "min",
+        "range", "round", "set", "sorted", "str", "sum", "tuple", "zip",
+    ]
+}
+
+# Module-level pandas functions and types generated code may use as pd.<name>
+PANDAS_FUNCTIONS = frozenset([
+    "DataFrame", "Series", "Index", "Categorical", "Grouper", "NamedAgg", "IndexSlice", "Timestamp",
+    "Timedelta", "DateOffset", "Interval", "NA", "NaT", "concat", "merge", "merge_asof", "crosstab",
+    "pivot_table", "melt", "get_dummies", "cut", "qcut", "factorize", "unique", "value_counts", "isna",
+    "isnull", "notna", "notnull", "to_datetime", "to_numeric", "to_timedelta", "date_range",
+    "period_range", "timedelta_range",
+])
+
+# Public methods that write files, run arbitrary callables/strings, touch global state or modify
+# their receiver (the dataset snapshot is shared by every request)
+DENIED_ATTRIBUTES = frozenset([
+    "pipe", "eval", "plot", "hist", "boxplot", "style", "set_flags", "format", "format_map",
+    "pop", "popitem", "insert", "update", "set_axis", "setdefault", "clear",
+])
+ALLOWED_TO_METHODS = frozenset([
+    "to_dict", "to_list", "to_numpy", "to_frame", "to_records", "to_period", "to_timestamp",
+    "to_pydatetime", "to_pytimedelta", "to_series", "to_flat_index",
+])
+# Renderers that return a string when called without a target, but write to a file or buffer with one
+RENDER_METHODS = frozenset(["to_string", "to_json", "to_markdown", "to_html"])
+RENDER_TARGET_KEYWORDS = frozenset(["buf", "path_or_buf"])
+
+# Methods that call a method of their receiver named by a string argument (df.agg('mean')), and the
+# keywords other calls take such names in (pivot_table(aggfunc='sum'))
+FUNCTION_NAME_METHODS = frozenset(["agg", "aggregate", "transform", "apply"])
+FUNCTION_NAME_KEYWORDS = frozenset(["func", "aggfunc"])
+# query() strings are checked as expressions of column names; these keywords could bind other objects
+QUERY_KEYWORDS = frozenset(["expr", "engine", "parser"])
+BACKTICK_PATTERN = re.compile(r"`[^`]*`")
+
+
+def _is_denied(attribute: str) -> bool:
+    return (attribute.startswith("_") or attribute in DENIED_ATTRIBUTES
+            or (attribute.startswith("to_") and attribute not in ALLOWED_TO_METHODS))
+
+
+def _public_attributes(types: Iterable[type]) -> FrozenSet[str]:
+    names: Set[str] = set()
+    for cls in types:
+        names.update(name for name in dir(cls) if not name.startswith("_"))
+    return frozenset(
+        name for name in names
+        if name not in DENIED_ATTRIBUTES and (not name.startswith("to_") or name in ALLOWED_TO_METHODS)
+    )
+
+
+def _method_types() -> Tuple[type, ...]:
+    types = [pd.DataFrame, pd.Series, pd.Index, pd.Timestamp, pd.Timedelta, pd.Categorical, str, dict, list]
+    typing_api = getattr(pd.api, "typing", None)
+    for name in ["DataFrameGroupBy", "SeriesGroupBy", "Rolling", "Expanding", "ExponentialMovingWindow", "Resampler"]:
+        if typing_api is not None and hasattr(typing_api, name):
+            types.append(getattr(typing_api, name))
+    sample = pd.Series(["a"])
+    types.append(type(sample.str))
+    types.append(type(sample.astype("category").cat))
+    types.append(type(pd.Series(pd.to_datetime(["2020-01-01"])).dt))
+    types.append(type(pd.Series(pd.to_timedelta(["1D"])).dt))
+    return tuple(types)
+
+
+# Methods and properties of DataFrames, Series, Index, groupby/window objects, accessors and builtins
+ALLOWED_ATTRIBUTES = _public_attributes(_method_types())
+
+
+class _Validator(ast.NodeVisitor):
+    """Checks an expression tree against the whitelist and collects attribute names it doesn't know,
+    which are only valid as column names (df.Salary)"""
+
+    def __init__(self, bound_names: Set[str]):
+        self.bound_names = bound_names
+        self.unknown_attributes: Set[str] = set()
+
+    def generic_visit(self, node: ast.AST) -> None:
+        if not isinstance(node, ALLOWED_NODES):
+            raise UnsafeExpressionError(f"{type(node).__name__} is not allowed in generated code")
+        super().generic_visit(node)
+
+    def visit_Name(self, node: ast.Name) -> None:
+        if node.id not in ("df", "pd") and node.id not in SAFE_BUILTINS and node.id not in self.bound_names:
+            raise UnsafeExpressionError(f"Name {node.id!r} is not allowed in generated code")
+
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        attribute = node.attr
+        if attribute.startswith("_"):
+            raise UnsafeExpressionError(f"Private attribute {attribute!r} is not allowed in generated code")
+        if isinstance(node.value, ast.Name) and node.value.id == "pd":
+            if attribute not in PANDAS_FUNCTIONS:
+                raise UnsafeExpressionError(f"pd.{attribute} is not allowed in generated code")
+        elif _is_denied(attribute):
+            raise UnsafeExpressionError(f"Method {attribute!r} is not allowed in generated code")
+        elif attribute not in ALLOWED_ATTRIBUTES:
+            self.unknown_attributes.add(attribute)
+        self.visit(node.value)
+
+    def visit_Call(self, node: ast.Call) -> None:
+        method = node.func.attr if isinstance(node.func, ast.Attribute) else None
+        for keyword in node.keywords:
+            # inplace=True would modify the shared frame; **kwargs could hide it
+            if keyword.arg is None:
+                raise UnsafeExpressionError("Keyword argument unpacking is not allowed in generated code")
+            if keyword.arg == "inplace":
+                raise UnsafeExpressionError("inplace operations are not allowed in generated code")
+            if keyword.arg in FUNCTION_NAME_KEYWORDS:
+                self._check_function_names(keyword.value)
+        if method in FUNCTION_NAME_METHODS:
+            if node.args:
+                self._check_function_names(node.args[0])
+            if method in ("agg", "aggregate"):
+                # Named aggregations: agg(total=('Salary', 'sum'))
+                for keyword in node.keywords:
+                    if isinstance(keyword.value, ast.Tuple):
+                        self._check_function_names(keyword.value)
+        elif method == "NamedAgg":
+            for arg in node.args:
+                self._check_function_names(arg)
+        elif method == "query":
+            self._check_query(node)
+        elif method in RENDER_METHODS:
+            # Only a called renderer is allowed; visit_Attribute still rejects df.to_json on its own
+            self._check_render(node)
+            for child in [node.func.value, *node.args, *node.keywords]:
+                self.visit(child)
+            return
+        self.generic_visit(node)
+
+    def _check_function_names(self, node: ast.AST) -> None:
+        """Strings naming functions must be whitelisted methods, otherwise they must be column names"""
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            name = node.value
+            if _is_denied(name) or name in FUNCTION_NAME_METHODS or name == "query":
+                raise UnsafeExpressionError(f"Method {name!r} is not allowed in generated code")
+            if name not in ALLOWED_ATTRIBUTES:
+                self.unknown_attributes.add(name)
+        elif isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            for element in node.elts:
+                self._check_function_names(element)
+        elif isinstance(node, ast.Dict):
+            for element in [*node.keys, *node.values]:
+                if element is not None:
+                    self._check_function_names(element)
+
+    def _check_render(self, node: ast.Call) -> None:
+        """A renderer must return its output rather than write it to a path or buffer"""
+        method = node.func.attr
+        if node.args or any(keyword.arg in RENDER_TARGET_KEYWORDS for keyword in node.keywords):
+            raise UnsafeExpressionError(f"{method}() with a path or buffer is not allowed in generated code")
+
+    def _check_query(self, node: ast.Call) -> None:
+        """A query() must be a string literal of columns and whitelisted methods, without @ references"""
+        for keyword in node.keywords:
+            if keyword.arg not in QUERY_KEYWORDS:
+                raise UnsafeExpressionError(f"query() keyword {keyword.arg!r} is not allowed in generated code")
+        expr = node.args[0] if node.args else next(
+            (keyword.value for keyword in node.keywords if keyword.arg == "expr"), None)
+        if not isinstance(expr, ast.Constant) or not isinstance(expr.value, str):
+            raise UnsafeExpressionError("query() expressions must be string literals in generated code")
+        if "@" in expr.value:
+            raise UnsafeExpressionError("Variable references (@) are not allowed in query() expressions")
+        try:
+            # Backtick-quoted column names aren't Python syntax
+            tree = ast.parse(BACKTICK_PATTERN.sub("backtick_column", expr.value).strip(), mode="eval")
+        except SyntaxError:
+            raise UnsafeExpressionError(f"Unsupported query() expression {expr.value!r}")
+        validator = _QueryValidator(self.bound_names)
+        validator.visit(tree)
+        self.unknown_attributes.update(validator.unknown_attributes)
+
+
+class _QueryValidator(_Validator):
+    """Validator for query() strings, where bare names refer to columns (or the index)"""
+
+    def visit_Name(self, node: ast.Name) -> None:
+        return None
+
+
+def _bound_names(tree: ast.AST) -> Set[str]:
+    """Names introduced by lambda parameters and comprehension targets"""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+    return names
+
+
+def validate_expression(source: str) -> Tuple[ast.Expression, FrozenSet[str]]:
+    """Parse and validate one expression; returns (tree, attribute names that must be column names)
+
+    Raises SyntaxError for code that isn't a single expression and UnsafeExpressionError for code
+    outside the whitelist.
+    """
+    tree = ast.parse(source.strip(), mode="eval")
+    validator = _Validator(_bound_names(tree))
+    validator.visit(tree)
+    return tree, frozenset(validator.unknown_attributes)
+
+
+class ExpressionCompiler:
+    """Validated, compiled generated expressions cached by source text
+
+    An expression is parsed, checked and compiled once; later uses of the same source get the cached
+    code object (or the cached rejection) without parsing again. Attributes that are neither known
+    methods nor denied are accepted only when the dataset has columns of those names.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        # source -> (code object or the exception it was rejected with, attributes that must be columns)
+        self._entries: "OrderedDict[str, Tuple[Any, FrozenSet[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "rejected": 0}
+
+    def compile(self, source: str, columns: Optional[Iterable[Any]] = None) -> CodeType:
+        """Compiled code object for source; raises SyntaxError or UnsafeExpressionError"""
+        with self._lock:
+            entry = self._entries.get(source)
+            if entry is not None:
+                self._entries.move_to_end(source)
+                self.stats["hits"] += 1
+        if entry is None:
+            entry = self._compile(source)
+            with self._lock:
+                self.stats["misses"] += 1
+                self._entries[source] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        code, column_attributes = entry
+        if isinstance(code, Exception):
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise type(code)(*code.args)
+        if column_attributes:
+            missing = column_attributes - set(str(column) for column in (columns or []))
+            if missing:
+                with self._lock:
+                    self.stats["rejected"] += 1
+                raise UnsafeExpressionError(f"Attribute {sorted(missing)[0]!r} is not allowed in generated code")
+        return code
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "max_entries": self.max_entries}
+
+    @staticmethod
+    def _compile(source: str) -> Tuple[Any, FrozenSet[str]]:
+        try:
+            tree, column_attributes = validate_expression(source)
+            return compile(tree, "<generated>", "eval"), column_attributes
+        except (SyntaxError, UnsafeExpressionError) as e:
+            logger.warning(f"Rejected generated code {source!r}: {e}")
+            return e, frozenset()
@@ -0,0 +1,201 @@
+# app/services/llm_provider.py
+import json
+import logging
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Dict, Iterator, Optional
+
+from app.config import LLM_PROVIDER, LLM_STUB_LATENCY, LLM_STUB_SEED, LLM_STUB_SCRIPT
+
+logger = logging.getLogger(__name__)
+
+# Prompt stages used by the query pipeline; the stub provider keys its scripted responses on these
+STAGE_CLASSIFY = "classify"
+STAGE_MAPPING = "mapping"
+STAGE_CODEGEN = "codegen"
+STAGE_LENGTH = "length"
+STAGE_EXPLANATION = "explanation"
+STAGE_CONVERSATION = "conversation"
+STAGE_PLAN = "plan"
+
+DEFAULT_STUB_SCRIPT = {
+    STAGE_CLASSIFY: "DATA_ANALYSIS",
+    STAGE_MAPPING: '{"department": "Department", "salary": "Salary"}',
+    STAGE_CODEGEN: "df.groupby('Department')['Salary'].mean()",
+    STAGE_LENGTH: "BRIEF",
+    STAGE_EXPLANATION: "The average salary varies by department.",
+    STAGE_CONVERSATION: "Hello! How can I help you with the employee data today?",
+    STAGE_PLAN: json.dumps({
+        "column_mapping": {"department": "Department", "salary": "Salary"},
+        "code": "df.groupby('Department')['Salary'].mean()",
+        "response_length": "BRIEF",
+    }),
+}
+
+
+class LLMProvider:
+    """Base class for text generation backends used by AiModelService"""
+
+    name = "base"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "total_seconds": 0.0}
+
+    def generate(self, prompt: str, model_name: str, stage: Optional[str] = None,
+                 generation_config: Optional[Dict[str, Any]] = None) -> str:
+        """Generate text for a prompt (blocking) and record call timing"""
+        start = time.perf_counter()
+        try:
+            return self._generate(prompt, model_name, stage, generation_config)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stats["calls"] += 1
+                self.stats["total_seconds"] += elapsed
+
+    def stream(self, prompt: str, model_name: str, stage: Optional[str] = None,
+               generation_config: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """Generate text for a prompt as a (blocking) iterator of chunks"""
+        start = time.perf_counter()
+        try:
+            yield from self._stream(prompt, model_name, stage, generation_config)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stats["calls"] += 1
+                self.stats["total_seconds"] += elapsed
+
+    def _generate(self, prompt, model_name, stage, generation_config) -> str:
+        raise NotImplementedError
+
+    def _stream(self, prompt, model_name, stage, generation_config) -> Iterator[str]:
+        # Providers without native streaming return the whole response as one chunk
+        yield self._generate(prompt, model_name, stage, generation_config)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get call count and cumulative model time for this provider"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats["provider"] = self.name
+        stats["avg_seconds"] = stats["total_seconds"] / stats["calls"] if stats["calls"] else 0.0
+        return stats
+
+
+class GeminiProvider(LLMProvider):
+    """Provider backed by the Google Gemini API"""
+
+    name = "gemini"
+
+    def _generate(self, prompt, model_name, stage, generation_config) -> str:
+        response = self._model(model_name, generation_config).generate_content(prompt)
+        return response.text
+
+    def _stream(self, prompt, model_name, stage, generation_config) -> Iterator[str]:
+        response = self._model(model_name, generation_config).generate_content(prompt, stream=True)
+        for chunk in response:
+            yield chunk.text
+
+    @staticmethod
+    def _model(model_name, generation_config):
+        import google.generativeai as genai
+
+        if generation_config:
+            return genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+        return genai.GenerativeModel(model_name)
+
+
+class LocalStubProvider(LLMProvider):
+    """Deterministic offline stand-in for Gemini with scripted responses and simulated latency"""
+
+    name = "stub"
+
+    def __init__(self, script: Optional[Dict[str, Any]] = None, latency: str = "fixed:0", seed: int = 0):
+        super().__init__()
+        self.script = dict(DEFAULT_STUB_SCRIPT)
+        if script:
+            self.script.update(script)
+        self.latency = latency
+        self._sample_latency = parse_latency_spec(latency)
+        self._rng = random.Random(seed)
+        self._counters: Dict[str, int] = {}
+
+    def _generate(self, prompt, model_name, stage, generation_config) -> str:
+        with self._lock:
+            delay = self._sample_latency(self._rng)
+            response = self._next_response(stage)
+        if delay > 0:
+            time.sleep(delay)
+        return response
+
+    def _stream(self, prompt, model_name, stage, generation_config) -> Iterator[str]:
+        with self._lock:
+            delay = self._sample_latency(self._rng)
+            response = self._next_response(stage)
+        # Spread the simulated latency across word-sized chunks, like a streaming model would
+        chunks = re.findall(r"\S+\s*", response) or [response]
+        for chunk in chunks:
+            if delay > 0:
+                time.sleep(delay / len(chunks))
+            yield chunk
+
+    def _next_response(self, stage: Optional[str]) -> str:
+        scripted = self.script.get(stage or "", "")
+        if isinstance(scripted, list):
+            if not scripted:
+                return ""
+            index = self._counters.get(stage, 0)
+            self._counters[stage] = index + 1
+            return str(scripted[index % len(scripted)])
+        return str(scripted)
+
+
+def parse_latency_spec(spec: str):
+    """Parse a latency spec like "uniform:0.02,0.08" into a sampler taking a random.Random"""
+    kind, _, args = (spec or "fixed:0").partition(":")
+    kind = kind.strip().lower()
+    params = [float(p) for p in args.split(",") if p.strip()] if args else []
+
+    if kind == "fixed":
+        value = params[0] if params else 0.0
+        return lambda rng: value
+    if kind == "uniform" and len(params) == 2:
+        low, high = params
+        return lambda rng: rng.uniform(low, high)
+    if kind == "normal" and len(params) == 2:
+        mean, stddev = params
+        return lambda rng: max(0.0, rng.gauss(mean, stddev))
+    if kind == "lognormal" and len(params) == 2:
+        mu, sigma = params
+        return lambda rng: rng.lognormvariate(mu, sigma)
+
+    raise ValueError(f"Invalid latency spec: {spec}")
+
+
+def _load_stub_script(path: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not path:
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading stub script {path}: {e}")
+        return None
+
+
+@lru_cache(maxsize=1)
+def get_llm_provider() -> LLMProvider:
+    """Get the configured LLM provider (shared across requests)"""
+    if LLM_PROVIDER == "stub":
+        logger.info(f"Using local stub LLM provider (latency={LLM_STUB_LATENCY})")
+        return LocalStubProvider(
+            script=_load_stub_script(LLM_STUB_SCRIPT),
+            latency=LLM_STUB_LATENCY,
+            seed=LLM_STUB_SEED,
+        )
+    if LLM_PROVIDER != "gemini":
+        logger.warning(f"Unknown LLM_PROVIDER '{LLM_PROVIDER}', falling back to gemini")
+    return GeminiProvider()
@@ -0,0 +1,92 @@
+# app/services/query_classifier.py
+import logging
+import re
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from app.services.code_cache import normalize_text
+from app.services.column_resolver import ColumnResolver
+from app.services.dataset_context import DatasetContext
+
+logger = logging.getLogger(__name__)
+
+DATA_ANALYSIS = "DATA_ANALYSIS"
+GENERAL_CONVERSATION = "GENERAL_CONVERSATION"
+
+GREETING_WORDS = {
+    "hi", "hello", "hey", "hiya", "yo", "thanks", "thank", "thx", "ty", "bye", "goodbye",
+    "morning", "afternoon", "evening", "night", "cheers", "appreciated",
+}
+# Words that may accompany a greeting ("thank you", "good morning") but don't make one on their own
+GREETING_FILLER_WORDS = {
+    "you", "good", "great", "how", "are", "doing", "there", "very", "so", "much", "see", "ya", "later",
+    "ok", "okay", "cool", "nice", "awesome",
+}
+
+ANALYTIC_PATTERN = re.compile(
+    r"\b(average|avg|mean|median|total|sum|count|how many|number of|highest|lowest|max|maximum|min|"
+    r"minimum|most|least|top|bottom|rank|list|show|compare|distribution|per|group|sort|headcount|"
+    r"percent|percentage|ratio|greater than|less than|more than|above|below)\b"
+)
+
+
+class LocalQueryClassifier:
+    """Cheap pre-classifier that decides obvious cases before the LLM classification call"""
+
+    def __init__(self, resolver: ColumnResolver, data_threshold: float = 1.4, general_threshold: float = 0.0):
+        self.resolver = resolver
+        self.data_threshold = data_threshold
+        self.general_threshold = general_threshold
+        self._lock = threading.Lock()
+        self.stats = {"local_data": 0, "local_general": 0, "llm": 0}
+
+    def classify(self, question: str, dataset: DatasetContext, has_last_result: bool = False,
+                 is_follow_up: bool = False) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Return (query type or None if ambiguous, scoring details)"""
+        normalized = normalize_text(question)
+        words = normalized.split()
+        details: Dict[str, Any] = {}
+
+        if (any(word in GREETING_WORDS for word in words)
+                and all(word in GREETING_WORDS or word in GREETING_FILLER_WORDS for word in words)):
+            details["reason"] = "greeting"
+            return self._record(GENERAL_CONVERSATION), details
+
+        resolution = self.resolver.resolve(question, dataset.columns)
+        column_score = max(resolution.scores.values()) if resolution.scores else 0.0
+        keyword_score = 0.5 if ANALYTIC_PATTERN.search(normalized) else 0.0
+        value_score = 0.5 if self._mentions_value(normalized, dataset) else 0.0
+        score = column_score + keyword_score + value_score
+        details.update({"score": round(score, 3), "columns": resolution.mapping})
+
+        if score >= self.data_threshold:
+            details["reason"] = "data_overlap"
+            return self._record(DATA_ANALYSIS), details
+        # A short follow-up to a data answer only needs some data reference to stay analytic
+        if has_last_result and is_follow_up and len(words) <= 12 and score > 0:
+            details["reason"] = "follow_up"
+            return self._record(DATA_ANALYSIS), details
+        if score < self.general_threshold and not is_follow_up:
+            details["reason"] = "no_data_reference"
+            return self._record(GENERAL_CONVERSATION), details
+
+        details["reason"] = "ambiguous"
+        return self._record(None), details
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        total = sum(stats.values())
+        stats["local_ratio"] = (stats["local_data"] + stats["local_general"]) / total if total else 0.0
+        return stats
+
+    def _record(self, query_type: Optional[str]) -> Optional[str]:
+        key = {DATA_ANALYSIS: "local_data", GENERAL_CONVERSATION: "local_general"}.get(query_type, "llm")
+        with self._lock:
+            self.stats[key] += 1
+        return query_type
+
+    @staticmethod
+    def _mentions_value(normalized: str, dataset: DatasetContext) -> bool:
+        padded = f" {normalized} "
+        return any(f" {value} " in padded for value in dataset.category_values)
@@ -0,0 +1,114 @@
+# app/services/result_cache.py
+import ast
+import logging
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# (dataset name, data version, normalized expression)
+ResultKey = Tuple[str, int, str]
+
+
+def normalize_expression(code: str) -> str:
+    """Canonical source of an expression, so whitespace and quoting differences share a key"""
+    try:
+        return ast.unparse(ast.parse(code.strip(), mode="eval"))
+    except SyntaxError:
+        return code.strip()
+
+
+def result_size(result: Any) -> int:
+    """Approximate bytes held by an evaluation result"""
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(deep=True, index=True).sum())
+    if isinstance(result, (pd.Series, pd.Index)):
+        return int(result.memory_usage(deep=True))
+    try:
+        return len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(result)
+
+
+class ResultCache:
+    """LRU cache of evaluated results keyed by expression and dataset version, bounded in bytes
+
+    Results are shared between requests and must be treated as read-only. Entries of a dataset are
+    dropped as soon as a new version of it is published (see `invalidate`), so a hit is always
+    computed from the data the caller is looking at.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[ResultKey, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0, "too_large": 0}
+
+    @staticmethod
+    def make_key(dataset_name: str, version: int, code: str) -> ResultKey:
+        return dataset_name, version, normalize_expression(code)
+
+    def get(self, dataset_name: str, version: int, code: str) -> Tuple[bool, Any]:
+        """Look up a result; returns (found, result) since None is a valid result"""
+        if self.max_bytes <= 0:
+            return False, None
+        key = self.make_key(dataset_name, version, code)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return True, entry[0]
+
+    def put(self, dataset_name: str, version: int, code: str, result: Any) -> bool:
+        """Store a result unless it alone exceeds the byte budget"""
+        if self.max_bytes <= 0:
+            return False
+        size = result_size(result)
+        if size > self.max_bytes:
+            with self._lock:
+                self.stats["too_large"] += 1
+            return False
+        key = self.make_key(dataset_name, version, code)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            self.stats["stores"] += 1
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats["evictions"] += 1
+        return True
+
+    def invalidate(self, dataset_name: str, keep_version: int) -> int:
+        """Drop every entry of a dataset computed from a version other than keep_version"""
+        with self._lock:
+            stale = [key for key in self._entries if key[0] == dataset_name and key[1] != keep_version]
+            for key in stale:
+                self._bytes -= self._entries.pop(key)[1]
+            self.stats["invalidations"] += len(stale)
+        if stale:
+            logger.info(f"Dropped {len(stale)} cached results of dataset {dataset_name!r}")
+        return len(stale)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,57 @@
+# app/services/result_encoding.py
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow IPC responses are only offered when pyarrow is installed
+    pa = None
+
+# Accept header values for the result encodings; anything else gets row records
+COLUMNAR_MEDIA_TYPE = "application/vnd.columnar+json"
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+ENCODING_RECORDS = "records"
+ENCODING_COLUMNAR = "columnar"
+ENCODING_ARROW = "arrow"
+
+
+def negotiate_encoding(accept: Optional[str]) -> str:
+    """Pick a result encoding from an Accept header"""
+    accept = (accept or "").lower()
+    if ARROW_STREAM_MEDIA_TYPE in accept:
+        return ENCODING_ARROW
+    if COLUMNAR_MEDIA_TYPE in accept:
+        return ENCODING_COLUMNAR
+    return ENCODING_RECORDS
+
+
+def arrow_available() -> bool:
+    return pa is not None
+
+
+def _column_values(series: pd.Series) -> List[Any]:
+    """Python values of a column, with missing values as None"""
+    if series.dtype.kind in "biufO" and not series.hasnans:
+        return series.tolist()
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def frame_columns(frame: pd.DataFrame) -> Dict[str, Any]:
+    """Column-oriented encoding: column names once, then one value array per column"""
+    return {
+        "columns": [str(column) for column in frame.columns],
+        "data": [_column_values(frame.iloc[:, i]) for i in range(frame.shape[1])],
+    }
+
+
+def frame_arrow_stream(frame: pd.DataFrame) -> bytes:
+    """Arrow IPC stream of a frame; requires pyarrow"""
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
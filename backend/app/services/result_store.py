@@ -0,0 +1,110 @@
+# app/services/result_store.py
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+import pandas as pd
+
+from app.services.result_cache import result_size
+from app.services.result_encoding import frame_columns
+
+logger = logging.getLogger(__name__)
+
+
+class ResultNotFoundError(KeyError):
+    """Raised for a result handle that never existed or has expired"""
+
+
+def frame_records(frame: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Rows of a frame as JSON-friendly dicts (missing values become None)"""
+    encoded = frame_columns(frame)
+    return [dict(zip(encoded["columns"], row)) for row in zip(*encoded["data"])]
+
+
+def series_frame(series: pd.Series) -> pd.DataFrame:
+    """A Series as a frame of its index labels and values, so it can be previewed and paged like a table"""
+    index_names = [str(level) for level in series.index.names if level is not None]
+    name = series.name if series.name is not None and str(series.name) not in index_names else "value"
+    frame = series.to_frame(name=name)
+    if isinstance(series.index, pd.RangeIndex):
+        return frame.reset_index(drop=True)
+    return frame.reset_index()
+
+
+class ResultStore:
+    """Large query results kept server-side under a handle, so responses carry only a preview
+
+    A stored frame expires `ttl_seconds` after it was last read. The least recently read frames are
+    also dropped beyond `max_results` entries or `max_bytes` in total.
+    """
+
+    def __init__(self, ttl_seconds: float = 1800, max_results: int = 500, max_bytes: int = 256 * 1024 * 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_results = max_results
+        self.max_bytes = max_bytes
+        # result id -> (frame, bytes, expires at), least recently read first
+        self._results: "OrderedDict[str, Tuple[pd.DataFrame, int, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"stored": 0, "pages": 0, "expired": 0, "evicted": 0, "not_found": 0}
+
+    def put(self, frame: pd.DataFrame) -> str:
+        """Store a result frame (treated as read-only) and return its handle"""
+        result_id = uuid.uuid4().hex
+        size = result_size(frame)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._results[result_id] = (frame, size, now + self.ttl_seconds)
+            self._bytes += size
+            self.stats["stored"] += 1
+            while len(self._results) > 1 and (len(self._results) > self.max_results or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._results)))
+                self.stats["evicted"] += 1
+        return result_id
+
+    def page(self, result_id: str, offset: int = 0, limit: int = 50) -> Tuple[List[Dict[str, Any]], int]:
+        """Rows [offset, offset + limit) of a stored result as records; returns (rows, total rows)"""
+        rows, total = self.slice(result_id, offset, limit)
+        return frame_records(rows), total
+
+    def slice(self, result_id: str, offset: int = 0, limit: int = 50) -> Tuple[pd.DataFrame, int]:
+        """Rows [offset, offset + limit) of a stored result as a frame; returns (rows, total rows)"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._results.get(result_id)
+            if entry is None:
+                self.stats["not_found"] += 1
+                raise ResultNotFoundError(result_id)
+            frame, size, _ = entry
+            self._results[result_id] = (frame, size, now + self.ttl_seconds)
+            self._results.move_to_end(result_id)
+            self.stats["pages"] += 1
+        return frame.iloc[offset:offset + limit], len(frame)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                "results": len(self._results),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+    def _expire(self, now: float) -> None:
+        # Entries are ordered by last read and share one TTL, so expired ones are at the front
+        while self._results:
+            result_id, (_, _, expires_at) = next(iter(self._results.items()))
+            if expires_at > now:
+                break
+            self._drop(result_id)
+            self.stats["expired"] += 1
+
+    def _drop(self, result_id: str) -> None:
+        _, size, _ = self._results.pop(result_id)
+        self._bytes -= size
@@ -0,0 +1,260 @@
+# app/services/search_index.py
+import bisect
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from app.services.code_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+SEARCH_STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "by", "with", "and", "or", "is", "are",
+    "was", "were", "be", "this", "that", "what", "which", "who", "how", "do", "does", "me", "my",
+}
+
+# Pseudo message sequence number under which a session's title is indexed
+TITLE_SEQ = -1
+TITLE_BOOST = 2.0
+# Prefix matches count a little less than exact term matches
+PREFIX_WEIGHT = 0.8
+MAX_PREFIX_EXPANSIONS = 50
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens used for indexing and querying"""
+    return [token for token in normalize_text(text or "").split()
+            if len(token) > 1 and token not in SEARCH_STOPWORDS]
+
+
+def _message_text(message: Any) -> str:
+    if isinstance(message, dict):
+        return message.get("text", "")
+    return getattr(message, "text", "")
+
+
+class ConversationSearchIndex:
+    """Incrementally maintained inverted index over conversation titles and messages
+
+    Postings map token -> session -> message sequence -> term frequency. Every message gets a
+    per-session sequence number, so trimming old messages only removes their own postings, and a
+    match is reported as the message's current position in the conversation. Built from `loader`
+    (one pass over storage) by `load()` at startup, or on first use otherwise.
+    """
+
+    def __init__(self, loader: Callable[[], Iterator[Tuple[str, Dict[str, Any]]]]):
+        self.loader = loader
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._postings: Dict[str, Dict[str, Dict[int, int]]] = {}
+        # Forward index: session -> sequence -> token counts, used to remove postings
+        self._documents: Dict[str, Dict[int, Counter]] = {}
+        # Session -> [first retained message seq, next message seq]
+        self._sequences: Dict[str, List[int]] = {}
+        self._vocabulary: List[str] = []
+
+    def load(self) -> None:
+        """Build the index from storage now if it isn't built yet (blocking: one pass over storage)"""
+        with self._lock:
+            self._ensure_loaded()
+
+    def index_conversation(self, session_id: str, data: Dict[str, Any]) -> None:
+        """(Re)index a whole conversation document"""
+        with self._lock:
+            self._ensure_loaded()
+            self._index_document(session_id, data)
+
+    def add_messages(self, session_id: str, texts: Iterable[str], trimmed: int = 0,
+                     message_count: Optional[int] = None) -> None:
+        """Index newly added messages, after dropping the `trimmed` oldest ones
+
+        `message_count` is the conversation's message count after the change; it places the new
+        messages after earlier ones the index hasn't seen (e.g. a conversation it only has the title of).
+        """
+        texts = list(texts)
+        with self._lock:
+            self._ensure_loaded()
+            first, next_seq = self._sequences.setdefault(session_id, [0, 0])
+            if message_count is not None:
+                next_seq = max(next_seq, first + message_count - len(texts) + trimmed)
+            for seq in range(first, min(first + trimmed, next_seq)):
+                self._remove_document(session_id, seq)
+            first = min(first + trimmed, next_seq)
+            for text in texts:
+                self._add_document(session_id, next_seq, text)
+                next_seq += 1
+            self._sequences[session_id] = [first, next_seq]
+
+    def set_title(self, session_id: str, title: str) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            self._sequences.setdefault(session_id, [0, 0])
+            self._remove_document(session_id, TITLE_SEQ)
+            self._add_document(session_id, TITLE_SEQ, title)
+
+    def clear_messages(self, session_id: str) -> None:
+        """Forget a session's messages but keep its title"""
+        with self._lock:
+            self._ensure_loaded()
+            for seq in [seq for seq in self._documents.get(session_id, {}) if seq != TITLE_SEQ]:
+                self._remove_document(session_id, seq)
+            if session_id in self._sequences:
+                self._sequences[session_id][0] = self._sequences[session_id][1]
+
+    def remove(self, session_id: str) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            for seq in list(self._documents.get(session_id, {})):
+                self._remove_document(session_id, seq)
+            self._documents.pop(session_id, None)
+            self._sequences.pop(session_id, None)
+
+    def search(self, query: str, limit: Optional[int] = 20, offset: int = 0,
+               prefix: bool = True) -> Tuple[List[Dict[str, Any]], int]:
+        """Rank sessions matching every query term; the last term also matches as a prefix
+
+        Returns ([{session_id, score, title_match, message_indexes}], total number of matches);
+        limit=None returns every match.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return [], 0
+
+        with self._lock:
+            self._ensure_loaded()
+            expansions = [[(term, 1.0)] for term in terms]
+            if prefix:
+                expansions[-1] = self._expand_prefix(terms[-1])
+
+            # Sessions must match every query position; start from the rarest one
+            candidates: Optional[Set[str]] = None
+            if len(expansions) > 1:
+                matches = []
+                for expansion in expansions:
+                    sessions: Set[str] = set()
+                    for term, _ in expansion:
+                        sessions.update(self._postings.get(term, ()))
+                    matches.append(sessions)
+                candidates = set.intersection(*sorted(matches, key=len))
+                if not candidates:
+                    return [], 0
+
+            # Term-at-a-time scoring: idf-weighted log term frequency, with a boost for title matches
+            total_sessions = max(1, len(self._documents))
+            scores: Dict[str, float] = {}
+            for expansion in expansions:
+                for term, weight in expansion:
+                    by_session = self._postings.get(term)
+                    if not by_session:
+                        continue
+                    df = len(by_session)
+                    term_weight = weight * math.log(1 + (total_sessions - df + 0.5) / (df + 0.5))
+                    for session_id, by_seq in by_session.items():
+                        if candidates is not None and session_id not in candidates:
+                            continue
+                        title_tf = by_seq.get(TITLE_SEQ, 0)
+                        message_tf = sum(by_seq.values()) - title_tf
+                        score = TITLE_BOOST if title_tf else 0.0
+                        if message_tf:
+                            score += 1 + math.log(message_tf)
+                        scores[session_id] = scores.get(session_id, 0.0) + term_weight * score
+
+            ranking_key = lambda item: (-item[1], item[0])
+            if limit is None:
+                ranked = sorted(scores.items(), key=ranking_key)[offset:]
+            else:
+                ranked = heapq.nsmallest(offset + limit, scores.items(), key=ranking_key)[offset:]
+
+            # Match details only for the returned page
+            results = []
+            for session_id, score in ranked:
+                sequences: Set[int] = set()
+                title_match = False
+                for expansion in expansions:
+                    for term, _ in expansion:
+                        by_seq = self._postings.get(term, {}).get(session_id)
+                        if by_seq:
+                            title_match = title_match or TITLE_SEQ in by_seq
+                            sequences.update(seq for seq in by_seq if seq != TITLE_SEQ)
+                first = self._sequences.get(session_id, [0, 0])[0]
+                results.append({
+                    "session_id": session_id,
+                    "score": round(score, 4),
+                    "title_match": title_match,
+                    "message_indexes": sorted(seq - first for seq in sequences),
+                })
+            return results, len(scores)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._documents),
+                "terms": len(self._postings),
+                "postings": sum(len(by_session) for by_session in self._postings.values()),
+            }
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        start = time.perf_counter()
+        self._loaded = True
+        for session_id, data in self.loader():
+            try:
+                self._index_document(session_id, data)
+            except Exception as e:
+                logger.error(f"Error indexing conversation {session_id}: {e}")
+        logger.info(f"Built search index with {len(self._documents)} sessions and {len(self._postings)} terms in "
+                    f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def _index_document(self, session_id: str, data: Dict[str, Any]) -> None:
+        for seq in list(self._documents.get(session_id, {})):
+            self._remove_document(session_id, seq)
+        messages = data.get("messages", [])
+        self._sequences[session_id] = [0, len(messages)]
+        title = (data.get("metadata") or {}).get("title")
+        if title:
+            self._add_document(session_id, TITLE_SEQ, title)
+        for seq, message in enumerate(messages):
+            self._add_document(session_id, seq, _message_text(message))
+
+    def _expand_prefix(self, term: str) -> List[Tuple[str, float]]:
+        expansion = [(term, 1.0)] if term in self._postings else []
+        start = bisect.bisect_right(self._vocabulary, term)
+        for candidate in self._vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+            if not candidate.startswith(term):
+                break
+            expansion.append((candidate, PREFIX_WEIGHT))
+        return expansion
+
+    def _add_document(self, session_id: str, seq: int, text: str) -> None:
+        counts = Counter(tokenize(text))
+        if not counts:
+            return
+        self._documents.setdefault(session_id, {})[seq] = counts
+        for token, tf in counts.items():
+            by_session = self._postings.get(token)
+            if by_session is None:
+                by_session = self._postings[token] = {}
+                bisect.insort(self._vocabulary, token)
+            by_session.setdefault(session_id, {})[seq] = tf
+
+    def _remove_document(self, session_id: str, seq: int) -> None:
+        documents = self._documents.get(session_id)
+        counts = documents.pop(seq, None) if documents else None
+        if counts is None:
+            return
+        for token in counts:
+            by_session = self._postings[token]
+            by_seq = by_session[session_id]
+            del by_seq[seq]
+            if not by_seq:
+                del by_session[session_id]
+            if not by_session:
+                del self._postings[token]
+                index = bisect.bisect_left(self._vocabulary, token)
+                if index < len(self._vocabulary) and self._vocabulary[index] == token:
+                    del self._vocabulary[index]
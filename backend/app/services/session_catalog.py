@@ -0,0 +1,190 @@
+# app/services/session_catalog.py
+import base64
+import bisect
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Sort key of a catalog entry: newest first when read from the end of the ordered list
+CatalogKey = Tuple[str, str]
+
+
+class InvalidCursorError(ValueError):
+    """Raised for a history cursor that wasn't produced by the catalog"""
+
+
+def catalog_entry(session_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """Compact summary of a conversation document (messages may be dicts or Message objects)"""
+    metadata = data.get("metadata") or {}
+    created_at = metadata.get("created_at") or data.get("last_access") or datetime.now().isoformat()
+    return {
+        "session_id": session_id,
+        "title": metadata.get("title", f"Conversation {session_id[:8]}"),
+        "created_at": created_at,
+        "last_access": data.get("last_access", created_at),
+        "message_count": len(data.get("messages", [])),
+        "tags": list(metadata.get("tags", [])),
+    }
+
+
+def encode_cursor(key: CatalogKey) -> str:
+    return base64.urlsafe_b64encode(f"{key[0]}|{key[1]}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> CatalogKey:
+    try:
+        created_at, session_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+    except Exception:
+        raise InvalidCursorError(f"Invalid history cursor: {cursor!r}")
+    return created_at, session_id
+
+
+class SessionCatalog:
+    """In-memory index of conversation summaries ordered by creation time
+
+    Built once from `loader` (one pass over storage) by `load()` at startup, or on first use
+    otherwise, and then kept up to date by `update`/`remove` on every write, so listing a page costs
+    time proportional to the page size. Sessions are also indexed per tag for filtered listings.
+
+    The catalog only sees writes made through this process: with several server processes sharing
+    one storage, each would list a stale set of sessions, so the API must run as a single process.
+    """
+
+    def __init__(self, loader: Callable[[], Iterator[Tuple[str, Dict[str, Any]]]]):
+        self.loader = loader
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._order: List[CatalogKey] = []
+        self._by_tag: Dict[str, List[CatalogKey]] = {}
+
+    def load(self) -> None:
+        """Build the catalog from storage now if it isn't built yet (blocking: one pass over storage)"""
+        with self._lock:
+            self._ensure_loaded()
+
+    def update(self, session_id: str, data: Dict[str, Any]) -> None:
+        """Insert or refresh the summary of a conversation document"""
+        entry = catalog_entry(session_id, data)
+        with self._lock:
+            self._ensure_loaded()
+            self._put(entry)
+
+    def remove(self, session_id: str) -> None:
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self._unindex(entry)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._entries.get(session_id)
+            return dict(entry) if entry is not None else None
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Copies of all catalog entries, in no particular order"""
+        with self._lock:
+            self._ensure_loaded()
+            return [dict(entry) for entry in self._entries.values()]
+
+    def count(self, tag: Optional[str] = None) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._keys(tag))
+
+    def page(self, limit: int, cursor: Optional[str] = None,
+             tag: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Newest-first page after `cursor`; returns (entries, cursor for the next page or None)"""
+        after = decode_cursor(cursor) if cursor else None
+        with self._lock:
+            self._ensure_loaded()
+            keys = self._keys(tag)
+            end = bisect.bisect_left(keys, after) if after is not None else len(keys)
+            start = max(0, end - limit)
+            page_keys = keys[start:end][::-1]
+            entries = [dict(self._entries[key[1]]) for key in page_keys]
+        next_cursor = encode_cursor(page_keys[-1]) if page_keys and start > 0 else None
+        return entries, next_cursor
+
+    def slice(self, limit: int, offset: int = 0, tag: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """Newest-first offset pagination; returns (entries, total count)"""
+        with self._lock:
+            self._ensure_loaded()
+            keys = self._keys(tag)
+            end = max(0, len(keys) - offset)
+            page_keys = keys[max(0, end - limit):end][::-1]
+            return [dict(self._entries[key[1]]) for key in page_keys], len(keys)
+
+    def expired(self, max_age_days: int) -> List[str]:
+        """Ids of sessions whose last access is more than max_age_days ago"""
+        now = datetime.now()
+        expired = []
+        with self._lock:
+            self._ensure_loaded()
+            entries = list(self._entries.values())
+        for entry in entries:
+            try:
+                last_access = datetime.fromisoformat(entry["last_access"].replace('Z', '+00:00'))
+                if (now - last_access.replace(tzinfo=None)).days > max_age_days:
+                    expired.append(entry["session_id"])
+            except (TypeError, ValueError):
+                continue
+        return expired
+
+    def invalidate(self) -> None:
+        """Drop the index so it is rebuilt from storage on next use"""
+        with self._lock:
+            self._loaded = False
+            self._entries, self._order, self._by_tag = {}, [], {}
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        start = time.perf_counter()
+        for session_id, data in self.loader():
+            try:
+                self._put(catalog_entry(session_id, data))
+            except Exception as e:
+                logger.error(f"Error indexing conversation {session_id}: {e}")
+        self._loaded = True
+        logger.info(f"Built session catalog with {len(self._entries)} sessions in "
+                    f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def _keys(self, tag: Optional[str]) -> List[CatalogKey]:
+        if tag is None:
+            return self._order
+        return self._by_tag.get(tag, [])
+
+    def _put(self, entry: Dict[str, Any]) -> None:
+        previous = self._entries.get(entry["session_id"])
+        self._entries[entry["session_id"]] = entry
+        if previous is not None:
+            if (previous["created_at"], previous["tags"]) == (entry["created_at"], entry["tags"]):
+                return
+            self._unindex(previous)
+        key = (entry["created_at"], entry["session_id"])
+        bisect.insort(self._order, key)
+        for tag in set(entry["tags"]):
+            bisect.insort(self._by_tag.setdefault(tag, []), key)
+
+    def _unindex(self, entry: Dict[str, Any]) -> None:
+        key = (entry["created_at"], entry["session_id"])
+        self._discard_key(self._order, key)
+        for tag in set(entry["tags"]):
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                self._discard_key(keys, key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    @staticmethod
+    def _discard_key(keys: List[CatalogKey], key: CatalogKey) -> None:
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
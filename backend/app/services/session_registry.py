@@ -0,0 +1,104 @@
+# app/services/session_registry.py
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SessionRegistry:
+    """LRU-bounded set of live conversation managers with write-behind flushing
+
+    Managers are created once per session by `factory` and kept in memory, so repeated requests
+    for a session don't reload it from storage. Their changes are written to storage in batches
+    by a background thread every `flush_interval` seconds (when > 0), when they are evicted, and
+    on `close()`. Evicted managers are detached: they flush and then write through, since a
+    request may still be using one.
+    """
+
+    def __init__(self, factory: Callable[[str], Any], max_sessions: int = 1000, flush_interval: float = 2.0):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.flush_interval = flush_interval
+        self._managers: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "flushes": 0, "sessions_flushed": 0}
+        self._flusher: Optional[threading.Thread] = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="session-flusher", daemon=True)
+            self._flusher.start()
+
+    def get(self, session_id: str) -> Any:
+        """Return the live manager for a session, loading it on first use"""
+        with self._lock:
+            manager = self._managers.get(session_id)
+            if manager is not None:
+                self._managers.move_to_end(session_id)
+                self.stats["hits"] += 1
+        if manager is not None:
+            manager.touch()
+            return manager
+
+        # Load outside the registry lock; if another request raced us, keep the first manager
+        manager = self.factory(session_id)
+        with self._lock:
+            existing = self._managers.get(session_id)
+            if existing is not None:
+                self._managers.move_to_end(session_id)
+                self.stats["hits"] += 1
+                return existing
+            self._managers[session_id] = manager
+            self.stats["misses"] += 1
+            evicted = []
+            while len(self._managers) > self.max_sessions:
+                evicted.append(self._managers.popitem(last=False)[1])
+                self.stats["evictions"] += 1
+
+        # Requests may still hold an evicted manager, so it writes through from now on
+        for old_manager in evicted:
+            old_manager.detach()
+        return manager
+
+    def discard(self, session_id: str) -> Optional[Any]:
+        """Forget a session without flushing it (e.g. before deleting it); returns its manager if live"""
+        with self._lock:
+            return self._managers.pop(session_id, None)
+
+    def flush_all(self) -> int:
+        """Write every dirty session to storage; returns the number of sessions written"""
+        start = time.perf_counter()
+        with self._lock:
+            managers = list(self._managers.values())
+        flushed = sum(1 for manager in managers if manager.flush())
+        with self._lock:
+            self.stats["flushes"] += 1
+            self.stats["sessions_flushed"] += flushed
+        if flushed:
+            logger.debug(f"Flushed {flushed} sessions in {(time.perf_counter() - start) * 1000:.1f} ms")
+        return flushed
+
+    def close(self) -> None:
+        """Stop the flusher thread and write out all pending changes"""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        self.flush_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["live_sessions"] = len(self._managers)
+            stats["dirty_sessions"] = sum(1 for manager in self._managers.values() if manager.is_dirty)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush_all()
+            except Exception as e:
+                logger.error(f"Error flushing sessions: {e}")
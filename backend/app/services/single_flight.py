@@ -0,0 +1,48 @@
+# app/services/single_flight.py
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Shares one in-flight computation between concurrent calls with the same key
+
+    The first caller starts the computation as its own task; callers arriving while it runs await
+    the same task and get its result (or exception). A caller that is cancelled (e.g. its client
+    disconnected) stops waiting without cancelling the computation for the others. Nothing is kept
+    once the computation finishes, so later calls compute afresh.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Task] = {}
+        self.stats = {"calls": 0, "executions": 0, "coalesced": 0, "failed": 0}
+
+    async def run(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """(result, coalesced) of compute(), sharing a computation already running for key"""
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        self.stats["calls"] += 1
+        task = self._inflight.get(flight_key)
+        coalesced = task is not None
+        if coalesced:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["executions"] += 1
+            task = loop.create_task(compute())
+            self._inflight[flight_key] = task
+            task.add_done_callback(lambda done: self._finish(flight_key, done))
+        return await asyncio.shield(task), coalesced
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "in_flight": len(self._inflight)}
+
+    def _finish(self, flight_key: Tuple[asyncio.AbstractEventLoop, Hashable], task: asyncio.Task) -> None:
+        if self._inflight.get(flight_key) is task:
+            del self._inflight[flight_key]
+        # Retrieve the exception here too, so it isn't reported as unhandled when every caller gave up
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["failed"] += 1
+            logger.debug(f"Shared {self.name} computation failed: {task.exception()}")
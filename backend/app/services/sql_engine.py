@@ -0,0 +1,283 @@
+# app/services/sql_engine.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Iterator, List, Optional, Tuple
+from urllib.request import pathname2url
+
+import pandas as pd
+
+from app.services.code_cache import normalize_text
+from app.services.code_executor import ExecutionTimeoutError
+from app.services.dataset_cache import source_signature, source_unchanged
+from app.services.dataset_context import MAX_CATEGORY_VALUES
+from app.services.dataset_store import DatasetStore
+from app.services.expression_compiler import UnsafeExpressionError
+
+logger = logging.getLogger(__name__)
+
+ENGINE_PANDAS = "pandas"
+ENGINE_SQL = "sql"
+ENGINES = (ENGINE_PANDAS, ENGINE_SQL)
+
+# Generated SQL reads this table; the source signature is kept in a table queries can't read
+SQL_TABLE = "data"
+SOURCE_TABLE = "_source"
+IMPORT_CHUNK_ROWS = 50_000
+
+SELECT_PATTERN = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+
+# Authorizer whitelist: queries may only read, never write, attach, or change settings
+_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+
+def default_database_path(source_path: str) -> str:
+    """SQLite file written next to the source file"""
+    return f"{source_path}.sqlite"
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _read_chunks(source_path: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    if source_path.lower().endswith(".csv"):
+        yield from pd.read_csv(source_path, chunksize=chunk_rows)
+        return
+    # openpyxl can't stream into pandas, so a spreadsheet is read whole once and written in chunks
+    df = pd.read_excel(source_path, engine='openpyxl')
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+
+def _stored_signature(database_path: str) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(database_path):
+        return None
+    try:
+        with closing(sqlite3.connect(database_path)) as conn:
+            row = conn.execute(f"SELECT signature FROM {SOURCE_TABLE}").fetchone()
+        return json.loads(row[0]) if row else None
+    except (sqlite3.Error, ValueError):
+        return None
+
+
+def build_database(source_path: str, database_path: Optional[str] = None, chunk_rows: int = IMPORT_CHUNK_ROWS) -> str:
+    """Import a CSV or spreadsheet into a SQLite file, unless it was already imported from the same file
+
+    CSV files are imported in chunks of `chunk_rows`, so they never have to fit in memory.
+    """
+    database_path = database_path or default_database_path(source_path)
+    stored = _stored_signature(database_path)
+    if stored is not None and source_unchanged(source_path, stored):
+        return database_path
+
+    start = time.perf_counter()
+    signature = source_signature(source_path)
+    tmp_path = f"{database_path}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        rows = 0
+        with closing(sqlite3.connect(tmp_path)) as conn:
+            for chunk in _read_chunks(source_path, chunk_rows):
+                chunk.to_sql(SQL_TABLE, conn, if_exists="append", index=False)
+                rows += len(chunk)
+            conn.execute(f"CREATE TABLE {SOURCE_TABLE} (signature TEXT)")
+            conn.execute(f"INSERT INTO {SOURCE_TABLE} VALUES (?)", (json.dumps(signature),))
+            conn.commit()
+        # Queries still reading the old file keep it open until they finish
+        os.replace(tmp_path, database_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logger.info(f"Imported {source_path} ({rows} rows) into {database_path} in "
+                f"{(time.perf_counter() - start) * 1000:.1f} ms")
+    return database_path
+
+
+def connect_readonly(database_path: str, cache_mb: float = 64) -> sqlite3.Connection:
+    """Read-only connection whose statements may only read; sorts and temp tables spill to disk"""
+    conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(database_path))}?mode=ro", uri=True,
+                           check_same_thread=False)
+    conn.execute(f"PRAGMA cache_size = {-int(cache_mb * 1024)}")
+    conn.execute("PRAGMA temp_store = FILE")
+    conn.set_authorizer(_authorize)
+    return conn
+
+
+def _authorize(action: int, arg1: Optional[str], arg2: Optional[str], database: Optional[str],
+               trigger: Optional[str]) -> int:
+    if action not in _ALLOWED_ACTIONS:
+        return sqlite3.SQLITE_DENY
+    if action == sqlite3.SQLITE_READ and arg1 in (SOURCE_TABLE, "sqlite_master", "sqlite_schema"):
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+def validate_sql(sql: str) -> str:
+    """The statement without a trailing semicolon; raises UnsafeExpressionError unless it is one SELECT"""
+    statement = sql.strip().rstrip(";").strip()
+    if not SELECT_PATTERN.match(statement):
+        raise UnsafeExpressionError("Only a single SELECT statement is allowed")
+    if ";" in statement and sqlite3.complete_statement(statement.split(";")[0] + ";"):
+        raise UnsafeExpressionError("Only a single SELECT statement is allowed")
+    return statement
+
+
+@dataclass(frozen=True)
+class SqlDatasetContext:
+    """Schema details and prerendered prompt fragments for one version of a dataset in a SQLite file"""
+    database_path: str
+    version: int
+    columns: List[str]
+    shape: Tuple[int, int]
+    dtypes: Dict[str, str]
+    fingerprint: str
+    category_values: FrozenSet[str]
+    # Prompt fragments, rendered once per data version
+    columns_text: str
+    sample_text_2: str
+    sample_text_3: str
+    classify_schema: str
+    codegen_schema: str
+    name: str = "default"
+
+
+def build_sql_context(database_path: str, version: int = 1, name: str = "default") -> SqlDatasetContext:
+    """Read the schema, row count, samples and low-cardinality text values of an imported dataset"""
+    table = quote_identifier(SQL_TABLE)
+    with closing(sqlite3.connect(database_path)) as conn:
+        info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        columns = [row[1] for row in info]
+        dtypes = {row[1]: row[2] or "ANY" for row in info}
+        rows = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        sample = pd.read_sql_query(f"SELECT * FROM {table} LIMIT 3", conn)
+
+        values = set()
+        for column, dtype in dtypes.items():
+            if dtype.upper() != "TEXT":
+                continue
+            uniques = conn.execute(
+                f"SELECT DISTINCT {quote_identifier(column)} FROM {table} "
+                f"WHERE {quote_identifier(column)} IS NOT NULL LIMIT {MAX_CATEGORY_VALUES + 1}"
+            ).fetchall()
+            if len(uniques) <= MAX_CATEGORY_VALUES:
+                values.update(normalize_text(str(value)) for (value,) in uniques)
+        values.discard("")
+
+    columns_text = str(columns)
+    sample_text_2 = sample.head(2).to_string()
+    sample_text_3 = sample.to_string()
+    fingerprint = hashlib.sha256(json.dumps([ENGINE_SQL, columns, dtypes]).encode("utf-8")).hexdigest()
+    return SqlDatasetContext(
+        database_path=database_path,
+        version=version,
+        columns=columns,
+        shape=(rows, len(columns)),
+        dtypes=dtypes,
+        fingerprint=fingerprint,
+        category_values=frozenset(values),
+        columns_text=columns_text,
+        sample_text_2=sample_text_2,
+        sample_text_3=sample_text_3,
+        classify_schema=(
+            f"- SQL table {table} with columns: {columns_text}\n"
+            f"        - Sample data (first 2 rows):\n"
+            f"        {sample_text_2}"
+        ),
+        codegen_schema=(
+            f"- Table: {table} with {rows} rows\n"
+            f"    - Columns and SQLite types: {dtypes}\n"
+            f"    - Sample data (first 3 rows):\n"
+            f"    {sample_text_3}"
+        ),
+        name=name,
+    )
+
+
+class SqlDatasetStore(DatasetStore):
+    """DatasetStore whose snapshots live in a SQLite file next to the source instead of in memory
+
+    A snapshot is a SqlDatasetContext; the import is reused across restarts while the source file
+    is unchanged, and redone (then swapped in) when the watcher sees it change.
+    """
+
+    def __init__(self, source_path: str, database_path: Optional[str] = None, reload_interval: float = 0,
+                 name: str = "default"):
+        self.database_path = database_path or default_database_path(source_path)
+        super().__init__(source_path, lambda: build_database(source_path, self.database_path),
+                         reload_interval=reload_interval, name=name)
+
+    def _build_context(self, database_path: str, version: int) -> SqlDatasetContext:
+        return build_sql_context(database_path, version, self.name)
+
+
+class SqlEngine:
+    """Runs generated SQL against dataset files on a thread, read-only, with a time and row limit
+
+    SQLite executes the query out of core; only the result rows (at most `max_rows`) are
+    materialized. A 1x1 result comes back as a plain value, like a pandas aggregation would.
+    """
+
+    def __init__(self, timeout_seconds: float = 10, max_rows: int = 100_000, cache_mb: float = 64):
+        self.timeout_seconds = timeout_seconds
+        self.max_rows = max_rows
+        self.cache_mb = cache_mb
+        self._lock = threading.Lock()
+        self.stats = {"queries": 0, "completed": 0, "failed": 0, "timed_out": 0, "truncated": 0, "total_ms": 0.0}
+
+    async def run(self, sql: str, dataset: SqlDatasetContext) -> Tuple[Any, bool]:
+        """(result, truncated) of a query; raises ExecutionTimeoutError past the timeout"""
+        return await asyncio.to_thread(self.execute, sql, dataset.database_path)
+
+    def execute(self, sql: str, database_path: str) -> Tuple[Any, bool]:
+        statement = validate_sql(sql)
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.timeout_seconds
+        with self._lock:
+            self.stats["queries"] += 1
+        try:
+            with closing(connect_readonly(database_path, self.cache_mb)) as conn:
+                conn.set_progress_handler(lambda: int(time.monotonic() > deadline), 10_000)
+                cursor = conn.execute(statement)
+                columns = [description[0] for description in cursor.description]
+                rows = cursor.fetchmany(self.max_rows + 1)
+        except sqlite3.OperationalError as e:
+            if time.monotonic() > deadline:
+                with self._lock:
+                    self.stats["timed_out"] += 1
+                raise ExecutionTimeoutError(f"Query exceeded {self.timeout_seconds}s") from e
+            self._count_failure()
+            raise
+        except Exception:
+            self._count_failure()
+            raise
+
+        truncated = len(rows) > self.max_rows
+        with self._lock:
+            self.stats["completed"] += 1
+            self.stats["truncated"] += int(truncated)
+            self.stats["total_ms"] += (time.perf_counter() - start) * 1000
+        if truncated:
+            logger.warning(f"SQL result truncated to {self.max_rows} rows")
+            rows = rows[:self.max_rows]
+        if len(rows) == 1 and len(columns) == 1:
+            return rows[0][0], False
+        return pd.DataFrame.from_records(rows, columns=columns), truncated
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "total_ms": round(self.stats["total_ms"], 3)}
+
+    def _count_failure(self) -> None:
+        with self._lock:
+            self.stats["failed"] += 1
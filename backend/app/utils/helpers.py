@@ -2,6 +2,8 @@ import re
 import pandas as pd
 import logging
 
+from app.services.result_store import frame_records, series_frame
+
 logger = logging.getLogger(__name__)
 
 def clean_code_string(code_string):
@@ -10,19 +12,19 @@ def clean_code_string(code_string):
     code = re.sub(r'```\s*', '', code_string)
     return code.strip()
 
-def format_result(result):
-    """Format a pandas result object for API response"""
+def format_result(result, preview_rows=20):
+    """Format a pandas result object for API response
+    
+    Tables are cut to a preview of preview_rows rows; the full table is served page by page from
+    the result store (see app.services.result_store). Series longer than the preview are cut the
+    same way, as a table of labels and values.
+    """
+    if isinstance(result, pd.Series) and len(result) > preview_rows:
+        result = series_frame(result)
     if isinstance(result, pd.DataFrame):
-        # Limit large result sets
-        if len(result) > 100:
-            result = result.head(100)
-            limited_result = True
-        else:
-            limited_result = False
-            
-        result_data = result.to_dict(orient="records")
-        if limited_result:
-            result_note = f"(Showing first 100 of {len(result)} results)"
+        result_data = frame_records(result.head(preview_rows))
+        if len(result) > preview_rows:
+            result_note = f"(Showing first {preview_rows} of {len(result)} results)"
         else:
             result_note = f"(Found {len(result)} results)"
             
@@ -33,4 +35,4 @@ def format_result(result):
         result_data = result
         result_note = ""
     
-    return result_data, result_note
\ No newline at end of file
+    return result_data, result_note
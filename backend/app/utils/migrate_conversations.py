@@ -0,0 +1,28 @@
+"""One-shot migration of conversations between storage backends
+
+Usage (from the backend directory):
+    python -m app.utils.migrate_conversations --source-dir data/conversations --sqlite-path data/conversations.db
+"""
+import argparse
+import logging
+
+from app.services.conversation_storage import JsonFileStorage, SqliteStorage, migrate_conversations
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate JSON conversation files into the SQLite backend")
+    parser.add_argument("--source-dir", default="data/conversations", help="Directory of <session_id>.json files")
+    parser.add_argument("--sqlite-path", default="data/conversations.db", help="Target SQLite database")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    source = JsonFileStorage(args.source_dir)
+    target = SqliteStorage(args.sqlite_path)
+    migrated = migrate_conversations(source, target)
+    logger.info(f"Migrated {migrated} of {source.count()} conversations into {args.sqlite_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,3 +12,22 @@ def client():
     """Fixture to provide the TestClient for making requests."""
     client = TestClient(app)
     yield client
+
+@pytest.fixture(autouse=True)
+def isolated_code_cache(monkeypatch):
+    """Use a fresh in-memory generated-code cache per test so cached code doesn't leak between tests."""
+    from app.services import data_service
+    from app.services.code_cache import GeneratedCodeCache
+    cache = GeneratedCodeCache(path=None)
+    monkeypatch.setattr(data_service, "code_cache", cache)
+    yield cache
+
+
+@pytest.fixture(autouse=True)
+def isolated_result_cache(monkeypatch):
+    """Use a fresh result cache per test so memoized results don't leak between tests."""
+    from app.services import data_service
+    from app.services.result_cache import ResultCache
+    cache = ResultCache()
+    monkeypatch.setattr(data_service, "result_cache", cache)
+    yield cache
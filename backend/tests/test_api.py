@@ -1,6 +1,9 @@
 from fastapi.testclient import TestClient
 from app.main import app
-from app.services.conversation_service import ConversationManager, conversation_store
+from app.services.conversation_service import (
+    ConversationManager, conversation_store, get_conversation_manager, delete_conversation
+)
+import json
 import uuid
 
 # Initialize TestClient
@@ -45,6 +48,37 @@ def test_get_session_history():
     assert len(history) > 0
     assert history[0]["sessionId"] == session_id
 
+def test_session_history_cursor_pagination():
+    """Test paging through session history with the returned cursor."""
+    session_ids = [str(uuid.uuid4()) for _ in range(3)]
+    for session_id in session_ids:
+        get_conversation_manager(session_id).add_message("Test message", "Test response")
+
+    first = client.get("/sessions/history", params={"limit": 2}).json()
+    assert [item["sessionId"] for item in first["history"]] == session_ids[::-1][:2]
+    assert first["history"][0]["messageCount"] == 2
+    second = client.get("/sessions/history", params={"limit": 2, "cursor": first["nextCursor"]}).json()
+    assert second["history"][0]["sessionId"] == session_ids[0]
+    assert client.get("/sessions/history", params={"cursor": "bogus"}).status_code == 400
+
+    for session_id in session_ids:
+        delete_conversation(session_id)
+
+def test_search_sessions():
+    """Test full-text search over conversation messages."""
+    session_id = str(uuid.uuid4())
+    get_conversation_manager(session_id).add_message("How many zebrafish analysts do we have?", "There are 3.")
+
+    response = client.get("/sessions/search", params={"q": "zebrafi"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 1
+    assert body["results"][0]["sessionId"] == session_id
+    assert body["results"][0]["titleMatch"] is True
+
+    delete_conversation(session_id)
+    assert client.get("/sessions/search", params={"q": "zebrafish"}).json()["total"] == 0
+
 def test_delete_session():
     """Test deleting a session."""
     # Manually create a session for testing
@@ -62,3 +96,116 @@ def test_delete_session():
 
     # Check if session is removed from store
     assert session_id not in conversation_store
+
+def test_query_stream(monkeypatch):
+    """Test that /query/stream emits stage events, answer tokens and a final response."""
+    from app.services.llm_provider import LocalStubProvider
+    provider = LocalStubProvider()
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+
+    session_id = str(uuid.uuid4())
+    response = client.post("/query/stream", json={"query": "Average salary by department?", "session_id": session_id})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = [line[len("event: "):] for line in response.text.splitlines() if line.startswith("event: ")]
+    assert events[:3] == ["classified", "code_generated", "result_computed"]
+    assert events.count("token") > 1
+    assert events[-1] == "done"
+    done = json.loads(response.text.strip().splitlines()[-1][len("data: "):])
+    assert done["data_version"] >= 1
+
+    # The final answer is recorded in the conversation
+    messages = get_conversation_manager(session_id).get_messages()
+    assert messages[-1].text == "The average salary varies by department."
+    assert messages[-1].source == "dataframe"
+    delete_conversation(session_id)
+
+def test_query_stream_conversation_tokens_match_stored_answer(monkeypatch):
+    """Test that streamed conversation tokens are cleaned the same way as the stored answer."""
+    from app.services.llm_provider import LocalStubProvider, STAGE_CONVERSATION
+    provider = LocalStubProvider(script={STAGE_CONVERSATION: "BRIEF: Hello! How can I help you today?"})
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+
+    session_id = str(uuid.uuid4())
+    response = client.post("/query/stream", json={"query": "Hi there!", "session_id": session_id})
+    payloads = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    streamed = "".join(payload["text"] for payload in payloads if "text" in payload)
+    assert streamed == "Hello! How can I help you today?"
+    assert payloads[-1]["answer"] == streamed
+    assert get_conversation_manager(session_id).get_messages()[-1].text == streamed
+    delete_conversation(session_id)
+
+def test_query_stream_saves_exchange_after_disconnect(monkeypatch):
+    """Test that the streamed exchange is still saved when the client goes away after the first event."""
+    import asyncio
+    from app.api import endpoints
+    from app.models.schema import QueryRequest
+    from app.services.llm_provider import LocalStubProvider
+    provider = LocalStubProvider(latency="fixed:0.02")
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+    session_id = str(uuid.uuid4())
+
+    async def disconnect_early():
+        response = await endpoints.query_stream(QueryRequest(query="Average salary by department?", session_id=session_id))
+        body = response.body_iterator
+        first = await body.__anext__()
+        await body.aclose()
+        await asyncio.gather(*endpoints._stream_tasks)
+        return first
+
+    assert asyncio.run(disconnect_early()).startswith("event: classified")
+    messages = get_conversation_manager(session_id).get_messages()
+    assert messages[-1].text == "The average salary varies by department."
+    delete_conversation(session_id)
+
+def test_query_unknown_dataset():
+    """Test that naming an unregistered dataset is rejected and registered ones are listed."""
+    response = client.post("/query", json={"query": "average salary", "dataset": "no-such-dataset"})
+    assert response.status_code == 404
+
+    datasets = client.get("/datasets").json()
+    assert datasets["default"] in [dataset["name"] for dataset in datasets["datasets"]]
+
+    report = client.get(f"/datasets/{datasets['default']}/memory").json()
+    assert report["dataset"] == datasets["default"]
+    assert report["bytesAfter"] == sum(column["bytesAfter"] for column in report["columns"])
+    assert client.get("/datasets/no-such-dataset/memory").status_code == 404
+
+def test_result_pages():
+    """Test paging through a stored table result and the 404 for an unknown handle."""
+    import pandas as pd
+    from app.services import data_service
+    frame = pd.DataFrame({"Name": [f"Employee {i}" for i in range(45)], "Rating": [None] + [4.0] * 44})
+    result_id = data_service.result_store.put(frame)
+
+    first = client.get(f"/results/{result_id}", params={"limit": 20}).json()
+    assert first["total"] == 45 and first["nextOffset"] == 20
+    assert first["rows"][0] == {"Name": "Employee 0", "Rating": None}
+    last = client.get(f"/results/{result_id}", params={"offset": 40, "limit": 20}).json()
+    assert [row["Name"] for row in last["rows"]] == [f"Employee {i}" for i in range(40, 45)]
+    assert last["nextOffset"] is None
+
+    assert client.get("/results/missing").status_code == 404
+
+def test_result_page_encodings():
+    """Test columnar result pages, gzip above the size threshold and the Arrow fallback."""
+    import pandas as pd
+    from app.services import data_service
+    from app.services.result_encoding import COLUMNAR_MEDIA_TYPE, ARROW_STREAM_MEDIA_TYPE, arrow_available
+    frame = pd.DataFrame({"Name": [f"Employee {i}" for i in range(100)], "Salary": [50000.5] * 99 + [None]})
+    result_id = data_service.result_store.put(frame)
+
+    response = client.get(f"/results/{result_id}", params={"limit": 100},
+                          headers={"Accept": COLUMNAR_MEDIA_TYPE, "Accept-Encoding": "gzip"})
+    assert response.headers["content-type"].startswith(COLUMNAR_MEDIA_TYPE)
+    assert response.headers["content-encoding"] == "gzip"
+    page = response.json()
+    assert page["columns"] == ["Name", "Salary"] and page["total"] == 100
+    assert page["data"][0][99] == "Employee 99" and page["data"][1][99] is None
+
+    small = client.get(f"/results/{result_id}", params={"limit": 1}, headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+
+    arrow = client.get(f"/results/{result_id}", headers={"Accept": ARROW_STREAM_MEDIA_TYPE})
+    assert arrow.status_code == (200 if arrow_available() else 406)
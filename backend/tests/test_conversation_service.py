@@ -0,0 +1,268 @@
+import os
+from datetime import datetime, timedelta
+import pytest
+from app.services.conversation_storage import JsonFileStorage, JsonlLogStorage, SqliteStorage, migrate_conversations
+from app.services.search_index import ConversationSearchIndex
+from app.services.session_catalog import InvalidCursorError, SessionCatalog
+
+
+def make_conversation(title, created_at, last_access=None, tags=None, messages=None):
+    return {
+        "messages": messages or [
+            {"text": f"question about {title}", "sender": "user", "timestamp": created_at, "source": None, "isError": None},
+            {"text": "answer", "sender": "assistant", "timestamp": created_at, "source": "dataframe", "isError": False},
+        ],
+        "last_access": last_access or created_at,
+        "context": {"last_result": {"IT": 1}},
+        "metadata": {"created_at": created_at, "title": title, "tags": tags or []},
+    }
+
+
+@pytest.fixture(params=["json", "sqlite", "jsonl"])
+def storage(request, tmp_path):
+    if request.param == "json":
+        return JsonFileStorage(str(tmp_path / "conversations"))
+    if request.param == "jsonl":
+        return JsonlLogStorage(str(tmp_path / "conversation_logs"))
+    return SqliteStorage(str(tmp_path / "conversations.db"))
+
+
+def test_storage_round_trip(storage):
+    """Test that both backends persist and reload the same conversation document."""
+    data = make_conversation("Salaries", "2025-03-01T10:00:00")
+    storage.save("s1", data)
+    assert storage.load("s1") == data
+    assert storage.load("missing") is None
+    assert storage.count() == 1
+
+    storage.delete("s1")
+    assert storage.load("s1") is None
+    assert storage.count() == 0
+
+
+def test_storage_list_filter_search_and_cleanup(storage, tmp_path):
+    """Test listing, tag filtering, search, cleanup and backup on both backends."""
+    now = datetime.now()
+    storage.save("a", make_conversation("Salaries", (now - timedelta(days=2)).isoformat(), tags=["hr"]))
+    storage.save("b", make_conversation("Departments", (now - timedelta(days=1)).isoformat()))
+    storage.save("c", make_conversation("Old chat", (now - timedelta(days=40)).isoformat()))
+
+    page, total = storage.list_summaries(limit=2, offset=0)
+    assert total == 3
+    assert [c["session_id"] for c in page] == ["b", "a"]
+    assert page[0]["message_count"] == 2
+
+    assert [c["session_id"] for c in storage.list_summaries(10, 0, filter_tag="hr")[0]] == ["a"]
+    assert [c["session_id"] for c in storage.list_summaries(10, 0, search_query="DEPART")[0]] == ["b"]
+
+    backup_path = tmp_path / "backup"
+    backup_path.mkdir()
+    assert storage.backup(str(backup_path)) == 3
+    assert os.listdir(backup_path)
+
+    if isinstance(storage, JsonFileStorage):
+        # The JSON backend also considers file modification time
+        os.utime(os.path.join(storage.storage_dir, "c.json"), (0, 0))
+    assert storage.cleanup(max_age_days=30) == 1
+    assert storage.load("c") is None
+
+
+def test_storage_append_trim_and_state_updates(storage):
+    """Test that appended, trimmed and state-only writes reload as the full document on every backend."""
+    data = make_conversation("Salaries", "2025-03-01T10:00:00")
+    storage.save("s1", data)
+    for i in range(3):
+        new_messages = [
+            {"text": f"follow-up {i}", "sender": "user", "timestamp": "t", "source": None, "isError": None},
+            {"text": str(i), "sender": "assistant", "timestamp": "t", "source": "dataframe", "isError": False},
+        ]
+        trimmed = 2 if i else 0
+        data["messages"] = data["messages"][trimmed:] + new_messages
+        storage.append_messages("s1", data, new_messages, trimmed=trimmed)
+    data["metadata"]["tags"] = ["hr"]
+    storage.update_state("s1", data)
+
+    assert storage.load("s1") == data
+    assert storage.list_summaries(10, 0)[0][0]["message_count"] == 4
+    # Search still looks at the leading messages after a trim
+    assert [c["session_id"] for c in storage.list_summaries(10, 0, search_query="follow-up 1")[0]] == ["s1"]
+
+
+def test_migrate_json_to_sqlite(tmp_path):
+    """Test the one-shot migration from the JSON directory into SQLite."""
+    source = JsonFileStorage(str(tmp_path / "conversations"))
+    for i in range(3):
+        source.save(f"s{i}", make_conversation(f"Chat {i}", f"2025-03-0{i + 1}T10:00:00"))
+
+    target = SqliteStorage(str(tmp_path / "conversations.db"))
+    assert migrate_conversations(source, target) == 3
+    assert target.load("s1") == source.load("s1")
+
+
+def test_jsonl_log_replay_compaction_and_torn_tail(tmp_path):
+    """Test that appends replay over the snapshot, survive compaction and ignore a torn last line."""
+    storage = JsonlLogStorage(str(tmp_path / "logs"), compact_after=1000)
+    data = make_conversation("Salaries", "2025-03-01T10:00:00")
+    storage.save("s1", data)
+
+    new_messages = [
+        {"text": "and the max?", "sender": "user", "timestamp": "t", "source": None, "isError": None},
+        {"text": "90000", "sender": "assistant", "timestamp": "t", "source": "dataframe", "isError": False},
+    ]
+    data["messages"] = data["messages"][2:] + new_messages
+    data["last_access"] = "2025-03-02T10:00:00"
+    storage.append_messages("s1", data, new_messages, trimmed=2)
+    data["metadata"]["tags"] = ["hr"]
+    storage.update_state("s1", data)
+    assert storage.load("s1") == data
+
+    assert storage.compact("s1")
+    assert not os.path.exists(storage._log_path("s1"))
+    assert storage.load("s1") == data
+
+    # A crash mid-write leaves a partial line; it is skipped on replay
+    storage.update_state("s1", dict(data, last_access="2025-03-03T10:00:00"))
+    with open(storage._log_path("s1"), "a") as f:
+        f.write('{"seq": 99, "op": "sta')
+    reopened = JsonlLogStorage(str(tmp_path / "logs"))
+    assert reopened.load("s1")["last_access"] == "2025-03-03T10:00:00"
+    assert reopened.load("s1")["messages"] == new_messages
+
+
+def test_jsonl_background_compaction(tmp_path):
+    """Test that long logs are folded into the snapshot by the compaction thread."""
+    storage = JsonlLogStorage(str(tmp_path / "logs"), compact_after=5)
+    data = make_conversation("Salaries", "2025-03-01T10:00:00")
+    for i in range(6):
+        data["last_access"] = f"2025-03-0{i + 1}T10:00:00"
+        storage.update_state("s1", data)
+    storage._compaction_queue.join()
+
+    assert storage.stats["compactions"] >= 1
+    assert storage.load("s1")["last_access"] == "2025-03-06T10:00:00"
+    storage.close()
+
+
+def test_session_registry_write_behind(tmp_path, monkeypatch):
+    """Test that live sessions are reused from memory and only written on flush or eviction."""
+    from app.services import conversation_service
+    from app.services.conversation_service import ConversationManager
+    from app.services.session_registry import SessionRegistry
+    storage = JsonlLogStorage(str(tmp_path / "logs"))
+    monkeypatch.setattr(conversation_service, "storage", storage)
+    monkeypatch.setattr(conversation_service, "session_catalog", SessionCatalog(storage.iter_conversations))
+    monkeypatch.setattr(conversation_service, "search_index", ConversationSearchIndex(storage.iter_conversations))
+    registry = SessionRegistry(lambda sid: ConversationManager(sid, write_behind=True), max_sessions=2, flush_interval=0)
+
+    manager = registry.get("s1")
+    assert registry.get("s1") is manager
+    manager.add_message("Average salary?", "About 70000", {"mean": 70000})
+    assert storage.load("s1") is None
+
+    assert registry.flush_all() == 1
+    assert [msg["text"] for msg in storage.load("s1")["messages"]] == ["Average salary?", "About 70000"]
+    assert registry.flush_all() == 0
+
+    # Evicting the least recently used session writes its pending changes
+    manager.add_message("And the max?", "90000")
+    registry.get("s2")
+    registry.get("s3")
+    assert len(storage.load("s1")["messages"]) == 4
+    stats = registry.get_stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["live_sessions"]) == (1, 3, 1, 2)
+
+    # A request still holding the evicted manager writes through instead of losing its changes
+    manager.add_message("And the min?", "30000")
+    assert not manager.is_dirty
+    assert len(registry.get("s1").get_messages()) == 6
+
+
+def test_session_catalog_cursor_pagination_and_tags(tmp_path):
+    """Test that the catalog is built from storage once and pages newest first by cursor."""
+    storage = JsonFileStorage(str(tmp_path / "conversations"))
+    for i in range(5):
+        storage.save(f"s{i}", make_conversation(f"Chat {i}", f"2025-03-0{i + 1}T10:00:00", tags=["hr"] if i % 2 else []))
+    scans = []
+    catalog = SessionCatalog(lambda: scans.append(1) or storage.iter_conversations())
+    # Built up front (as at startup), so later reads don't scan storage
+    catalog.load()
+    assert len(scans) == 1
+
+    page, cursor = catalog.page(limit=2)
+    assert [c["session_id"] for c in page] == ["s4", "s3"]
+    assert page[0]["message_count"] == 2 and page[0]["title"] == "Chat 4"
+    page, cursor = catalog.page(limit=2, cursor=cursor)
+    assert [c["session_id"] for c in page] == ["s2", "s1"]
+    page, cursor = catalog.page(limit=2, cursor=cursor)
+    assert [c["session_id"] for c in page] == ["s0"] and cursor is None
+
+    assert [c["session_id"] for c in catalog.page(limit=10, tag="hr")[0]] == ["s3", "s1"]
+    assert catalog.slice(limit=2, offset=1) == (catalog.page(limit=3)[0][1:], 5)
+
+    # Writes keep the index current without touching storage
+    catalog.update("s5", make_conversation("New", "2025-03-09T10:00:00", tags=["hr"]))
+    catalog.remove("s3")
+    assert [c["session_id"] for c in catalog.page(limit=10, tag="hr")[0]] == ["s5", "s1"]
+    assert catalog.count() == 5
+    assert len(scans) == 1
+
+    with pytest.raises(InvalidCursorError):
+        catalog.page(limit=2, cursor="not a cursor")
+
+
+def test_search_index_ranking_prefix_and_trimming(tmp_path):
+    """Test ranked, prefix and incremental full-text search over titles and messages."""
+    storage = JsonFileStorage(str(tmp_path / "conversations"))
+    storage.save("a", make_conversation("Salary review", "2025-03-01T10:00:00"))
+    storage.save("b", make_conversation("Departments", "2025-03-02T10:00:00"))
+    index = ConversationSearchIndex(storage.iter_conversations)
+
+    # Built from storage on first use; title matches rank above message-only matches
+    index.add_messages("b", ["Which department has the highest salary?", "Engineering"])
+    results, total = index.search("salary")
+    assert total == 2
+    assert [r["session_id"] for r in results] == ["a", "b"]
+    assert results[0]["title_match"] and results[1]["message_indexes"] == [2]
+
+    # Every term must match; the last one also matches as a prefix
+    assert [r["session_id"] for r in index.search("engineering sal")[0]] == ["b"]
+    assert index.search("engineering sal", prefix=False)[1] == 0
+    assert index.search("the")[1] == 0
+
+    # Trimmed and deleted messages leave the index
+    index.add_messages("b", ["Headcount?", "42"], trimmed=4)
+    assert index.search("engineering")[1] == 0
+    assert index.search("headcount")[0][0]["message_indexes"] == [0]
+    index.remove("a")
+    assert [r["session_id"] for r in index.search("salary")[0]] == []
+    assert index.get_stats()["sessions"] == 1
+
+    # New messages of a conversation the index hadn't seen are numbered after its stored ones;
+    # "IT" is a searchable department name
+    index.set_title("c", "Budgets")
+    index.add_messages("c", ["Budget of IT?", "1.2M"], message_count=6)
+    assert index.search("it")[0][0]["message_indexes"] == [4]
+
+
+def test_expiry_scheduler_only_expires_due_sessions():
+    """Test heap-based expiry: touched sessions move back, seeded sessions are scheduled once."""
+    from app.services.expiry_scheduler import ExpiryScheduler
+    released, deleted = [], []
+    scheduler = ExpiryScheduler(interval=0, seed=lambda: [("stored", 0.0), ("live", 0.0)])
+    scheduler.add_policy("idle", 100, released.append)
+    scheduler.add_policy("retention", 1000, deleted.append, seeded=True, automatic=False)
+
+    scheduler.touch("live", 500.0)
+    scheduler.touch("other", 10.0)
+    scheduler.touch("other", 50.0)
+
+    assert scheduler.sweep(now=160.0, automatic_only=True) == {"idle": 1}
+    assert released == ["other"]
+    # "live" was touched after the seeded timestamp, so its retention deadline is later
+    assert scheduler.sweep(now=1200.0) == {"idle": 1, "retention": 2}
+    assert released == ["other", "live"] and deleted == ["stored", "other"]
+
+    stats = scheduler.get_stats()
+    assert stats["sweeps"] == 2
+    assert stats["policies"]["idle"]["stale_entries_skipped"] == 1
+    assert stats["policies"]["retention"]["tracked"] == 1
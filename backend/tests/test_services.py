@@ -0,0 +1,670 @@
+import asyncio
+import os
+import sqlite3
+import random
+import pytest
+import pandas as pd
+from app.services.ai_service import AiModelService, classify_query_type
+from app.services.code_cache import GeneratedCodeCache, normalize_question, schema_fingerprint
+from app.services.column_resolver import ColumnResolver
+from app.services.data_service import looks_like_follow_up, process_dataframe_query, parse_query_plan
+from app.services.dataset_context import build_dataset_context
+from app.services.llm_provider import LocalStubProvider, parse_latency_spec, STAGE_CLASSIFY, STAGE_PLAN
+from app.services.query_classifier import LocalQueryClassifier
+
+
+def test_stub_provider_scripted_responses():
+    """Test that the stub provider returns scripted responses per stage, cycling lists."""
+    provider = LocalStubProvider(script={STAGE_CLASSIFY: ["DATA_ANALYSIS", "GENERAL_CONVERSATION"]})
+    responses = [provider.generate("prompt", "model", STAGE_CLASSIFY) for _ in range(3)]
+    assert responses == ["DATA_ANALYSIS", "GENERAL_CONVERSATION", "DATA_ANALYSIS"]
+    assert provider.get_stats()["calls"] == 3
+
+
+def test_parse_latency_spec():
+    """Test latency spec parsing for the stub provider."""
+    rng = random.Random(0)
+    assert parse_latency_spec("fixed:0.5")(rng) == 0.5
+    assert 0.1 <= parse_latency_spec("uniform:0.1,0.2")(rng) <= 0.2
+    with pytest.raises(ValueError):
+        parse_latency_spec("bogus:1")
+
+
+def test_pipeline_with_stub_provider(monkeypatch):
+    """Test the data analysis pipeline end-to-end against the stub provider."""
+    provider = LocalStubProvider()
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+
+    monkeypatch.setattr("app.services.ai_service.LOCAL_CLASSIFIER_ENABLED", False)
+
+    query_type = asyncio.run(classify_query_type("What is the average salary by department?"))
+    assert query_type == "DATA_ANALYSIS"
+
+    result_data, answer, code = asyncio.run(process_dataframe_query("What is the average salary by department?"))
+    assert code == "df.groupby('Department')['Salary'].mean()"
+    assert isinstance(result_data, dict) and len(result_data) > 0
+    assert answer
+    assert provider.get_stats()["calls"] == 4
+
+
+def test_single_shot_pipeline(monkeypatch):
+    """Test that single-shot mode answers a data query with one structured call plus the explanation."""
+    provider = LocalStubProvider()
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+    monkeypatch.setattr("app.services.data_service.QUERY_PIPELINE_MODE", "single_shot")
+
+    result_data, answer, code = asyncio.run(process_dataframe_query("Average salary per department?"))
+    assert code == "df.groupby('Department')['Salary'].mean()"
+    assert isinstance(result_data, dict)
+    assert provider.get_stats()["calls"] == 2
+
+
+def test_single_shot_falls_back_on_invalid_plan(monkeypatch):
+    """Test that an unparseable single-shot response falls back to the multi-step pipeline."""
+    provider = LocalStubProvider(script={STAGE_PLAN: '{"code": ""}'})
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+    monkeypatch.setattr("app.services.data_service.QUERY_PIPELINE_MODE", "single_shot")
+
+    result_data, answer, code = asyncio.run(process_dataframe_query("Average salary per department?"))
+    assert code == "df.groupby('Department')['Salary'].mean()"
+    assert provider.get_stats()["calls"] == 4
+
+
+def test_parse_query_plan():
+    """Test schema validation of single-shot responses."""
+    plan = parse_query_plan('```json\n{"column_mapping": {"pay": "Salary"}, "code": "df[\'Salary\'].max()", "response_length": "MEDIUM"}\n```')
+    assert plan.code == "df['Salary'].max()"
+    assert plan.response_length == "MEDIUM"
+    assert parse_query_plan("not json") is None
+    assert parse_query_plan('{"code": "df.head()", "response_length": "LONG"}') is None
+
+
+def test_code_cache_reuses_code_for_equivalent_questions(monkeypatch, isolated_code_cache):
+    """Test that a repeated (normalized) question skips mapping and code generation."""
+    provider = LocalStubProvider()
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+
+    asyncio.run(process_dataframe_query("Average salary by department?"))
+    assert provider.get_stats()["calls"] == 3
+
+    result_data, answer, code = asyncio.run(process_dataframe_query("  average SALARY by department "))
+    assert code == "df.groupby('Department')['Salary'].mean()"
+    # Only the explanation call is needed on a cache hit
+    assert provider.get_stats()["calls"] == 4
+    assert isolated_code_cache.get_stats()["hits"] == 1
+
+
+def test_question_normalization_keeps_operators():
+    """Test that cache keys only fold case, whitespace and trailing punctuation, and "IT" isn't a follow-up."""
+    assert normalize_question("  Average SALARY by department ?") == "average salary by department"
+    assert normalize_question("Employees with salary > 50000") != normalize_question("employees with salary < 50000")
+    assert normalize_question("salary >= 50000") != normalize_question("salary = 50000")
+    assert not looks_like_follow_up("How many employees work in IT?")
+    assert looks_like_follow_up("Is it higher than in HR?")
+
+
+def test_code_cache_persistence_and_invalidation(tmp_path):
+    """Test that the cache survives a reload and drops entries when the schema changes."""
+    path = str(tmp_path / "code_cache.json")
+    df = pd.DataFrame({"Department": ["IT", "HR"], "Salary": [1, 2]})
+    cache = GeneratedCodeCache(path=path, max_entries=2, flush_interval=0)
+    cache.put("Total salary?", schema_fingerprint(df), "df['Salary'].sum()", "BRIEF")
+    # Puts only mark the cache dirty; the file is written by a flush (background thread or close)
+    assert not os.path.exists(path)
+    cache.close()
+    assert os.path.exists(path) and not cache.flush()
+
+    reloaded = GeneratedCodeCache(path=path)
+    assert reloaded.get("total salary", schema_fingerprint(df))["code"] == "df['Salary'].sum()"
+
+    changed = df.assign(Bonus=[0.5, 0.1])
+    assert reloaded.get("total salary", schema_fingerprint(changed)) is None
+    assert reloaded.get_stats()["invalidations"] == 1
+
+    # Entries of other datasets survive lookups against a different dataset
+    cache = GeneratedCodeCache(max_entries=10)
+    cache.put("Total salary?", "fp-a", "df['Salary'].sum()", dataset_name="a")
+    cache.put("Total bonus?", "fp-b", "df['Bonus'].sum()", dataset_name="b")
+    assert cache.get("total salary", "fp-a", dataset_name="a") is not None
+    assert cache.get("total bonus", "fp-b", dataset_name="b") is not None
+    assert cache.get_stats()["invalidations"] == 0
+    assert cache.get("total salary", "fp-a2", dataset_name="a") is None
+    assert cache.get("total bonus", "fp-b", dataset_name="b") is not None
+    assert cache.get_stats()["invalidations"] == 1
+
+
+def test_code_cache_lru_and_ttl():
+    """Test LRU eviction and TTL expiry of cached code."""
+    cache = GeneratedCodeCache(max_entries=2, ttl_seconds=0)
+    for question in ["a", "b", "c"]:
+        cache.put(question, "fp", f"df['{question}']")
+    assert cache.get("a", "fp") is None
+    assert cache.get("c", "fp") is not None
+    assert cache.get_stats()["evictions"] == 1
+
+    expiring = GeneratedCodeCache(ttl_seconds=1)
+    expiring.put("a", "fp", "df.head()")
+    expiring._entries[expiring.make_key("a", "fp")]["created_at"] -= 10
+    assert expiring.get("a", "fp") is None
+
+
+def test_column_resolver_matches_variants():
+    """Test local column mapping of typos, plurals and synonyms."""
+    resolver = ColumnResolver()
+    columns = ["EmployeeID", "Department", "Salary", "Performance", "Sales"]
+    resolution = resolver.resolve("Average performence of workers per dept in sale", columns)
+    assert resolution.mapping == {
+        "performence": "Performance", "workers": "EmployeeID", "dept": "Department", "sale": "Sales"
+    }
+    assert 0.8 <= resolution.confidence < 1.0
+    assert resolver.resolve("hello there", columns).confidence == 0.0
+
+
+def test_column_mapping_falls_back_to_llm_on_low_confidence(monkeypatch):
+    """Test that the mapping model call is only made when local confidence is too low."""
+    provider = LocalStubProvider()
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+
+    debug_info = {}
+    asyncio.run(process_dataframe_query("Who is best paid?", debug_info=debug_info))
+    assert debug_info["column_mapping_source"] == "llm"
+    assert debug_info["column_mapping_confidence"] == 0.0
+    assert provider.get_stats()["calls"] == 4
+
+
+def test_local_classifier_decides_easy_cases():
+    """Test that greetings, clear data questions and follow-ups are classified without the model."""
+    classifier = LocalQueryClassifier(ColumnResolver())
+    dataset = build_dataset_context(pd.DataFrame({"Name": ["Ann", "Bob"], "Department": ["IT", "Sales"], "Salary": [1, 2]}))
+
+    assert classifier.classify("Hi there!", dataset)[0] == "GENERAL_CONVERSATION"
+    assert classifier.classify("What is the average salary per department?", dataset)[0] == "DATA_ANALYSIS"
+    assert classifier.classify("How many people work in Sales?", dataset)[0] == "DATA_ANALYSIS"
+    assert classifier.classify("Thank you very much", dataset)[0] == "GENERAL_CONVERSATION"
+    assert classifier.classify("What about IT?", dataset, has_last_result=True, is_follow_up=True)[0] == "DATA_ANALYSIS"
+    # Follow-ups without any data reference aren't assumed to be analysis
+    for question in ["thanks, that was helpful", "Can you explain that in simpler terms?",
+                     "Why is that important?", "tell me a joke about them"]:
+        assert classifier.classify(question, dataset, has_last_result=True, is_follow_up=True)[0] is None
+    assert classifier.classify("Which salary band am I in?", dataset)[0] is None
+    # No column match isn't evidence of small talk: these are left to the model
+    assert classifier.classify("Who is the best performer?", dataset)[0] is None
+    assert classifier.classify("Great", dataset)[0] is None
+
+    stats = classifier.get_stats()
+    assert stats["local_data"] == 3 and stats["local_general"] == 2 and stats["llm"] == 7
+
+
+def test_classify_query_type_skips_model_for_greetings(monkeypatch):
+    """Test that a greeting never reaches the LLM classification call."""
+    provider = LocalStubProvider()
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+
+    assert asyncio.run(classify_query_type("thanks!")) == "GENERAL_CONVERSATION"
+    assert provider.get_stats()["calls"] == 0
+
+
+def test_dataset_context_is_built_once_per_data_version(monkeypatch):
+    """Test that the prerendered context is reused until the dataframe changes."""
+    from app.services import data_service
+    first = data_service.get_dataset_context()
+    assert data_service.get_dataset_context() is first
+    assert first.columns_text == str(list(first.df.columns))
+    assert first.sample_text_3 in first.codegen_schema
+
+    # Publishing a new frame swaps in the next version; the old snapshot stays intact
+    from app.services.dataset_registry import DatasetRegistry
+    from app.services.dataset_store import DatasetStore
+    registry = DatasetRegistry({"employees": data_service.DATA_FILE_PATH}, "employees",
+                               lambda name, path: DatasetStore(path, lambda: first.df, name=name))
+    monkeypatch.setattr(data_service, "dataset_registry", registry)
+    store = registry.store()
+    base = data_service.get_dataset_context()
+    second = store.publish(first.df.head(5).copy())
+    assert data_service.get_dataset_context() is second
+    assert second.version == base.version + 1
+    assert second.shape == (5, first.shape[1])
+    assert base.shape == first.shape
+
+
+def test_dataset_columnar_cache(tmp_path, monkeypatch):
+    """Test that the spreadsheet is parsed once, then served from the columnar cache until it changes."""
+    import numpy as np
+    import pandas as pd
+    from app.services.dataset_cache import read_dataset
+    source = str(tmp_path / "data.xlsx")
+    df = pd.DataFrame({
+        "Name": ["Ann", None, "Cy"],
+        "Salary": [100, 200, 300],
+        "Rating": [4.5, np.nan, 3.0],
+        "Hired": pd.to_datetime(["2020-01-01", "2021-06-15", "2022-03-01"]),
+    })
+    df.to_excel(source, index=False)
+
+    excel_reads = []
+    read_excel = pd.read_excel
+    monkeypatch.setattr(pd, "read_excel", lambda *args, **kwargs: excel_reads.append(1) or read_excel(*args, **kwargs))
+
+    first = read_dataset(source)
+    second = read_dataset(source)
+    assert len(excel_reads) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+    # A changed source invalidates the cache
+    df.assign(Salary=df["Salary"] * 2).to_excel(source, index=False)
+    assert read_dataset(source)["Salary"].tolist() == [200, 400, 600]
+    assert len(excel_reads) == 2
+
+
+def test_dataset_store_hot_reload(tmp_path):
+    """Test that a changed source is reloaded into a new version and a failed reload keeps the old one."""
+    import os
+    import pandas as pd
+    from app.services.dataset_store import DatasetStore
+    source = tmp_path / "data.csv"
+    pd.DataFrame({"Salary": [1, 2]}).to_csv(source, index=False)
+    swaps = []
+    store = DatasetStore(str(source), lambda: pd.read_csv(source))
+    store.add_listener(lambda context: swaps.append(context.version))
+
+    v1 = store.current()
+    assert not store.reload_if_changed()
+
+    pd.DataFrame({"Salary": [1, 2, 3]}).to_csv(source, index=False)
+    os.utime(source, ns=(0, 10**9))
+    assert store.reload_if_changed()
+    assert store.current().version == 2 and store.current().shape == (3, 1)
+    assert v1.df["Salary"].tolist() == [1, 2]
+
+    source.write_text("")
+    os.utime(source, ns=(0, 2 * 10**9))
+    assert not store.reload_if_changed()
+    assert store.current().version == 2
+    assert swaps == [1, 2] and store.get_stats()["failed_reloads"] == 1
+
+
+def test_dataset_registry_lazy_loading_and_memory_budget(tmp_path):
+    """Test that datasets load on first use and the least recently used one is evicted over budget."""
+    import pandas as pd
+    from app.services.dataset_registry import DatasetRegistry, UnknownDatasetError, parse_dataset_sources
+    from app.services.dataset_store import DatasetStore
+    sources = {}
+    for name in ["a", "b", "c"]:
+        path = tmp_path / f"{name}.csv"
+        pd.DataFrame({"Team": [name] * 100, "Value": range(100)}).to_csv(path, index=False)
+        sources[name] = str(path)
+    assert parse_dataset_sources(",".join(f"{name}={path}" for name, path in sources.items())) == sources
+
+    loads = []
+    def factory(name, path):
+        return DatasetStore(path, lambda: loads.append(name) or pd.read_csv(path), name=name)
+    frame_bytes = int(pd.read_csv(sources["a"]).memory_usage(deep=True).sum())
+    registry = DatasetRegistry(sources, "a", factory, memory_budget_bytes=int(frame_bytes * 2.5))
+    unloaded = []
+    registry.add_unload_listener(unloaded.append)
+    assert loads == []
+
+    assert registry.get().name == "a"
+    assert registry.get("b").df["Team"].iloc[0] == "b"
+    registry.get("a")
+    # Loading c goes over budget and unloads b, the least recently used
+    c = registry.get("c")
+    assert loads == ["a", "b", "c"]
+    stats = registry.get_stats()
+    assert stats["evictions"] == 1 and not stats["datasets"]["b"]["loaded"]
+    assert unloaded == ["b"]
+    assert stats["memory_used_bytes"] <= registry.memory_budget_bytes
+
+    # An evicted dataset is reloaded on next use with a new version
+    assert registry.get("b").version == 2
+    assert loads[-1] == "b"
+    assert registry.get("c") is c
+    assert not registry.get_stats()["datasets"]["a"]["loaded"]
+    with pytest.raises(UnknownDatasetError):
+        registry.get("missing")
+
+
+def test_code_executor_runs_in_worker_processes_with_timeout():
+    """Test that generated code runs in a worker, errors come back, and a runaway job is killed."""
+    import pandas as pd
+    from app.services.code_executor import CodeExecutor, ExecutionError, ExecutionTimeoutError
+    executor = CodeExecutor(pool_size=1, timeout_seconds=2, cpu_seconds=30)
+    dataset = build_dataset_context(pd.DataFrame({"Department": ["IT", "IT", "HR"], "Salary": [1, 2, 3]}))
+    try:
+        result = asyncio.run(executor.run("df.groupby('Department')['Salary'].sum()", dataset))
+        assert result.to_dict() == {"HR": 3, "IT": 3}
+        with pytest.raises(ExecutionError, match="NoSuchColumn"):
+            asyncio.run(executor.run("df['NoSuchColumn']", dataset))
+        # The failed job made the worker drop its copy; it gets the dataset again with the next job
+        assert executor._idle.queue[0].datasets == {}
+        with pytest.raises(ExecutionTimeoutError):
+            asyncio.run(executor.run("sum(range(10 ** 15))", dataset))
+
+        # The killed worker was replaced and gets the dataset again
+        assert asyncio.run(executor.run("len(df)", dataset)) == 3
+        stats = executor.get_stats()
+        assert stats["timed_out"] == 1 and stats["workers_killed"] == 1
+        assert stats["completed"] == 2 and stats["dataset_transfers"] == 3
+
+        # Unloading releases the parent's pickled copy and the worker's frame; the next use sends it again
+        executor.unload(dataset.name)
+        assert executor._payloads == {}
+        assert asyncio.run(executor.run("len(df)", dataset)) == 3
+        assert executor.get_stats()["dataset_transfers"] == 4
+    finally:
+        executor.close()
+
+
+def test_evaluated_expressions_cannot_change_the_shared_frame(monkeypatch):
+    """Test that column pop/insert in generated code only affects the expression's own copy."""
+    import pandas as pd
+    from app.services import code_executor
+    df = pd.DataFrame({"Department": ["IT", "HR"], "Salary": [1, 2]})
+    # Bypass the whitelist to simulate a mutating call it doesn't know about
+    monkeypatch.setattr(code_executor.expression_compiler, "compile",
+                        lambda code, columns: compile(code, "<test>", "eval"))
+    code_executor.evaluate_expression("df.pop('Salary')", df)
+    code_executor.evaluate_expression("df.insert(0, 'x', 1)", df)
+    assert list(df.columns) == ["Department", "Salary"]
+
+
+def test_expression_compiler_whitelist_and_cache():
+    """Test that generated expressions are checked against the whitelist and compiled once per source."""
+    from app.services.expression_compiler import ExpressionCompiler, UnsafeExpressionError
+    compiler = ExpressionCompiler()
+    columns = ["Department", "Salary", "profile_file"]
+    for code in [
+        "df[df['profile_file'].str.contains('cv')]",
+        "df.groupby('Department')['Salary'].mean().idxmax()",
+        "df.Salary.apply(lambda value: round(value / 1000, 1)).sum()",
+        "pd.to_numeric(df['Salary']).describe().to_dict()",
+        "df.head().to_string(index=False)",
+        "df.groupby('Department')['Salary'].mean().to_json(orient='index')",
+        "df.to_markdown()",
+        "df.to_html(max_rows=10)",
+    ]:
+        compiler.compile(code, columns)
+    for code in [
+        "__import__('os').system('ls')",
+        "open('/etc/passwd').read()",
+        "df.to_csv('/tmp/out.csv')",
+        "pd.read_csv('/etc/passwd')",
+        "df.__class__",
+        "'{0.__class__}'.format(df)",
+        "df.NotAColumn",
+        "df.pop('Salary')",
+        "df.insert(0, 'x', 1)",
+        "df.update(df * 0)",
+        "df.drop(columns=['Salary'], inplace=True)",
+        "df.rename(columns={'Salary': 'Pay'}, inplace=True)",
+        "df['Salary'].fillna(0, inplace=False)",
+        "df.sort_values(**{'by': 'Salary', 'inplace': True})",
+        "df.query('Salary > 1', inplace=True)",
+        "df.set_axis(['a', 'b', 'c'], axis=1)",
+        "df.to_json('/tmp/out.json')",
+        "df.to_string(buf='/tmp/out.txt')",
+        "df.to_html(path_or_buf='/tmp/out.html')",
+        "df.to_string",
+        "df.Salary.apply(df.to_json)",
+    ]:
+        with pytest.raises(UnsafeExpressionError):
+            compiler.compile(code, columns)
+    with pytest.raises(SyntaxError):
+        compiler.compile("x = df", columns)
+
+    code = compiler.compile("df['Salary'].max()", columns)
+    assert compiler.compile("df['Salary'].max()", columns) is code
+    assert compiler.get_stats()["hits"] == 1
+
+
+def test_expression_compiler_checks_method_names_in_strings():
+    """Test that methods named by strings (agg/transform/apply) and query() strings are whitelisted too."""
+    from app.services.expression_compiler import ExpressionCompiler, UnsafeExpressionError
+    compiler = ExpressionCompiler()
+    columns = ["Department", "Salary", "Hire Date"]
+    for code in [
+        "df.groupby('Department')['Salary'].agg('mean')",
+        "df.groupby('Department').agg(total=('Salary', 'sum'), top=('Salary', 'max'))",
+        "df.agg({'Salary': ['min', 'max']})",
+        "df.query('Salary > 50000 and `Hire Date` > 2020')",
+        "df.query('Department.str.contains(\"IT\")', engine='python')",
+    ]:
+        compiler.compile(code, columns)
+    for code in [
+        "df.transform('to_csv', path_or_buf='/tmp/x.csv')",
+        "df.query('@pd.read_csv(\"/etc/hostname\")')",
+        "df.groupby('Department').agg(total=('Salary', 'to_pickle'))",
+        "df.agg(['mean', 'to_csv'])",
+        "df.apply('query', expr='Salary > 0')",
+        "df.query('Salary.to_csv(\"/tmp/x.csv\")')",
+        "df.query('Salary > 0', local_dict={})",
+        "df.agg('save')",
+    ]:
+        with pytest.raises(UnsafeExpressionError):
+            compiler.compile(code, columns)
+
+
+def test_result_cache_by_expression_and_version():
+    """Test that results are shared across formatting differences, bounded in bytes and dropped on new data."""
+    import pandas as pd
+    from app.services.result_cache import ResultCache, result_size
+    frame = pd.DataFrame({"Salary": range(1000)})
+    cache = ResultCache(max_bytes=int(result_size(frame) * 1.5))
+    cache.put("employees", 1, "df.groupby('Department')['Salary'].mean()", 42.0)
+    assert cache.get("employees", 1, 'df.groupby( "Department" )["Salary"].mean()') == (True, 42.0)
+    assert cache.get("employees", 2, "df.groupby('Department')['Salary'].mean()") == (False, None)
+
+    # A second large frame pushes out the least recently used entries
+    cache.put("employees", 1, "df.head(1000)", frame)
+    cache.put("employees", 1, "df.tail(1000)", frame.copy())
+    assert cache.get("employees", 1, "df.head(1000)")[0] is False
+    assert cache.get_stats()["bytes"] <= cache.max_bytes
+
+    assert cache.invalidate("employees", keep_version=2) == 1
+    stats = cache.get_stats()
+    assert stats["entries"] == 0 and stats["bytes"] == 0
+    assert stats["hits"] == 1 and stats["hit_ratio"] == 0.3333
+
+
+def test_result_store_expiry_and_budget(monkeypatch):
+    """Test that stored results expire after the TTL since last read and are bounded in count."""
+    import pandas as pd
+    from app.services import result_store as result_store_module
+    from app.services.result_store import ResultStore, ResultNotFoundError
+    now = [1000.0]
+    monkeypatch.setattr(result_store_module.time, "time", lambda: now[0])
+    store = ResultStore(ttl_seconds=60, max_results=2)
+    frame = pd.DataFrame({"Salary": range(10)})
+    first, second = store.put(frame), store.put(frame)
+
+    now[0] += 50
+    assert store.page(first, 8, 5) == ([{"Salary": 8}, {"Salary": 9}], 10)
+    now[0] += 20
+    with pytest.raises(ResultNotFoundError):
+        store.page(second)
+    store.put(frame)
+    store.put(frame)
+    with pytest.raises(ResultNotFoundError):
+        store.page(first)
+    assert store.get_stats()["expired"] == 1 and store.get_stats()["evicted"] == 1
+
+
+def test_long_series_results_are_previewed_and_stored(monkeypatch):
+    """Test that a Series longer than the preview is stored as a table of labels and values."""
+    from app.services import data_service
+    from app.services.llm_provider import STAGE_CODEGEN
+    provider = LocalStubProvider(script={STAGE_CODEGEN: "df.set_index('Name')['Salary']"})
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+
+    debug_info = {}
+    result_data, answer, code = asyncio.run(process_dataframe_query("Salary of every employee?", debug_info=debug_info))
+    df = data_service.get_dataset_context().df
+    assert debug_info["result_rows"] == len(df) > len(result_data) == data_service.RESULT_PREVIEW_ROWS
+    assert result_data[0] == {"Name": df["Name"].iloc[0], "Salary": df["Salary"].iloc[0]}
+    rows, total = data_service.result_store.page(debug_info["result_id"], offset=len(df) - 1)
+    assert total == len(df) and rows == [{"Name": df["Name"].iloc[-1], "Salary": df["Salary"].iloc[-1]}]
+
+
+def test_aggregate_cube_answers_group_by_expressions():
+    """Test that cube answers equal evaluating on the frame, and other expressions fall through."""
+    import pandas as pd
+    from app.services.aggregate_cube import AggregateCubeStore
+    from app.services.code_executor import evaluate_expression
+    df = pd.DataFrame({
+        "Department": ["IT", "HR", "IT", "Sales", "HR", "IT"],
+        "Salary": [90000, 60000, 85000, 65000, 62000, 70000],
+        "Performance": [4.1, 3.5, 4.8, 3.9, None, 4.4],
+    })
+    cubes = AggregateCubeStore(max_cardinality=10, max_plans=4)
+    context = build_dataset_context(df, version=3, name="employees")
+    cubes.rebuild(context)
+
+    for code in [
+        "df.groupby('Department')['Salary'].mean().sort_values(ascending=False).head(2)",
+        "df.groupby('Department')['Performance'].agg('max').idxmax()",
+        "df.groupby('Department')['Salary'].idxmax()",
+        "df['Department'].value_counts()",
+        "round(df['Performance'].mean(), 2)",
+    ]:
+        answered, result = cubes.evaluate(context, code)
+        expected = evaluate_expression(code, df)
+        assert answered
+        assert result.equals(expected) if hasattr(expected, "equals") else result == expected
+
+    # Filters and uncubed aggregations need the frame; an older version has no cube
+    assert cubes.evaluate(context, "df[df['Salary'] > 65000]['Salary'].mean()") == (False, None)
+    assert cubes.evaluate(context, "df.groupby('Department')['Salary'].median()") == (False, None)
+    assert cubes.evaluate(build_dataset_context(df, version=2, name="employees"),
+                          "df['Salary'].sum()") == (False, None)
+    stats = cubes.get_stats()
+    assert stats["hits"] == 5 and stats["misses"] == 3
+    assert stats["cubes"]["employees"]["version"] == 3
+    # Plans of the 7 distinct expressions are kept in a bounded LRU
+    assert stats["cubes"]["employees"]["plans"] == 4
+
+
+def test_dtype_compaction_is_lossless():
+    """Test that compaction shrinks repetitive text and numbers without changing any value."""
+    import numpy as np
+    import pandas as pd
+    from app.services.dtype_compaction import compact_with_report
+    df = pd.DataFrame({
+        "EmployeeID": [f"Employee_{i}" for i in range(200)],
+        "Department": ["IT", "HR", "Sales", np.nan] * 50,
+        "Salary": np.arange(60000, 80000, 100),
+        "Rating": [4.5, 3.25, None, 4.0] * 50,
+        "Bonus": [0.1, 0.2, 0.3, 0.4] * 50,
+    })
+    compacted, report = compact_with_report(df)
+    dtypes = {column["name"]: column["dtypeAfter"] for column in report["columns"]}
+    assert dtypes == {"EmployeeID": "object", "Department": "category", "Salary": "int32",
+                      "Rating": "float32", "Bonus": "float64"}
+    assert report["bytesAfter"] < report["bytesBefore"]
+    pd.testing.assert_frame_equal(compacted.astype(df.dtypes.to_dict()), df)
+
+
+def test_sql_engine_dataset(tmp_path, monkeypatch):
+    """Test that a SQL dataset is imported once, answers generated SELECTs and rejects anything else."""
+    import pandas as pd
+    from app.services import data_service
+    from app.services.code_executor import ExecutionTimeoutError
+    from app.services.dataset_registry import DatasetRegistry
+    from app.services.expression_compiler import UnsafeExpressionError
+    from app.services.llm_provider import STAGE_CODEGEN
+    from app.services.sql_engine import SqlDatasetStore, SqlEngine
+    source = tmp_path / "employees.csv"
+    pd.DataFrame({
+        "Department": ["IT", "HR", "IT", "Sales"] * 25,
+        "Salary": range(50000, 60000, 100),
+    }).to_csv(source, index=False)
+
+    store = SqlDatasetStore(str(source), name="warehouse")
+    context = store.current()
+    assert context.shape == (100, 2) and context.columns == ["Department", "Salary"]
+    assert "sales" in context.category_values
+    # The import is reused while the source is unchanged
+    mtime = (tmp_path / "employees.csv.sqlite").stat().st_mtime_ns
+    assert SqlDatasetStore(str(source), name="warehouse").current().shape == (100, 2)
+    assert (tmp_path / "employees.csv.sqlite").stat().st_mtime_ns == mtime
+
+    engine = SqlEngine(timeout_seconds=0.2, max_rows=2)
+    assert asyncio.run(engine.run('SELECT AVG("Salary") FROM "data";', context)) == (54950.0, False)
+    frame, truncated = asyncio.run(engine.run('SELECT "Department", COUNT(*) AS n FROM "data" GROUP BY 1', context))
+    assert truncated and list(frame.columns) == ["Department", "n"] and len(frame) == 2
+    for sql in ['DROP TABLE "data"', 'SELECT 1; DELETE FROM "data"', "SELECT * FROM _source",
+                "WITH x AS (SELECT 1) DELETE FROM \"data\"", "SELECT load_extension('x')"]:
+        with pytest.raises(Exception) as error:
+            engine.execute(sql, context.database_path)
+        assert isinstance(error.value, (UnsafeExpressionError, sqlite3.Error))
+    with pytest.raises(ExecutionTimeoutError):
+        engine.execute("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT MAX(i) FROM n",
+                       context.database_path)
+
+    # The pipeline asks for SQL and returns the same result shapes as for pandas
+    provider = LocalStubProvider(script={
+        STAGE_CODEGEN: '```sql\nSELECT "Department", AVG("Salary") AS "Salary" FROM "data" GROUP BY "Department"\n```'
+    })
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+    registry = DatasetRegistry({"warehouse": str(source)}, "warehouse", data_service._create_dataset_store)
+    monkeypatch.setattr(data_service, "dataset_registry", registry)
+    monkeypatch.setattr(data_service, "dataset_engines", {"warehouse": "sql"})
+    debug_info = {}
+    result_data, answer, code = asyncio.run(process_dataframe_query("Average salary by department?",
+                                                                    debug_info=debug_info))
+    assert code.startswith("SELECT") and debug_info["engine"] == "sql"
+    expected = pd.read_csv(source).groupby("Department", as_index=False)["Salary"].mean()
+    assert result_data == expected.to_dict("records")
+    assert answer
+
+
+def test_identical_concurrent_requests_share_one_pipeline(monkeypatch):
+    """Test that concurrent identical questions share one model pipeline and different ones don't."""
+    from app.services import data_service
+    from app.services.single_flight import SingleFlight
+    provider = LocalStubProvider(latency="fixed:0.05")
+    monkeypatch.setattr("app.services.ai_service.get_llm_provider", lambda: provider)
+    flights = SingleFlight("query")
+    monkeypatch.setattr(data_service, "query_flights", flights)
+
+    async def ask_all():
+        questions = ["What is the average salary by department?"] * 5 + ["what is the AVERAGE salary by department ?"] * 4
+        debug_infos = [{} for _ in questions]
+        answers = await asyncio.gather(*[
+            process_dataframe_query(question, debug_info=debug_info)
+            for question, debug_info in zip(questions, debug_infos)
+        ])
+        return answers, debug_infos
+
+    answers, debug_infos = asyncio.run(ask_all())
+    assert all(answer == answers[0] for answer in answers)
+    assert sum(debug_info["coalesced"] for debug_info in debug_infos) == 8
+    assert all(debug_info["data_version"] == debug_infos[0]["data_version"] for debug_info in debug_infos)
+    # One codegen, one response-length and one explanation call for all nine requests
+    assert provider.get_stats()["calls"] == 3
+    assert flights.get_stats() == {"calls": 9, "executions": 1, "coalesced": 8, "failed": 0, "in_flight": 0}
+
+    # Questions that differ only in an operator or a number never share a run
+    keys = {data_service.coalescing_key(question) for question in [
+        "Employees with salary > 50000?", "employees with salary < 50000", "Employees with salary > 60000",
+    ]}
+    assert len(keys) == 3
+    assert data_service.coalescing_key("Employees with salary > 50000?") == data_service.coalescing_key(
+        "  employees with SALARY > 50000")
+
+    # A waiter that gives up doesn't cancel the shared run; failures reach every waiter
+    async def cancel_and_fail():
+        async def slow():
+            await asyncio.sleep(0.05)
+            return "done"
+        first = asyncio.ensure_future(flights.run("slow", slow))
+        second = asyncio.ensure_future(flights.run("slow", slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        async def boom():
+            raise ValueError("boom")
+        failures = await asyncio.gather(flights.run("boom", boom), flights.run("boom", boom), return_exceptions=True)
+        return await second, failures
+
+    second, failures = asyncio.run(cancel_and_fail())
+    assert second == ("done", True)
+    assert all(isinstance(failure, ValueError) for failure in failures)